@@ -22,18 +22,15 @@ def get_secret():
  
     for vserv in vault_clusters:
         if vserv in cluster_tokens:
-            secret = vault_call(vserv, "get")
+            secret = cached_secret(vserv)
         else:
             continue
  
         if secret == "Connection Failed":
-            if vserv != vault_clusters[-1]:
-                continue
-            else:
-                return "Unable to Retrieve Secret"
+            continue
         elif secret == 403:
             if get_token(vserv):
-                secret = vault_call(vserv, "get")
+                secret = cached_secret(vserv)
                 break
             else:
                 continue
@@ -42,4 +39,11 @@ def get_secret():
         else:
             break
  
+    # No cluster could be read: serve the secret cached before the outage,
+    # unless Vault answered that it does not exist
+    if not isinstance(secret, dict) and secret != 404:
+        secret = stale_secret(vault_clusters)
+        if secret is None:
+            return "Unable to Retrieve Secret"
+
     return secret
@@ -11,16 +11,20 @@ def get_secret():
         if not get_token("vault-east"):
             return "Unable to Retrieve Token"
 
-    secret = vault_call("vault-east", "get")
+    secret = cached_secret("vault-east")
  
-    if secret == "Connection Failed":
-        return "Unable to Retrieve Secret"
-    elif secret == 403:
+    if secret == 403:
         if get_token("vault-east"):
-            secret = vault_call("vault-east", "get")
+            secret = cached_secret("vault-east")
         else:
             return "Unable to Retrieve Secret"
     elif secret == 404:
         return "Empty Secret"
 
+    # Also after a new token: serve the secret cached before the outage
+    if secret == "Connection Failed":
+        secret = stale_secret(["vault-east"])
+        if secret is None:
+            return "Unable to Retrieve Secret"
+
     return secret
@@ -0,0 +1,73 @@
+secret_cache = {}
+secret_ttl = int(os.environ.get("SECRET_TTL", "300"))
+# Refresh in the background once less than this fraction of the TTL is left
+refresh_ahead = 0.2
+# Seconds past expiry a secret may still be served while Vault cannot be
+# reached, 0 to never serve stale secrets
+stale_ttl = int(os.environ.get("SECRET_STALE_TTL", "0"))
+
+
+def read_secret(vserv, vpath):
+
+    resp = vault_call(vserv, "read", vpath)
+    if not isinstance(resp, dict):
+        return resp
+
+    # The lease of the secret if it has one, otherwise the cache_ttl of its
+    # KV custom metadata, otherwise SECRET_TTL
+    metadata = resp["data"].get("metadata") or {}
+    custom = metadata.get("custom_metadata") or {}
+    ttl = resp.get("lease_duration")
+    if not ttl:
+        # Custom metadata is free text, "5m" is not a number of seconds
+        try:
+            ttl = int(custom.get("cache_ttl", secret_ttl))
+        except (ValueError, TypeError):
+            ttl = secret_ttl
+
+    secret_cache[(vserv, vpath)] = {
+        "data": resp["data"]["data"],
+        "ttl": ttl,
+        "expires": time.monotonic() + ttl,
+        "refreshing": False,
+    }
+
+    return resp["data"]["data"]
+
+
+def refresh_secret(vserv, vpath, entry):
+
+    try:
+        read_secret(vserv, vpath)
+    finally:
+        entry["refreshing"] = False
+
+
+def cached_secret(vserv, vpath="secrets/data/myapp"):
+
+    entry = secret_cache.get((vserv, vpath))
+    now = time.monotonic()
+
+    if entry is None or now >= entry["expires"]:
+        return read_secret(vserv, vpath)
+
+    if (now >= entry["expires"] - entry["ttl"] * refresh_ahead
+            and not entry["refreshing"]):
+        entry["refreshing"] = True
+        threading.Thread(target=refresh_secret,
+                         args=(vserv, vpath, entry),
+                         daemon=True).start()
+
+    return entry["data"]
+
+
+def stale_secret(vservs, vpath="secrets/data/myapp"):
+
+    now = time.monotonic()
+
+    for vserv in vservs:
+        entry = secret_cache.get((vserv, vpath))
+        if entry is not None and now < entry["expires"] + stale_ttl:
+            return entry["data"]
+
+    return None
@@ -1,6 +1,39 @@
-def vault_call(vserv, vact):
+curl_pool = {}
+curl_share = {}
 
-    crl = pycurl.Curl()
+
+def vault_handle(vserv):
+
+    # One share per cluster: the handles of a cluster share their DNS cache,
+    # TLS sessions and (libcurl >= 7.57) open connections
+    if vserv not in curl_share:
+        shr = pycurl.CurlShare()
+        shr.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        shr.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+            shr.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+        curl_share[vserv] = shr
+        curl_pool[vserv] = []
+
+    # reset() clears the options of the last call but keeps the live
+    # connections and the TLS session cache of the handle
+    if curl_pool[vserv]:
+        crl = curl_pool[vserv].pop()
+        crl.reset()
+    else:
+        crl = pycurl.Curl()
+
+    crl.setopt(crl.SHARE, curl_share[vserv])
+    crl.setopt(crl.TCP_KEEPALIVE, 1)
+    if pycurl.version_info()[4] & pycurl.VERSION_HTTP2:
+        crl.setopt(crl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+
+    return crl
+
+
+def vault_call(vserv, vact, vpath="secrets/data/myapp"):
+
+    crl = vault_handle(vserv)
     data = BytesIO()
     base_url = "https://" + vserv + ":8200/v1/"
 
@@ -10,8 +43,8 @@ def vault_call(vserv, vact):
         sec_id = os.environ.get("SEC_ID")
         login_data = json.dumps({"role_id": role_id, "secret_id": sec_id})
         crl.setopt(crl.POSTFIELDS, login_data)
-    elif vact == "get":
-        vault_url = base_url + "secrets/data/myapp"
+    elif vact in ("get", "read"):
+        vault_url = base_url + vpath
         vault_header = ["X-Vault-Token: " + cluster_token[vserv]]
         crl.setopt(crl.HTTPHEADER, vault_header)
     else:
@@ -25,12 +58,13 @@ def vault_call(vserv, vact):
         crl.perform()
         resp_data = json.loads(data.getvalue())
         resp_code = crl.getinfo(pycurl.RESPONSE_CODE)
-    except pycurl.error:
+    except (pycurl.error, ValueError):
+        # The connection may be broken or half read: drop the handle with it
         crl.close()
         return "Connection Failed"
  
-    crl.close()
- 
+    curl_pool[vserv].append(crl)
+
     if resp_code != 200:
         return resp_code
     elif vact == "login":
@@ -1,34 +1,98 @@
 #!/usr/bin/env python3
 
 """Restore script is used to restore data for various backups for any backup
-(influxdb, cassandra), any strategy (AWS or Azure).
+(influxdb, cassandra, postgres, elasticsearch, vault), any strategy (AWS, Azure
+or a local filesystem).
 
 
-Usage: restore [-h] [--debug] [--verbose] [--show-last]
+Usage: restore [-h] [--debug] [--verbose] [--show-last] [--plan]
                [--download] [--restore] [--restore-keyspaces]
-               [--refresh] [--verify] zinfluxdb|cassandra
+               [--refresh] [--verify] [--metrics-file METRICS_FILE]
+               [--metrics-json METRICS_JSON] [--profile]
+               [--profile-cprofile] [--profile-memory]
+               [--profile-report PROFILE_REPORT] [--async-io]
+               [--concurrency CONCURRENCY] [--keyspace KEYSPACE]
+               [--table TABLE] [--database DATABASE]
+               [--since-days SINCE_DAYS] [--bandwidth BANDWIDTH]
+               [--scrub-report SCRUB_REPORT] [--jobs JOBS]
+               [--index INDEX] [--bulk-size BULK_SIZE] [--cleanup]
+               [--no-schema] [--inventory INVENTORY]
+               [--node-command NODE_COMMAND]
+               [--rack-concurrency RACK_CONCURRENCY]
+               [--coordinate-report COORDINATE_REPORT] [--dedup]
+               [--codec {gz,zst,lz4}] [--keep-daily KEEP_DAILY]
+               [--keep-weekly KEEP_WEEKLY] [--dry-run]
+               [--sstableloader HOSTS]
+               [--loader-throttle LOADER_THROTTLE]
+               [--command-timeout COMMAND_TIMEOUT]
+               [scrub|coordinate|backup|prune]
+               zinfluxdb|cassandra|postgres|elasticsearch|vault
 
 optional arguments:
   -h, --help           Show this help message and exit
   --debug              Set log level to debug
   --verbose            Set log level to verbose
   --show-last          Show the last available set of backup tarballs
+  --plan               Estimate disk space and time needed for a restore
   --download           Download last set of backup tarballs
   --restore            Restore from tarballs in the download directory
   --restore-keyspaces  Restore keyspaces (cassandra only)
   --refresh            Refresh keyspaces (cassandra only)
-  --verify             Verify restored data (cassandra only)
+  --verify             Verify restored data
+  --metrics-file       Write metrics to this Prometheus textfile
+  --metrics-json       Write metrics to this JSON file
+  --profile            Time each phase of the restore
+  --profile-cprofile   Profile the functions called in each phase
+  --profile-memory     Trace memory allocations in each phase
+  --profile-report     Write the profile report to this file
+  --async-io           List and download with the asyncio storage backends
+  --concurrency        Maximum concurrent storage requests
+  --keyspace           Only restore this keyspace (cassandra only, repeatable)
+  --table              Only restore this keyspace.table (cassandra only,
+                       repeatable)
+  --database           Only restore this database (influxdb and postgres only,
+                       repeatable)
+  --since-days         Scrub backups from the last SINCE_DAYS days
+  --bandwidth          Limit scrub reads to BANDWIDTH MB/s
+  --scrub-report       Write the scrub health report to this JSON file
+  --jobs               Parallel jobs of the postgres and elasticsearch
+                       restores, and of the influxdb and cassandra count
+                       queries
+  --index              Only restore this index (elasticsearch only,
+                       repeatable)
+  --bulk-size          Size in bytes of the bulk requests (elasticsearch only)
+  --cleanup            Remove the downloaded and extracted backups
+  --no-schema          Extract the tarballs without applying the keyspace
+                       schemas (cassandra only, with --restore-keyspaces)
+  --inventory          JSON list of the nodes to restore (coordinate only)
+  --node-command       Command running restore.py on a node (coordinate only)
+  --rack-concurrency   Nodes of a rack running a phase at a time (coordinate
+                       only)
+  --coordinate-report  Write the per-node results to this JSON file
+  --dedup              Store each SSTable file once, by content (cassandra
+                       backup only)
+  --codec              Compress the backup tarballs with this codec (backup
+                       only)
+  --keep-daily         Keep the last backup of as many days (prune only)
+  --keep-weekly        Keep the last backup of as many weeks (prune only)
+  --dry-run            Only report what would be deleted (prune only)
+  --sstableloader      Stream the tables to the cluster of these comma
+                       separated hosts with sstableloader (cassandra only)
+  --loader-throttle    Throttle each sstableloader to LOADER_THROTTLE Mbit/s
+                       (cassandra only)
+  --command-timeout    Kill the external commands that run longer than
+                       COMMAND_TIMEOUT seconds
 
 Supported database types
 ------------------------
 
 The last argument to restore script is the type of data being restored.
-Currently, we support influxdb (zinfluxdb) and cassandra. The argument passed to
-the script is the prefix of the directory used to store the encrypted tarballs
-in the storage backend. For example, influxdb data is stored in zinfluxdb-data
-and cassandra data is stored in cassandra-data. Going forward, there could be
-postgres-data, vault-data, elasticsearch-data in the storage backend, and the
-script shall take postgres, vault and elasticsearch as arguments, then.
+Currently, we support influxdb (zinfluxdb), cassandra, postgres, elasticsearch
+and vault. The argument passed to the script is the prefix of the directory
+used to store the encrypted tarballs in the storage backend. For example,
+influxdb data is stored in zinfluxdb-data, cassandra data is stored in
+cassandra-data, postgres data in postgres-data, elasticsearch data in
+elasticsearch-data and vault data in vault-data.
 
 
 Last set of backups
@@ -47,6 +111,322 @@ was taken on May 1st, 2020 at 18:45:34 and the tarballs for each keyspace were
 uploaded to cassandra-data/2020-05-01_18-45-34/, then all the tarballs in that
 directory comprise the last set of backups.
 
+InfluxDB verification
+---------------------
+
+Each influxdb backup directory holds zinfluxdb.stats.json, written by the backup
+script: for each database and measurement, the number of points (the largest
+COUNT(*) of its fields), and the time of its first and last point, in
+nanoseconds since the epoch: {"db": {"cpu": {"count": 1234, "min_time": ...,
+"max_time": ...}}}. --verify compares the restored databases with the
+manifest of the last backup restored. The points are counted shard group by
+shard group (SHOW SHARD GROUPS), so that each query only reads one shard, and
+--jobs queries run at a time; the time bounds must match exactly, the counts
+within the row count thresholds, which catches points dropped by the SELECT
+INTO merge of the incremental backups. Backups taken before the stats manifest
+existed are restored without being verified.
+
+PostgreSQL
+----------
+
+Each postgres backup directory (postgres-data/2020-05-01_18-45-34/) holds one
+tarball per database, <db>.tar.gz.gpg, with a directory-format dump of the
+database (pg_dump -Fd) in <db>/ and the row count of each of its tables in
+<db>.stats ("schema.table rows" lines). --download only downloads the encrypted
+tarballs: --restore decrypts and extracts each of them in one pass, gpg piped
+into tar, so the decrypted tarball is never written to disk, then recreates the
+database and loads the dump with pg_restore --jobs JOBS (the number of CPUs by
+default). --verify counts the rows of the tables, JOBS tables at a time, and
+compares them with <db>.stats. The server and credentials are taken from the
+usual libpq environment variables (PGHOST, PGPORT, PGUSER, PGPASSWORD), so a
+local postgres works without any setup.
+
+Elasticsearch
+-------------
+
+Each elasticsearch backup directory (elasticsearch-data/2020-05-01_18-45-34/)
+holds one tarball per index, <index>.tar.gz.gpg, with the settings and mappings
+of the index in <index>/index.json, its documents in <index>/*.ndjson in the
+bulk API format (an action line followed by the document), and the document
+count of the index in <index>.stats ("index count" lines). Like postgres, the
+tarballs are only decrypted by --restore, which reads each one as a stream:
+the index is recreated with refresh and replicas disabled, the documents are
+sent in bulk requests of --bulk-size bytes (5 MiB by default) by --jobs
+workers, with exponential backoff on the requests and documents rejected with
+429 Too Many Requests, and the refresh interval and the number of replicas are
+restored and the index refreshed after the load, even if it fails. Memory use
+is bounded by the bulk requests in flight.
+
+A backup directory can hold a snapshot export instead: snapshot.tar.gz.gpg,
+with an fs snapshot repository in snapshot/ and the document counts in
+snapshot.stats. It is extracted in the backup directory, registered as a
+snapshot repository (the backup directory must be in path.repo of the
+cluster), and the indices of its last snapshot are restored from it.
+
+--verify compares the document count of each index with the stats. The cluster
+is ELASTICSEARCH_URL (http://127.0.0.1:9200 by default), with the credentials
+in ELASTICSEARCH_USERNAME and ELASTICSEARCH_PASSWORD if it needs them, so a
+local single node works without any setup.
+
+Vault
+-----
+
+Each vault backup directory (vault-data/2020-05-01_18-45-34/) holds the
+encrypted raft snapshot of the cluster, raft.snap.gpg, and kv-metadata.json.gpg,
+the current version of the KV secrets at the time of the snapshot
+({"mount": "secret", "versions": {"path": version}}). --restore streams the
+snapshot from gpg straight into the sys/storage/raft/snapshot-force endpoint in
+a chunked request, so neither the decrypted snapshot nor a temporary file is
+ever written, and memory use does not grow with the size of the snapshot.
+--verify waits for the cluster to be healthy again, then compares the current
+version of a random sample of VAULT_VERIFY_SAMPLE (50) secrets with the
+metadata. The cluster is VAULT_ADDR, trusted with the CA in VAULT_CACERT,
+with VAULT_TOKEN (a token that is valid in the snapshot, since the restore
+replaces the token store too).
+
+Coordinated cassandra restore
+-----------------------------
+
+'restore coordinate cassandra --inventory nodes.json' restores a whole ring:
+the inventory is a JSON list of the nodes, [{"host": "cass1", "rack": "rack1"},
+...], and --node-command is the command running restore.py on a node ('ssh
+{host} restore.py {args}' by default; {host} and {rack} are replaced by those
+of the node, and {args} by the arguments of the phase). The phases run on all
+the nodes in parallel, one phase after the other, with at most
+--rack-concurrency nodes of a rack (1 by default) running a phase at a time:
+
+- download on every node,
+- restore-keyspaces on the first node of the inventory, which applies the
+  schemas, then on the other nodes with --no-schema, which only extracts the
+  tarballs,
+- restore and refresh on every node,
+- verify on the first node, and cleanup on the other nodes.
+
+The coordinator stops after the first phase a node fails, logs the progress
+of each phase, and writes the result and duration of each phase on each node
+to --coordinate-report (coordinate-report.json by default). --keyspace,
+--table, --debug and --verbose are passed on to the nodes. For a local
+simulation, a --node-command running restore.py with a data directory per
+{host} is enough.
+
+Scrubbing backups
+-----------------
+
+'restore scrub cassandra' checks that recent backups (from the last
+--since-days days, 7 by default) would restore, without writing to disk: each
+encrypted tarball is streamed from storage through gpg, its decompressor and a
+streaming tar reader. The encrypted bytes are checked against the checksum
+stored with the object when there is one (see Download checksums), gpg must
+decrypt and authenticate the whole stream, and the compressed stream and the
+tar structure must be intact to the last byte. Encrypted objects that are not
+tarballs are decrypted and authenticated. --concurrency objects are scrubbed in
+parallel, reading at most --bandwidth MB/s in total. The health of each object
+is written to --scrub-report (scrub-report.json by default), and the scrub
+fails if any object is bad. Meant to run nightly.
+
+Backups
+-------
+
+'restore backup cassandra|zinfluxdb' produces the backups the restore reads,
+in the same layout. The tarballs are never staged on disk: tar is piped into
+gpg (encrypting for the key of GPG_RECIPIENT), and the encrypted stream is cut
+into parts of UPLOAD_PART_SIZE (64 MiB, override with BACKUP_PART_SIZE) that
+are uploaded while the next ones are read, --concurrency at a time: the parts
+of a multipart upload on S3, the blocks of a block blob on Azure (committed with
+the Content-MD5 of the whole blob, see Download checksums), positioned writes to
+a temporary file renamed into place on the filesystem backend. An upload is
+only completed once tar and gpg have succeeded, and aborted otherwise. The
+tarballs are compressed with --codec (gz by default, see Compression codecs).
+
+- cassandra: the selected keyspaces (--keyspace, --table) are snapshotted with
+  nodetool snapshot -t backup-<timestamp>, and each of them is uploaded to
+  cassandra-data/<timestamp>/<keyspace>.tar.gz.gpg, with schema-<keyspace>.cql
+  (from the driver metadata), <keyspace>.stats (the rows of its tables, counted
+  --jobs tables at a time) and the snapshot of each table. The snapshot is
+  cleared afterwards.
+- influxdb: influxd backup -portable takes a full backup on Sundays (or when no
+  earlier backup is found) and an incremental one since the end of the last
+  backup otherwise, up to the time of the backup. zinfluxdb.stats.json is
+  written next to it with the same shard group queries as --verify, bounded by
+  the same end time, and the directory is uploaded to
+  zinfluxdb-data/<timestamp>-full.tar.gz.gpg (or -inc). The portable backup
+  itself is staged in the backup directory, since influxd writes it to a
+  directory, and removed once uploaded.
+
+Pruning backups
+---------------
+
+'restore prune cassandra' deletes the backups that the retention policy does
+not keep: the last backup of each of the last --keep-daily days (7 by
+default) and of each of the last --keep-weekly weeks (4 by default), and the
+last backup whatever its age. A backup is a backup directory
+(cassandra-data/2020-05-01_18-45-34/), or for influxdb a tarball along with
+the rest of its chain, as the restore reads them: keeping an incremental
+influxdb backup keeps the full backup and the incremental ones before it, so
+a chain is never broken. Objects that are not part of a backup are left
+alone. After a deduplicated cassandra backup, the SSTable files in
+cassandra-cas/ that no manifest kept refers to are deleted too, unless they
+are younger than a day (a backup in progress uploads its manifest last).
+Since a backup in progress may also reuse older files, it uploads a
+manifest.pending marker next to its manifest before it lists the files
+stored, and deletes it after the manifest: no SSTable file is pruned while a
+marker younger than a day exists, and the markers of failed backups are
+deleted.
+
+Deletes are batched, 1000 keys per DeleteObjects request on S3 and 256 per
+blob batch request on Azure, and --concurrency batches are sent at a time.
+--dry-run only reports what would be deleted, and --verbose logs each backup
+kept or pruned.
+
+Compression codecs
+------------------
+
+Tarballs are compressed with gzip (.tar.gz.gpg), zstd (.tar.zst.gpg) or lz4
+(.tar.lz4.gpg), told apart by their suffix, and the codecs can be mixed within a
+backup set or an influxdb backup chain. tar is given the decompressor with -I,
+in order of preference: pigz or gzip, pzstd or zstd, lz4. pzstd decompresses
+the independent frames it writes with --jobs threads, where gzip tops out at
+about 100 MB/s per tarball; zstd decompresses in one thread, still several
+times faster than gzip, and lz4 is faster again at a lower compression ratio.
+The streaming readers (the elasticsearch loader, the scrubber) pipe gpg into
+the same decompressors. 'restore_bench.py --suites codecs' compares the codecs
+on a synthetic backup of the shape of ours.
+
+Streaming cassandra restore
+---------------------------
+
+--restore copies the SSTables into the table directories of the node, which
+only works on a node with the table directories (table ids) and the token
+ranges of the node backed up, followed by --refresh and its full repair. For a
+migration, or a disaster recovery to a cluster of another size, --restore
+--sstableloader HOSTS streams each table to the cluster of HOSTS instead, and
+the cluster sends each row to the replicas that own it, whatever its topology;
+no refresh or repair is needed. Apply the schemas with --restore-keyspaces
+first, as usual.
+
+The snapshot files of each selected table are hard linked into
+sstableloader/<keyspace>/<table>/ in the working directory, the layout
+sstableloader expects, and --jobs tables are streamed at a time, each loader
+throttled to --loader-throttle Mbit/s if given. A table that fails is streamed
+again after LOADER_BACKOFF_SECONDS (30), doubled on each of LOADER_RETRIES (3)
+retries. Each table streamed is recorded in LOADED in the working directory,
+and skipped when the restore is run again, so a failed restore resumes with
+the tables left; streaming a table twice is harmless, the rows are the same.
+The credentials are CASSANDRA_USERNAME and CASSANDRA_PASSWORD, as for cqlsh.
+
+Deduplicated cassandra backups
+------------------------------
+
+SSTable files never change once written, so most of them are the same from
+one backup to the next. With --dedup, a cassandra backup uploads each SSTable
+file once, encrypted, to cassandra-cas/<sha256[:2]>/<sha256>.gpg, named by the
+SHA-256 of its content (hashed --jobs files at a time), and only the files not
+stored yet. Instead of tarballs, cassandra-data/<timestamp>/ then holds
+manifest.json.gpg, uploaded last: the schema and stats of each keyspace, and the
+path, SHA-256 and size of each of its files.
+
+--show-last and --download read the manifest of the last backup and download
+the SSTable files of the selected tables that are not in the cache
+(cassandra-cas in the data directory), found with one listing of
+cassandra-cas/ and downloaded and decrypted --concurrency at a time.
+--restore-keyspaces lays the backup out as the tarballs would be extracted:
+each downloaded file is checked against its SHA-256 and moved to the cache,
+and linked from there into the snapshot directories. The cache keeps the files
+of the last backup restored, so the next restore only downloads the files that
+changed.
+
+Selective restore
+-----------------
+
+By default the whole backup set is restored. --keyspace and --table (cassandra)
+and --database (influxdb) restrict the restore to what is asked for, and can be
+repeated. Pass the same filters to each step of the restore:
+
+- cassandra: only the tarballs of the selected keyspaces are downloaded, only
+  the selected tables are extracted from them, only the schemas of the selected
+  keyspaces are applied, and only the SSTables and row counts of the selected
+  tables are restored and verified. The system_schema tables are not restored
+  from the backup, since they would replace the schema of every keyspace.
+- influxdb: every tarball holds all databases, so all of them are downloaded,
+  but only the shards of the selected databases are extracted, restored and
+  merged, and only the selected databases are dropped beforehand.
+- postgres: only the tarballs of the selected databases are downloaded,
+  restored and verified.
+- elasticsearch: --index selects indices; only their tarballs are downloaded
+  (a snapshot export is always downloaded, and only the selected indices are
+  restored from it).
+
+Storage backends
+----------------
+
+The storage backend is chosen from the environment: AWS_VARS for S3,
+AZURE_VARS for Azure blob storage, or FS_VARS (BACKUP_DIR_PATH) for backups kept
+on a local filesystem or an NFS mount, laid out like the bucket
+(BACKUP_DIR_PATH/cassandra-data/2020-05-01_18-45-34/...). The filesystem
+backend lists with os.scandir and downloads without going through user space:
+tarballs are hard linked when the backup directory is on the same filesystem as
+the data directory, and copied with copy_file_range (or sendfile) otherwise.
+
+External commands
+-----------------
+
+tar, influxd, cqlsh, nodetool, pg_restore and the node commands of coordinate
+run under a supervisor with an event loop of its own, which any thread can
+hand commands to: at most --jobs of them run at a time (the cassandra tarballs
+are extracted concurrently), and their standard output and error are logged
+line by line as they come (at the info and warning levels), with the last
+lines logged again if the command fails. A command that runs longer than its
+timeout, COMMAND_TIMEOUTS by program (12 hours for nodetool, an hour for
+cqlsh) or --command-timeout for all of them, is sent SIGTERM, then SIGKILL
+COMMAND_KILL_GRACE (30) seconds later, so a hung nodetool repair fails the
+restore instead of blocking it. The duration and exit status of each command
+are recorded in the metrics.
+
+Dependencies
+------------
+
+Only the client library of the storage backend in use is imported: boto3 for
+AWS, azure-storage-blob for Azure. Likewise, only the client of the datatype
+being restored is imported (influxdb, cassandra-driver or psycopg2), and
+python-gnupg only when decrypting.
+
+Listing
+-------
+
+Backup prefixes hold thousands of objects, and a single paginated listing
+fetches them 1000 keys at a time, one request after the other. Instead, the
+sub-prefixes directly under the datatype prefix (the date-stamped backup
+directories, cassandra-data/2020-05-01_18-45-34/) are discovered with a
+delimiter listing, and listed concurrently (--concurrency at a time) before
+being merged into the list of backups.
+
+Asynchronous storage
+--------------------
+
+With --async-io, listings and downloads go through asyncio implementations of
+the storage backends (aiobotocore for AWS, azure.storage.blob.aio for Azure).
+Listings of several prefixes are paginated concurrently, and the tarballs are
+streamed to disk concurrently, up to --concurrency requests at a time, over one
+connection pool and without a thread per object. The synchronous client API
+(download_last_backup and friends) is unchanged and runs the event loop itself.
+
+Download checksums
+------------------
+
+Downloads are checked against the checksum stored with each object while the
+bytes are written, without reading the file again. On S3, objects uploaded in
+parts are downloaded part by part in parallel (--concurrency parts at a time),
+each part hashed as it is written at its offset, and the MD5 of the part MD5s
+compared with the multipart ETag; objects uploaded in one part are streamed and
+compared with their MD5 ETag. A part that fails, comes back short or does not
+match the checksum S3 keeps for it (objects uploaded with additional
+checksums) is downloaded again on its own; if the ETag does not match, the
+object is downloaded again, up to DOWNLOAD_RETRIES times. The ETag of objects
+encrypted with SSE-KMS or SSE-C is not an MD5, so they are not checked. On
+Azure, each range is validated with its transactional MD5 (validate_content),
+and the blob with its Content-MD5 when it has one. The filesystem backend
+keeps no checksums. The scrubber uses the same checksums.
+
 Download directory
 ------------------
 
@@ -55,6 +435,66 @@ of the database. For example, cassandra backup tarballs are downloaded to
 cassandra-data directory in /var/lib/cassandra. The influxdb backup tarballs are
 downloaded to zinfluxdb-data in /var/lib/influxdb.
 
+Library API
+-----------
+
+RestoreSession(datatype, backend, workdir) restores one datatype without
+argparse: it holds one storage client and its listing and one database client
+(influxdb client, cassandra cluster), and downloads to and extracts in workdir
+with absolute paths instead of changing the current directory of the process.
+Sessions are independent, so an orchestrator can drive several restores
+concurrently in one process:
+
+    with RestoreSession('zinfluxdb', 'aws', '/data/influx-restore') as influx, \
+            RestoreSession('cassandra', 'aws', '/data/cass-restore') as cass:
+        with ThreadPoolExecutor() as pool:
+            pool.submit(lambda: influx.download() and influx.restore())
+            pool.submit(lambda: cass.download() and cass.restore_keyspaces()
+                        and cass.restore())
+
+Restore plan
+------------
+
+Before downloading, --plan uses the sizes in the backup listing to estimate how
+much space the restore needs: the encrypted tarballs, the decrypted tarballs
+(about the same size) and the extracted data (EXTRACT_RATIO times the tarball
+size, override with RESTORE_EXTRACT_RATIO). Both the backup directory and the
+data directory are checked for free space, and the script exits with an error
+if either is too small. --download, --restore-keyspaces and --restore run the
+same check for the space their step needs before they write anything: the
+extracted data in the backup directory for the step that extracts the
+tarballs (--restore-keyspaces for cassandra, --restore otherwise), and in the
+data directory for --restore. Each restore records the throughput of its
+download, decrypt, extract and copy phases in restore-history.json in the data
+directory; the plan uses that history to estimate how long the restore will
+take.
+
+Metrics
+-------
+
+Every run collects metrics for the phases it runs: bytes and seconds for each
+downloaded, decrypted and extracted tarball and each copied table, the latency
+of each verify query and the deviation of restored rows from the expected rows
+of each table. With --metrics-file (or RESTORE_METRICS_FILE) they are written
+in the Prometheus text format, for the node exporter textfile collector, and
+with --metrics-json as a JSON summary. The file is replaced atomically, so the
+collector never reads a partial file.
+
+Profiling
+---------
+
+With --profile, each phase of the restore (setup and listing, download,
+decrypt, extracting and restoring, refresh, verify, cleanup) and the datasource
+and storage methods it calls are timed by wall clock and CPU time. Add
+--profile-cprofile to run the top level phases under cProfile and report their
+hottest functions, and --profile-memory to trace allocations with tracemalloc
+and report the peak memory and the biggest allocation sites of each phase.
+Only the phases of the main thread are profiled that way: the phases run by
+worker threads (the download and upload pools, sessions run in threads) are
+timed as nested in the main phase running at the time. The
+report, ranked by wall clock time, is written to --profile-report
+(restore-profile.txt by default).
+
 """
 
 from abc import ABC
@@ -67,28 +507,47 @@ import logging
 import pathlib
 import shutil
 import subprocess
+import json
+import time
+import threading
+import functools
+import contextlib
+import cProfile
+import pstats
+import io
+import tracemalloc
+import asyncio
+import hashlib
+import tarfile
+import tempfile
+import base64
+import http.client
+import urllib.parse
+import ssl
+import random
+import shlex
+import signal
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import gnupg
-import urllib3
-import boto3
-from azure.storage.blob import BlobServiceClient
-
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
-from cassandra.cluster import Cluster # pylint: disable=no-name-in-module
-from cassandra.auth import PlainTextAuthProvider
-from cassandra.policies import DCAwareRoundRobinPolicy
-from cassandra import OperationTimedOut, ReadFailure
-
-from botocore.exceptions import ClientError
+# The storage backend (boto3, azure), database client (influxdb, cassandra) and
+# gnupg modules are imported where they are used, so that each run only loads
+# the backend and datasource it needs, and --help or --show-last do not pay for
+# the others.
+# pylint: disable=import-outside-toplevel
 
 ZINFLUXDB = 'zinfluxdb'
 CASSANDRA = 'cassandra'
-SUPPORTED_DBS = [CASSANDRA, ZINFLUXDB]
+POSTGRES = 'postgres'
+ELASTICSEARCH = 'elasticsearch'
+VAULT = 'vault'
+SUPPORTED_DBS = [CASSANDRA, ZINFLUXDB, POSTGRES, ELASTICSEARCH, VAULT]
 
 AWS_VARS = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'S3_BACKUP_BUCKET']
 AZURE_VARS = ['AZURE_BLOB_BACKUP_CONTAINER', 'AZURE_STORAGE_CONNECTION_STRING']
+FS_VARS = ['BACKUP_DIR_PATH']
+BACKENDS = ['aws', 'azure', 'fs']
 
 # If the rows restored are more than this much percentage off, we flag an error
 # Some tables, like gangesdb_app_inst_flow_dns_cf have high rate of volatility,
@@ -96,17 +555,243 @@ AZURE_VARS = ['AZURE_BLOB_BACKUP_CONTAINER', 'AZURE_STORAGE_CONNECTION_STRING']
 HIGH_ERROR_THRESHOLD = 0.40     # 40%
 LOW_ERROR_THRESHOLD = 0.05      # 5%
 
+# Extracted data is roughly this many times the size of the gzipped tarball
+EXTRACT_RATIO = float(os.environ.get('RESTORE_EXTRACT_RATIO', '3.0'))
 
-def execute_cmd(cmd):
-    """Helper function to execute a command; returns True if successful, False
-       otherwise."""
-    try:
-        proc = subprocess.run(cmd, check=True)
-        logging.debug(proc)
-    except subprocess.CalledProcessError as error:
-        logging.error('Failed to run %s: %s', ' '.join(cmd), error)
-        return False
-    return True
+# Compression codecs of the tarballs (.tar.<codec>.gpg): the programs tar
+# compresses and decompresses them with (tar -I, which adds -d to
+# decompress), in order of preference. pzstd writes independent frames and
+# decompresses them in parallel; zstd only compresses with several threads.
+CODECS = {
+    'gz': (['pigz -p {jobs}', 'gzip'], ['pigz -p {jobs}', 'gzip']),
+    'zst': (['pzstd -p {jobs}', 'zstd -T{jobs}'], ['pzstd -p {jobs}', 'zstd']),
+    'lz4': (['lz4'], ['lz4']),
+}
+BACKUP_CODEC = 'gz'
+
+# Throughput history kept in the data directory, used to estimate restore time
+HISTORY_FILE = 'restore-history.json'
+HISTORY_SAMPLES = 20
+RESTORE_PHASES = ['download', 'decrypt', 'extract', 'copy']
+
+# Concurrent requests and read size of the asyncio storage backends
+DOWNLOAD_CONCURRENCY = 16
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Parallel jobs of the postgres and elasticsearch restores
+RESTORE_JOBS = os.cpu_count() or 4
+
+# Elasticsearch bulk requests: size, and retries of the documents rejected with
+# 429 Too Many Requests with exponential backoff
+ES_BULK_BYTES = 5 * 1024 * 1024
+ES_BULK_RETRIES = 8
+ES_BACKOFF_SECONDS = 1
+ES_BACKOFF_MAX_SECONDS = 60
+
+# Retries of a table that sstableloader failed to stream, with exponential
+# backoff
+LOADER_RETRIES = 3
+LOADER_BACKOFF_SECONDS = 30
+
+# Command running restore.py on a node of a coordinated restore
+NODE_COMMAND = 'ssh {host} restore.py {args}'
+
+# Secrets whose KV metadata version is checked after a vault restore, and how
+# long to wait for vault to be healthy after the restore
+VAULT_VERIFY_SAMPLE = int(os.environ.get('VAULT_VERIFY_SAMPLE', '50'))
+VAULT_READY_TIMEOUT = 120
+
+# Attempts at downloading an object, or a part of it, that fails or does not
+# match its checksum
+DOWNLOAD_RETRIES = 3
+
+# Backups: size of the parts of multipart (S3) and block (Azure) uploads; at
+# most --concurrency parts are held in memory at a time
+UPLOAD_PART_SIZE = int(
+    os.environ.get('BACKUP_PART_SIZE', str(64 * 1024 * 1024)))
+BACKUP_DATATYPES = [CASSANDRA, ZINFLUXDB]
+
+# Subcommands; without one, the script restores
+COMMANDS = ['scrub', 'coordinate', 'backup', 'prune']
+SCRUB_SINCE_DAYS = 7
+# Retention of prune: the last backup set of as many days and weeks
+PRUNE_KEEP_DAILY = 7
+PRUNE_KEEP_WEEKLY = 4
+# Seconds an external command may run before it is killed, by program (the
+# others run as long as they need); --command-timeout applies to all of them
+COMMAND_TIMEOUTS = {
+    'nodetool': 12 * 3600,
+    'cqlsh': 3600,
+    'sstableloader': 12 * 3600,
+}
+# Seconds between SIGTERM and SIGKILL of a command that timed out
+COMMAND_KILL_GRACE = 30
+# Lines of output of a failed command logged with the error
+COMMAND_TAIL_LINES = 20
+COMMAND_LINE_LIMIT = 1024 * 1024
+
+# Unreferenced SSTable files younger than this may belong to a deduplicated
+# backup in progress, whose manifest is uploaded last; neither are any pruned
+# while the pending marker of such a backup is younger than this
+PRUNE_GRACE_SECONDS = 86400
+
+METRIC_HELP = {
+    'restore_phase_bytes': 'Bytes processed by a restore phase',
+    'restore_phase_seconds': 'Seconds spent in a restore phase',
+    'restore_scrub_ok': 'Whether a scrubbed object passed all the checks',
+    'restore_verify_query_seconds': 'Latency of the verify query of a table',
+    'restore_verify_expected_rows': 'Rows expected in a table',
+    'restore_verify_actual_rows': 'Rows restored in a table',
+    'restore_verify_row_deviation_ratio':
+    'Relative deviation of restored rows from expected rows',
+    'restore_duration_seconds': 'Duration of the restore action',
+    'restore_success': 'Whether the restore action succeeded',
+    'restore_last_run_timestamp_seconds': 'Time the restore action finished',
+    'restore_node_phase_seconds': 'Seconds a node spent in a restore phase',
+    'restore_node_phase_success': 'Whether a node completed a restore phase',
+    'restore_command_seconds': 'Seconds an external command ran',
+    'restore_command_exit_status':
+    'Exit status of an external command, negative if it was killed',
+    'prune_deleted_objects': 'Objects deleted by prune',
+    'prune_deleted_bytes': 'Bytes deleted by prune',
+}
+
+
+class CommandSupervisor:
+    """ Runs external commands on an event loop of its own, at most
+        concurrency of them at a time, from any thread: their output is
+        logged line by line as it comes, and they are terminated, then killed,
+        when they outlive their timeout """
+    def __init__(self, concurrency=RESTORE_JOBS, timeout=None):
+        self.concurrency = concurrency
+        # Timeout of every command, instead of COMMAND_TIMEOUTS
+        self.timeout = timeout
+        self.loop = None
+        self.slots = None
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def _start(self):
+        """ Start the event loop thread if needed; returns the number of the
+            next command """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever,
+                                 name='command-supervisor',
+                                 daemon=True).start()
+            self.runs += 1
+            return self.runs
+
+    @staticmethod
+    async def _stream(reader, name, level, tail):
+        """ Log each line read from reader, and keep the last ones in tail """
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Longer than COMMAND_LINE_LIMIT, dropped by the reader
+                continue
+            if not line:
+                return
+            text = line.decode(errors='replace').rstrip()
+            tail.append(text)
+            logging.log(level, '%s: %s', name, text)
+
+    async def _kill(self, proc):
+        """ Terminate proc, and kill it if it is still running after
+            COMMAND_KILL_GRACE seconds; returns its exit status """
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            with contextlib.suppress(ProcessLookupError):
+                proc.send_signal(sig)
+            try:
+                return await asyncio.wait_for(proc.wait(), COMMAND_KILL_GRACE)
+            except asyncio.TimeoutError:
+                continue
+        return await proc.wait()
+
+    async def run(self, cmd, timeout=None, name=None, number=0):
+        """ Run cmd once fewer than concurrency commands are running; returns
+            its exit status, negative if it was killed by a signal """
+        # Created on the loop it is used on
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        program = os.path.basename(cmd[0])
+        name = name or program
+        timeout = timeout or self.timeout or COMMAND_TIMEOUTS.get(program)
+        tail = collections.deque(maxlen=COMMAND_TAIL_LINES)
+        async with self.slots:
+            start = time.monotonic()
+            try:
+                # Not in a process group of its own, so that an interrupt
+                # of the terminal still reaches it
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=COMMAND_LINE_LIMIT)
+            except OSError as error:
+                logging.error('Failed to run %s: %s', ' '.join(cmd), error)
+                return 127
+            readers = asyncio.gather(
+                self._stream(proc.stdout, name, logging.INFO, tail),
+                self._stream(proc.stderr, name, logging.WARNING, tail))
+            try:
+                returncode = await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.error('%s timed out after %s, terminating it', name,
+                              human_duration(timeout))
+                returncode = await self._kill(proc)
+            # The output may be held open by a child the command left behind
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(readers, COMMAND_KILL_GRACE)
+            seconds = time.monotonic() - start
+        METRICS.add('restore_command_seconds',
+                    seconds,
+                    program=program,
+                    run=number)
+        METRICS.add('restore_command_exit_status',
+                    returncode,
+                    program=program,
+                    run=number)
+        if returncode:
+            logging.error('Failed to run %s: exit status %d after %s%s',
+                          ' '.join(cmd), returncode, human_duration(seconds),
+                          ''.join('\n' + line for line in tail))
+        else:
+            logging.debug('%s done in %s', name, human_duration(seconds))
+        return returncode
+
+    def submit(self, cmd, timeout=None, name=None):
+        """ Run cmd on the event loop (see run); returns a Future of its exit
+            status. name prefixes its output in the log, the program name by
+            default. """
+        number = self._start()
+        return asyncio.run_coroutine_threadsafe(
+            self.run(cmd, timeout, name, number), self.loop)
+
+    def run_all(self, cmds, timeout=None):
+        """ Run cmds concurrently; returns their exit statuses in order """
+        futures = [self.submit(cmd, timeout) for cmd in cmds]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """ Stop the event loop thread """
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop = None
+                self.slots = None
+
+
+SUPERVISOR = CommandSupervisor()
+
+
+def execute_cmd(cmd, timeout=None):
+    """Helper function to execute a command under the SUPERVISOR; returns True
+       if successful, False otherwise."""
+    return SUPERVISOR.submit(cmd, timeout).result() == 0
 
 
 def row_count_ok(table_name, expected, actual):
@@ -122,61 +807,876 @@ def row_count_ok(table_name, expected, actual):
     return True
 
 
+def human_size(nbytes):
+    """ Format a byte count for humans """
+    size = float(nbytes)
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if size < 1024 or unit == 'TiB':
+            break
+        size /= 1024
+    return '{:.1f} {}'.format(size, unit)
+
+
+def human_duration(seconds):
+    """ Format a duration in seconds for humans """
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    return '{}m{:02d}s'.format(minutes, secs)
+
+
+def file_sha256(path):
+    """ Return the hex SHA-256 of the content of the file at path """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as sfh:
+        for chunk in iter(lambda: sfh.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def copy_file(src, dest):
+    """ Copy src to dest in the kernel: hard link it if both are on the same
+        filesystem, otherwise copy_file_range or sendfile. Returns the method
+        used. """
+    if os.path.exists(dest):
+        os.unlink(dest)
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dest) or '.').st_dev:
+        try:
+            os.link(src, dest)
+            return 'link'
+        except OSError as error:
+            logging.debug('Unable to link %s: %s', src, error)
+
+    with open(src, 'rb') as sfh, open(dest, 'wb') as dfh:
+        remaining = os.fstat(sfh.fileno()).st_size
+        for method in ['copy_file_range', 'sendfile']:
+            if not hasattr(os, method):
+                continue
+            try:
+                while remaining > 0:
+                    if method == 'copy_file_range':
+                        copied = os.copy_file_range(sfh.fileno(), dfh.fileno(),
+                                                    remaining)
+                    else:
+                        copied = os.sendfile(dfh.fileno(), sfh.fileno(), None,
+                                             remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return method
+            except OSError as error:
+                # Not supported between these filesystems; the file offsets
+                # tell the next method where to carry on from
+                logging.debug('%s %s failed: %s', method, src, error)
+        shutil.copyfileobj(sfh, dfh)
+    return 'copy'
+
+
+class RateLimiter:
+    """ Token bucket limiting the bytes per second read by several
+        threads together; a rate of None means unlimited """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ Wait until nbytes can be read within the rate """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance +
+                                 (now - self.last) * self.rate) - nbytes
+            self.last = now
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ChecksumError(Exception):
+    """ Downloaded bytes do not match the checksum of the object """
+
+
+def multipart_etag(digests):
+    """ ETag of an object uploaded to S3 in parts with these MD5 digests """
+    return '{}-{}'.format(
+        hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+class ObjectChecksum:
+    """ Checksum of an object computed from its bytes in order, to compare
+        with the checksum stored with it: the MD5 ETag of S3 objects uploaded
+        in one part, the multipart ETag of the others (part_size is the size
+        of their parts), or the Content-MD5 of Azure blobs. expected is None
+        when the object has no usable checksum. """
+    def __init__(self, expected=None, part_size=None):
+        self.expected = expected
+        self.part_size = part_size
+        self.md5 = hashlib.md5()
+        self.filled = 0
+        self.digests = []
+
+    def update(self, data):
+        """ Hash data, the next bytes of the object """
+        if not self.part_size:
+            self.md5.update(data)
+            return
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self.part_size - self.filled)
+            self.md5.update(view[:size])
+            self.filled += size
+            view = view[size:]
+            if self.filled == self.part_size:
+                self.digests.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.filled = 0
+
+    def hexdigest(self):
+        """ Checksum of the bytes so far, in the format of expected """
+        if not self.part_size:
+            return self.md5.hexdigest()
+        return multipart_etag(self.digests +
+                              ([self.md5.digest()] if self.filled else []))
+
+    @property
+    def status(self):
+        """ 'ok', 'mismatch', or 'unavailable' without an expected checksum """
+        if self.expected is None:
+            return 'unavailable'
+        return 'ok' if self.hexdigest() == self.expected else 'mismatch'
+
+
+def s3_checksum(head):
+    """ ObjectChecksum of an S3 object from the head_object response of its
+        first part """
+    if head.get('ServerSideEncryption', '').startswith('aws:kms') or \
+            head.get('SSECustomerAlgorithm'):
+        # The ETag of encrypted objects is not an MD5
+        return ObjectChecksum()
+    etag = head['ETag'].strip('"')
+    if '-' in etag:
+        return ObjectChecksum(etag, head['ContentLength'])
+    return ObjectChecksum(etag)
+
+
+def azure_checksum(properties):
+    """ ObjectChecksum of an Azure blob from its properties """
+    md5 = properties.content_settings.content_md5
+    return ObjectChecksum(bytes(md5).hex() if md5 else None)
+
+
+def tarball_codec(name):
+    """ Return the codec of the tarball name, encrypted or not, None if it is
+        not a tarball """
+    if name.endswith('.gpg'):
+        name = name[:-len('.gpg')]
+    for codec in CODECS:
+        if name.endswith('.tar.' + codec):
+            return codec
+    return None
+
+
+def tarball_name(name):
+    """ Return the tarball name without its .tar.<codec>[.gpg] suffix """
+    codec = tarball_codec(name)
+    if name.endswith('.gpg'):
+        name = name[:-len('.gpg')]
+    return name[:-len('.tar.' + codec)] if codec else name
+
+
+def codec_program(codec, decompress=False):
+    """ Return the program compressing (or decompressing) codec, for tar -I:
+        the first one installed """
+    programs = CODECS[codec][1 if decompress else 0]
+    for program in programs:
+        if shutil.which(program.split()[0]):
+            break
+    return program.format(jobs=RESTORE_JOBS)
+
+
+def tar_codec_args(name, decompress=True):
+    """ tar arguments (de)compressing the tarball name with its codec """
+    return ['-I', codec_program(tarball_codec(name) or BACKUP_CODEC,
+                                decompress)]
+
+
+def spawn(cmd, **kwargs):
+    """ Start cmd with its standard error in an anonymous temporary file,
+        read by process_errors: a stderr pipe that is only read once the
+        other pipes are done blocks the command when it fills up """
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stderr=errors, **kwargs)
+    proc.errors = errors
+    return proc
+
+
+def process_errors(proc):
+    """ Wait for proc, started by spawn, and return its standard error """
+    proc.wait()
+    proc.errors.seek(0)
+    stderr = proc.errors.read().decode(errors='replace').strip()
+    proc.errors.close()
+    return stderr
+
+
+def decompress_process(codec, stdin):
+    """ Start the decompressor of codec reading stdin, to its stdout """
+    return spawn(shlex.split(codec_program(codec, True)) + ['-d'],
+                 stdin=stdin,
+                 stdout=subprocess.PIPE)
+
+
+def gnupg_home():
+    """ GPG home directory holding the backup decryption key """
+    return os.path.join(os.getenv('HOME'), '.gnupg')
+
+
+def gpg_decrypt_process(stdin=subprocess.PIPE):
+    """ Start gpg decrypting stdin to its stdout, with the passphrase in
+        GPG_PASSPHRASE; returns None if there is no passphrase """
+    passphrase = os.getenv('GPG_PASSPHRASE')
+    if not passphrase:
+        logging.error('No key found in GPG_PASSPHRASE')
+        return None
+    # The passphrase goes through a pipe, not the command line
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, 'w') as pfh:
+        pfh.write(passphrase)
+    try:
+        return spawn([
+            'gpg', '--batch', '--quiet', '--homedir',
+            gnupg_home(), '--pinentry-mode', 'loopback', '--passphrase-fd',
+            str(read_fd), '--decrypt'
+        ],
+                     stdin=stdin,
+                     stdout=subprocess.PIPE,
+                     pass_fds=(read_fd, ))
+    finally:
+        os.close(read_fd)
+
+
+def extract_encrypted(etarball, dest):
+    """ Decrypt and extract the encrypted tarball into dest in one pass,
+        without writing the decrypted tarball """
+    with open(etarball, 'rb') as efh:
+        gpg = gpg_decrypt_process(stdin=efh)
+    if gpg is None:
+        return False
+    cmd = ['tar', 'xf', '-', '-C', dest] + tar_codec_args(
+        os.fspath(etarball))
+    logging.info(cmd)
+    tar = subprocess.Popen(cmd, stdin=gpg.stdout)
+    # tar holds the read end of the pipe now; gpg gets SIGPIPE if tar exits
+    # early
+    gpg.stdout.close()
+    tar.wait()
+    stderr = process_errors(gpg)
+    if gpg.returncode != 0:
+        logging.error('Failed to decrypt %s: %s', etarball, stderr)
+        return False
+    if tar.returncode != 0:
+        logging.error('Failed to extract %s', etarball)
+        return False
+    return True
+
+
+def gpg_encrypt_process(stdin):
+    """ Start gpg encrypting stdin to its stdout for the key of
+        GPG_RECIPIENT; returns None if there is no recipient """
+    recipient = os.getenv('GPG_RECIPIENT')
+    if not recipient:
+        logging.error('No key found in GPG_RECIPIENT')
+        return None
+    return spawn([
+        'gpg', '--batch', '--quiet', '--homedir',
+        gnupg_home(), '--trust-model', 'always', '--recipient', recipient,
+        '--encrypt'
+    ],
+                 stdin=stdin,
+                 stdout=subprocess.PIPE)
+
+
+class EncryptedStream:
+    """ source (a file object) encrypted as it is read: gpg reads source,
+        and the stream is read from the stdout of gpg. producer is the
+        process writing source, if any. read() it to the end, then wait()
+        for gpg and the producer to succeed before using what was read. """
+    def __init__(self, source, producer=None):
+        self.producer = producer
+        self.gpg = gpg_encrypt_process(source)
+
+    def read(self, size=-1):
+        """ Read up to size bytes of the encrypted stream """
+        return self.gpg.stdout.read(size)
+
+    def wait(self):
+        """ Wait for gpg and the producer; returns whether both succeeded """
+        stderr = process_errors(self.gpg)
+        if self.producer is not None:
+            self.producer.wait()
+        if self.gpg.returncode != 0:
+            logging.error('Failed to encrypt: %s', stderr)
+            return False
+        if self.producer is not None and self.producer.returncode != 0:
+            logging.error('%s exited with %d', self.producer.args[0],
+                          self.producer.returncode)
+            return False
+        return True
+
+    def close(self):
+        """ Stop gpg and the producer if the stream was not read to the
+            end """
+        for proc in [self.gpg, self.producer]:
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if self.gpg is not None:
+            self.gpg.stdout.close()
+            self.gpg.errors.close()
+
+
+class EncryptedTar(EncryptedStream):
+    """ Tarball of members compressed with codec, encrypted as it is
+        written: tar piped into gpg. members is a list of (directory, [paths
+        relative to it]). """
+    def __init__(self, members, codec=BACKUP_CODEC):
+        cmd = ['tar', 'cf', '-', '-I', codec_program(codec)]
+        for directory, paths in members:
+            cmd += ['-C', directory] + list(paths)
+        logging.info(cmd)
+        tar = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        super().__init__(tar.stdout, tar)
+        # gpg holds the read end of the pipe now; tar gets SIGPIPE if gpg
+        # exits early
+        tar.stdout.close()
+
+
+def http_connection(url, cafile=None):
+    """ Return an HTTP(S) connection to the host of the URL (a urlsplit
+        result), trusting the CA in cafile if given """
+    if url.scheme == 'https':
+        return http.client.HTTPSConnection(
+            url.netloc, context=ssl.create_default_context(cafile=cafile))
+    return http.client.HTTPConnection(url.netloc)
+
+
+def free_space(path):
+    """ Return (device, free bytes) of the filesystem path is (or would be)
+        created on """
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev, shutil.disk_usage(path).free
+
+
+class RestoreMetrics:
+    """ Metrics collected during a restore, exported as a Prometheus textfile
+        and as JSON """
+    def __init__(self):
+        self.labels = {}
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, name, value, **labels):
+        """ Add a sample for metric name """
+        labels = dict(self.labels, **labels)
+        with self.lock:
+            self.samples.append((name, labels, value))
+
+    def transfer(self, phase, nbytes, seconds, **labels):
+        """ Add the bytes processed and seconds spent by phase """
+        self.add('restore_phase_bytes', nbytes, phase=phase, **labels)
+        self.add('restore_phase_seconds', seconds, phase=phase, **labels)
+
+    def summary(self):
+        """ Return the samples and the total bytes, seconds and throughput
+            of each phase """
+        phases = {}
+        for name, labels, value in self.samples:
+            if name in ['restore_phase_bytes', 'restore_phase_seconds']:
+                phase = phases.setdefault(labels['phase'], {
+                    'bytes': 0,
+                    'seconds': 0
+                })
+                phase[name[len('restore_phase_'):]] += value
+        for phase in phases.values():
+            phase['bytes_per_second'] = (phase['bytes'] / phase['seconds']
+                                         if phase['seconds'] else None)
+        return {
+            'labels': self.labels,
+            'phases': phases,
+            'samples': [{
+                'name': name,
+                'labels': labels,
+                'value': value
+            } for name, labels, value in self.samples]
+        }
+
+    def to_prometheus(self):
+        """ Render the samples in the Prometheus text format """
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+
+        lines = []
+        names = sorted(set(name for name, _, _ in self.samples))
+        for name in names:
+            lines.append('# HELP {} {}'.format(name, METRIC_HELP.get(name,
+                                                                      name)))
+            lines.append('# TYPE {} gauge'.format(name))
+            for sname, labels, value in self.samples:
+                if sname != name:
+                    continue
+                label_str = ','.join('{}="{}"'.format(key, escape(val))
+                                     for key, val in sorted(labels.items()))
+                lines.append('{}{{{}}} {}'.format(name, label_str, value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomic(path, content):
+        """ Write content to path through a temporary file and rename """
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as mfh:
+            mfh.write(content)
+        os.replace(tmp_path, path)
+
+    def write_textfile(self, path):
+        """ Write the samples to a Prometheus textfile collector file """
+        self._write_atomic(path, self.to_prometheus())
+
+    def write_json(self, path):
+        """ Write the samples and per phase totals as JSON """
+        self._write_atomic(path, json.dumps(self.summary(), indent=2))
+
+
+METRICS = RestoreMetrics()
+
+
+class PhaseProfiler:
+    """ Wall clock and CPU timers per restore phase, with optional cProfile
+        and tracemalloc snapshots of the top level phases of the thread that
+        enabled it """
+    def __init__(self):
+        self.enabled = False
+        self.use_cprofile = False
+        self.use_tracemalloc = False
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The thread that enabled the profiler and its stack of phases
+        self.thread = None
+        self.root = []
+
+    def enable(self, use_cprofile=False, use_tracemalloc=False):
+        """ Start profiling phases """
+        self.enabled = True
+        self.use_cprofile = use_cprofile
+        self.use_tracemalloc = use_tracemalloc
+        self.thread = threading.get_ident()
+        self.root = self.local.__dict__.setdefault('stack', [])
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Measure the enclosed block as phase name; phases nested in another
+            phase are named after their parents """
+        if not self.enabled:
+            yield
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        owner = threading.get_ident() == self.thread
+        # Only one cProfile can be active at a time and the tracemalloc peak
+        # is process wide: the phases of the other threads (upload and
+        # download pools, sessions) are timed as nested in the current top
+        # level phase of the thread that enabled the profiler
+        toplevel = owner and not stack
+        stack.append(name)
+        path = '/'.join(stack if owner else self.root[:1] + stack)
+        profile = None
+        snapshot = None
+        if toplevel and self.use_cprofile:
+            profile = cProfile.Profile()
+        if toplevel and self.use_tracemalloc:
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            stack.pop()
+            peak = None
+            allocations = []
+            if snapshot:
+                peak = tracemalloc.get_traced_memory()[1]
+                allocations = tracemalloc.take_snapshot().compare_to(
+                    snapshot, 'lineno')[:10]
+            self._record(path, wall, cpu, profile, peak, allocations)
+
+    def _record(self, path, wall, cpu, profile, peak, allocations):
+        """ Add a measurement to the totals of the phase at path """
+        with self.lock:
+            phase = self.phases.setdefault(
+                path, {
+                    'calls': 0,
+                    'wall': 0.0,
+                    'cpu': 0.0,
+                    'peak': None,
+                    'stats': None,
+                    'allocations': []
+                })
+            phase['calls'] += 1
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+            if peak is not None:
+                phase['peak'] = max(phase['peak'] or 0, peak)
+                phase['allocations'] = allocations
+            if profile:
+                if phase['stats'] is None:
+                    phase['stats'] = pstats.Stats(profile)
+                else:
+                    phase['stats'].add(profile)
+
+    def report(self, top=20):
+        """ Return the report of the phases ranked by wall clock time """
+        lines = [
+            '{:<50} {:>6} {:>10} {:>10} {:>12}'.format('PHASE', 'CALLS',
+                                                       'WALL(s)', 'CPU(s)',
+                                                       'PEAK MEM')
+        ]
+        ranked = sorted(self.phases.items(),
+                        key=lambda item: item[1]['wall'],
+                        reverse=True)
+        for path, phase in ranked:
+            lines.append('{:<50} {:>6} {:>10.3f} {:>10.3f} {:>12}'.format(
+                path, phase['calls'], phase['wall'], phase['cpu'],
+                human_size(phase['peak'])
+                if phase['peak'] is not None else '-'))
+        for path, phase in ranked:
+            if phase['allocations']:
+                lines.append('')
+                lines.append('Top allocations in {}:'.format(path))
+                lines.extend(
+                    '  {}'.format(stat) for stat in phase['allocations'])
+            if phase['stats']:
+                lines.append('')
+                lines.append('Hot functions in {}:'.format(path))
+                stream = io.StringIO()
+                phase['stats'].stream = stream
+                phase['stats'].sort_stats('cumulative').print_stats(top)
+                lines.append(stream.getvalue())
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path):
+        """ Write the report to path """
+        with open(path, 'w') as rfh:
+            rfh.write(self.report())
+
+
+PROFILER = PhaseProfiler()
+
+
+def profiled(name):
+    """ Decorator measuring each call of the function as phase name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 # pylint: disable=too-few-public-methods
 class DataSource(ABC):
     """ Generic Data source """
+    DATA_DIR = None
+    BACKUP_DIR = None
+    # Phases of a restore, for the restore plan
+    PHASES = RESTORE_PHASES
+    # Whether the tarballs are decrypted by restore_data rather than after
+    # they are downloaded
+    STREAM_DECRYPT = False
+    # Whether the tarballs are extracted by restore_data rather than by
+    # restore_keyspaces
+    RESTORE_EXTRACTS = True
+
     def __init__(self, **kwargs):
         self.datatype = kwargs.get('datatype', None)
+        # Selective restore filters; empty means everything
+        self.keyspaces = kwargs.get('keyspaces') or []
+        self.tables = kwargs.get('tables') or []
+        self.databases = kwargs.get('databases') or []
+        # The data directory of the database, and the working directory the
+        # backups are downloaded to and extracted in; the class defaults
+        # unless the session gives its own
+        self.data_dir = kwargs.get('data_dir') or self.DATA_DIR
+        self.backup_dir = kwargs.get('workdir') or self.BACKUP_DIR
+        # The storage client the datasource belongs to, set by the client
+        self.storage = None
+        # Codec of the tarballs backed up
+        self.codec = kwargs.get('codec') or BACKUP_CODEC
 
     def restore(self):
         """ Restore backup from tarballs in data_dir """
 
+    @property
+    def history_path(self):
+        """ Path of the throughput history file """
+        return os.path.join(self.data_dir, HISTORY_FILE)
+
+    def local_path(self, key):
+        """ Path in the working directory the object at key is downloaded to """
+        return os.path.join(self.backup_dir, key.split('/', 1)[1])
+
+    def close(self):
+        """ Close the database client, if any """
+
+    def backup_data(self, client):
+        """ Back the data up to the storage backend of client """
+        logging.error('Backups of %s are not supported', self.datatype)
+        return False
+
+    def restore_points(self, objs):
+        """ Return [(backup time, keys)] of the backup sets in objs, oldest
+            first, where keys are all the objects a restore of the set
+            reads; objects outside of a date-stamped backup directory are
+            left out """
+        dirs = {}
+        for key in objs:
+            parts = key.split('/')
+            if len(parts) < 3:
+                continue
+            try:
+                timestamp = datetime.strptime(parts[1], '%Y-%m-%d_%H-%M-%S')
+            except ValueError:
+                continue
+            dirs.setdefault(timestamp, []).append(key)
+        return sorted(dirs.items())
+
+    def unreferenced_keys(self, kept):
+        """ {key: size} of the objects out of the datatype prefix that none
+            of the objects in kept refers to, for prune; None if they cannot
+            be told apart """
+        return {}
+
+    def upload_tarball(self, client, key, members):
+        """ Stream the encrypted tarball of members (see EncryptedTar) to key
+            in the storage backend of client; returns whether it was
+            uploaded """
+        return self.upload_stream(
+            client, key, EncryptedTar(members, tarball_codec(key)))
+
+    def upload_file(self, client, key, path):
+        """ Stream the file at path, encrypted, to key in the storage backend
+            of client; returns whether it was uploaded """
+        with open(path, 'rb') as sfh:
+            stream = EncryptedStream(sfh)
+        return self.upload_stream(client, key, stream)
+
+    def upload_stream(self, client, key, stream):
+        """ Upload the EncryptedStream stream to key in the storage backend
+            of client; returns whether it was uploaded """
+        if stream.gpg is None:
+            stream.close()
+            return False
+        start = time.monotonic()
+        try:
+            size = client.upload(key, stream)
+        finally:
+            stream.close()
+        if size is None:
+            return False
+        METRICS.transfer('upload', size, time.monotonic() - start, object=key)
+        logging.info('Uploaded %s (%s)', key, human_size(size))
+        return True
+
+    def load_history(self):
+        """ Load throughput samples per phase from the history file """
+        try:
+            with open(self.history_path) as hfh:
+                return json.load(hfh)
+        except (OSError, ValueError):
+            return {}
+
+    def record_throughput(self, phase, nbytes, seconds, **labels):
+        """ Record bytes processed in seconds by phase in the metrics and the
+            history """
+        METRICS.transfer(phase, nbytes, seconds, **labels)
+        history = self.load_history()
+        samples = history.setdefault(phase, [])
+        samples.append([nbytes, seconds])
+        del samples[:-HISTORY_SAMPLES]
+        try:
+            with open(self.history_path, 'w') as hfh:
+                json.dump(history, hfh)
+        except OSError as error:
+            logging.warning('Unable to save throughput history: %s', error)
+
+    def throughput(self, phase):
+        """ Return measured throughput of phase in bytes/sec, None if unknown """
+        samples = self.load_history().get(phase, [])
+        nbytes = sum(sample[0] for sample in samples)
+        seconds = sum(sample[1] for sample in samples)
+        if not nbytes or not seconds:
+            return None
+        return nbytes / seconds
+
+    def record_row_count(self, table, expected, actual, seconds):
+        """ Record the rows counted in a restored table in seconds against the
+            rows expected, and flag it if they differ too much """
+        METRICS.add('restore_verify_query_seconds', seconds, table=table)
+        METRICS.add('restore_verify_expected_rows', expected, table=table)
+        METRICS.add('restore_verify_actual_rows', actual, table=table)
+        if expected:
+            METRICS.add('restore_verify_row_deviation_ratio',
+                        (actual - expected) / expected,
+                        table=table)
+        if not row_count_ok(table, expected, actual):
+            logging.error(
+                'Row count for %s differ too much (expected=%d, actual=%d)',
+                table, expected, actual)
+            return False
+        logging.info('%s OK', table)
+        return True
+
+    @profiled('cleanup')
+    def cleanup(self):
+        """ Cleanup """
+        logging.info('Cleanup')
+        try:
+            shutil.rmtree(self.backup_dir)
+        except OSError as error:
+            logging.error('Cannot delete %s: %s', self.backup_dir, error)
+            return False
+        return True
+
 
 class InfluxData(DataSource):
     """ Influxdb Data Source """
     # Influxdb constants
-    FULL_BACKUP_SUFFIX = '-full.tar.gz.gpg'
+    FULL_BACKUP_SUFFIX = '-full'
+    # Full backups are taken on Sundays, incremental ones the other days
+    FULL_BACKUP_WEEKDAY = 6
+    TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
     DATA_DIR = '/var/lib/influxdb'
     BACKUP_DIR = os.path.join(DATA_DIR, 'zinfluxdb-data')
+    STATS_MANIFEST = 'zinfluxdb.stats.json'
+    SHARD_FILES = '*.s[0-9]*.tar.gz'
 
     HOST = '127.0.0.1'
     PORT = 8086
 
     def __init__(self, *args, **kwargs):
         self.datatype = ZINFLUXDB
+        self.client = None
+        self.jobs = kwargs.get('jobs') or RESTORE_JOBS
         super().__init__(*args, **kwargs)
 
-    def get_last_backup_keys(self, objs):
-        """ Return the set of last backups that comprise a full influxdb backup """
+    def restore_points(self, objs):
+        """ Each influxdb backup is a restore point, which reads the backups
+            of its chain: the last full backup before it and the incremental
+            ones since """
         # Assumption: the objects in the backup bucket are chronologically
-        # ordered. We iterate over the last 20 objects in reverse order to find the last
-        # full backup, while adding them to the list of blobs that we need to
-        # download.
-        keys = []
-        if len(objs) > 20:
-            last = sorted(objs, key=objs.get)[-20:]
-        else:
-            last = sorted(objs, key=objs.get)
-        for key in last[::-1]:
-            keys.append(key)
-            if key.endswith(self.FULL_BACKUP_SUFFIX):
-                break
-        return keys
+        # ordered by their last modified time
+        points = []
+        chain = []
+        for key in sorted(objs, key=objs.get):
+            if not tarball_codec(key):
+                continue
+            if tarball_name(key).endswith(self.FULL_BACKUP_SUFFIX):
+                chain = []
+            chain = chain + [key]
+            points.append((datetime.fromtimestamp(objs[key]), chain))
+        return points
+
+    def get_last_backup_keys(self, objs):
+        """ Return the set of last backups that comprise a full influxdb backup:
+            the last backup and the ones before it, back to the last full
+            backup """
+        points = self.restore_points(objs)
+        return points[-1][1][::-1] if points else []
 
     # pylint: disable=no-self-use
+    @profiled('influxd_restore')
     def _restore_influxdb_data(self, client):
         """ Helper function to restore influxdb data """
+        from influxdb.exceptions import InfluxDBClientError
         databases = []
-        for tarball_path in sorted(pathlib.Path('.').glob('**/*.tar.gz')):
-            cmd = ['tar', 'xf', os.fspath(tarball_path)]
+        # The decrypted tarballs
+        tarballs = [
+            path for path in pathlib.Path(self.backup_dir).glob('**/*.tar.*')
+            if path.suffix != '.gpg' and tarball_codec(path.name)
+        ]
+        for tarball_path in sorted(tarballs,
+                                   key=lambda path: tarball_name(path.name)):
+            influxdb_data_dir = tarball_name(tarball_path.name)
+            backup_path = os.path.join(self.backup_dir, influxdb_data_dir)
+            cmd = [
+                'tar', 'xf',
+                os.fspath(tarball_path), '-C', self.backup_dir
+            ] + tar_codec_args(tarball_path.name)
+            if self.databases:
+                # Portable backups hold a manifest, the meta store and one
+                # <ts>.s<shard id>.tar.gz file per shard: everything but the
+                # shards is extracted first, the manifest to find the shards
+                # of the databases. Excluded rather than listed, so that the
+                # stats manifest, which older backups lack, may be missing.
+                cmd += ['--wildcards', '--exclude', self.SHARD_FILES]
             logging.info(cmd)
+            start = time.monotonic()
             if not execute_cmd(cmd):
                 return False
+            shards = self._portable_shards(backup_path)
+            if shards is None:
+                return False
+            members = [
+                '{}/{}'.format(influxdb_data_dir, name)
+                for dbname in self.databases for name in shards.get(dbname, [])
+            ]
+            if members:
+                cmd = [
+                    'tar', 'xf',
+                    os.fspath(tarball_path), '-C', self.backup_dir
+                ] + tar_codec_args(tarball_path.name) + members
+                logging.info(cmd)
+                if not execute_cmd(cmd):
+                    return False
+            self.record_throughput('extract',
+                                   tarball_path.stat().st_size,
+                                   time.monotonic() - start,
+                                   object=os.fspath(tarball_path))
 
-            influxdb_data_dir = os.fspath(tarball_path).strip('.tar.gz').split(
-                '/')[1]
-            if influxdb_data_dir.endswith('-full'):
-                cmd = ['influxd', 'restore', '-portable', influxdb_data_dir]
+            if influxdb_data_dir.endswith('-full') and self.databases:
+                for dbname in self.databases:
+                    if dbname not in shards:
+                        logging.warning('%s has no shards in %s', dbname,
+                                        influxdb_data_dir)
+                        continue
+                    cmd = [
+                        'influxd', 'restore', '-db', dbname, '-portable',
+                        backup_path
+                    ]
+                    if not execute_cmd(cmd):
+                        return False
+                databases = [
+                    dbname for dbname in self.databases if dbname in shards
+                ]
+                logging.info('Databases: %s', ','.join(databases))
+            elif influxdb_data_dir.endswith('-full'):
+                cmd = ['influxd', 'restore', '-portable', backup_path]
                 if not execute_cmd(cmd):
                     return False
                 databases = [
@@ -186,10 +1686,16 @@ class InfluxData(DataSource):
                 logging.info('Databases: %s', ','.join(databases))
             elif influxdb_data_dir.endswith('-inc'):
                 for dbname in databases:
+                    # influxd restore -db fails on a database the backup
+                    # has no shards of
+                    if dbname not in shards:
+                        logging.info('%s has no shards in %s', dbname,
+                                     influxdb_data_dir)
+                        continue
                     inc_db = dbname + '_inc'
                     cmd = [
                         'influxd', 'restore', '-db', dbname, '-newdb', inc_db,
-                        '-portable', influxdb_data_dir
+                        '-portable', backup_path
                     ]
                     if not execute_cmd(cmd):
                         return False
@@ -210,35 +1716,308 @@ class InfluxData(DataSource):
             os.unlink(os.fspath(tarball_path))
         return True
 
-    def restore_data(self):
-        """ Restore from zinfluxdb data tarballs """
+    @staticmethod
+    def _portable_shards(backup_path):
+        """ Return the shard files of each database, from the manifests of
+            the portable backup extracted at backup_path; None if they cannot
+            be read """
+        shards = {}
+        try:
+            for path in pathlib.Path(backup_path).glob('*.manifest'):
+                with open(path) as mfh:
+                    for entry in json.load(mfh).get('files') or []:
+                        shards.setdefault(entry['database'],
+                                          []).append(entry['fileName'])
+        except (OSError, ValueError, KeyError) as error:
+            logging.error('Unable to read the manifest of %s: %s',
+                          backup_path, error)
+            return None
+        return shards
+
+    def _influxdb_client(self):
+        """ Return the client of the local influxdb, None if the credentials
+            are missing """
+        if self.client is None:
+            self.client = self._connect()
+        return self.client
+
+    def _connect(self):
+        """ Return a new client for the local influxdb, None if the
+            credentials are missing """
+        from influxdb import InfluxDBClient
+        import urllib3
+
         username = os.environ.get('INFLUXDB_ADMIN_USER')
         password = os.environ.get('INFLUXDB_ADMIN_PASSWORD')
 
         if any(var is None for var in [username, password]):
             logging.error('Influxdb username/password cannot be None.')
+            return None
+        # The local influxdb uses a self-signed certificate
+        urllib3.disable_warnings()
+        return InfluxDBClient(host=self.HOST,
+                              port=self.PORT,
+                              username=username,
+                              password=password,
+                              ssl=True,
+                              verify_ssl=False,
+                              database=None)
+
+    def close(self):
+        """ Close the influxdb client """
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    @profiled('restore_data')
+    def restore_data(self):
+        """ Restore from zinfluxdb data tarballs """
+        influxdb_client = self._influxdb_client()
+        if influxdb_client is None:
             return False
-        influxdb_client = InfluxDBClient(host=self.HOST,
-                                         port=self.PORT,
-                                         username=username,
-                                         password=password,
-                                         ssl=True,
-                                         verify_ssl=False,
-                                         database=None)
         dbs = influxdb_client.get_list_database()
         if dbs:
             for _db in dbs:
+                if self.databases and _db['name'] not in self.databases:
+                    continue
                 if _db['name'] != '_internal':
                     logging.info('Dropping %s', _db['name'])
                     influxdb_client.drop_database(_db['name'])
+        return self._restore_influxdb_data(influxdb_client)
+
+    def _load_manifest(self):
+        """ Return the stats manifest of the last backup restored, {} if
+            there is none, None if it cannot be read """
+        paths = sorted(
+            pathlib.Path(self.backup_dir).glob('*/' + self.STATS_MANIFEST),
+            key=lambda path: path.parent.name)
+        if not paths:
+            return {}
         try:
-            os.chdir(self.BACKUP_DIR)
-        except OSError as error:
-            logging.error('Unable to change directory to %s: %s',
-                          self.BACKUP_DIR, error)
+            with open(paths[-1]) as mfh:
+                return json.load(mfh)
+        except (OSError, ValueError) as error:
+            logging.error('Unable to read %s: %s', paths[-1], error)
+            return None
+
+    @staticmethod
+    def _points(result):
+        """ Number of points in the result of a COUNT(*) query: the count of
+            the field set in the most points """
+        return max([
+            value for point in result.get_points()
+            for name, value in point.items() if name.startswith('count')
+        ] or [0])
+
+    # pylint: disable=too-many-locals
+    def _measurement_stats(self, client, databases, end=None):
+        """ Count the points of the measurements of databases ({db:
+            [measurement]}), up to the time end (RFC3339) if given, and find
+            their first and last point, jobs queries at a time; returns
+            {(db, measurement): {count, min_time, max_time, seconds}}, None
+            if a query failed """
+        from influxdb.exceptions import InfluxDBClientError
+
+        # One query per measurement and shard group, so each query reads a
+        # single shard
+        try:
+            shard_groups = list(
+                client.query('SHOW SHARD GROUPS').get_points())
+        except InfluxDBClientError as error:
+            logging.error('Failed to list shard groups: %s', error)
+            return None
+        upto = 'time <= \'{}\''.format(end) if end else None
+        queries = []
+        for dbname, measurements in sorted(databases.items()):
+            groups = [
+                group for group in shard_groups
+                if group['database'] == dbname
+            ]
+            for measurement in sorted(measurements):
+                name = '"{}"'.format(measurement.replace('"', '\\"'))
+                for group in groups:
+                    queries.append(
+                        (dbname, measurement, 'count',
+                         'SELECT COUNT(*) FROM "{}".{} WHERE time >= \'{}\' '
+                         'AND time < \'{}\'{}'.format(
+                             group['retention_policy'], name,
+                             group['start_time'], group['end_time'],
+                             ' AND ' + upto if upto else '')))
+                # Like the counts, the bounds cover every retention policy:
+                # the first and last points of each, merged below
+                for policy in sorted(
+                        {group['retention_policy'] for group in groups}):
+                    for bound, order in [('min_time', 'ASC'),
+                                         ('max_time', 'DESC')]:
+                        queries.append(
+                            (dbname, measurement, bound,
+                             'SELECT * FROM "{}".{}{} ORDER BY time {} '
+                             'LIMIT 1'.format(
+                                 policy, name,
+                                 ' WHERE ' + upto if upto else '', order)))
+
+        # A client per thread; the influxdb client is not thread safe
+        local = threading.local()
+        clients = []
+        lock = threading.Lock()
+
+        def run(query):
+            dbname, _, kind, influxql = query
+            conn = getattr(local, 'client', None)
+            if conn is None:
+                conn = local.client = self._connect()
+                with lock:
+                    clients.append(conn)
+            start = time.monotonic()
+            result = conn.query(influxql, database=dbname, epoch='ns')
+            seconds = time.monotonic() - start
+            if kind == 'count':
+                return self._points(result), seconds
+            points = list(result.get_points())
+            return (points[0]['time'] if points else None), seconds
+
+        logging.info('Querying %d measurements with %d queries',
+                     sum(len(measurements)
+                         for measurements in databases.values()),
+                     len(queries))
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                answers = list(pool.map(run, queries))
+        except InfluxDBClientError as error:
+            logging.error('Failed to query measurements: %s', error)
+            return None
+        finally:
+            for conn in clients:
+                conn.close()
+
+        actual = {}
+        for (dbname, measurement, kind, _), (value, seconds) in zip(
+                queries, answers):
+            stats = actual.setdefault((dbname, measurement), {
+                'count': 0,
+                'seconds': 0.0
+            })
+            stats['seconds'] += seconds
+            if kind == 'count':
+                stats['count'] += value
+            elif stats.get(kind) is None or value is None:
+                # None if no retention policy has points
+                stats[kind] = value if value is not None else stats.get(kind)
+            else:
+                merge = min if kind == 'min_time' else max
+                stats[kind] = merge(stats[kind], value)
+        return actual
+
+    def _last_backup_time(self, client):
+        """ Return the time the last backup in the storage backend of client
+            ends at, None if there is none """
+        times = []
+        for key in client.backups:
+            try:
+                times.append(
+                    datetime.strptime(
+                        os.path.basename(key)[:19], self.TIMESTAMP_FORMAT))
+            except ValueError:
+                continue
+        return max(times, default=None)
+
+    # pylint: disable=too-many-locals
+    @profiled('backup')
+    def backup_data(self, client):
+        """ Take a portable backup of all databases, full on Sundays and
+            incremental since the last backup otherwise, write its stats
+            manifest, and upload it to zinfluxdb-data/<timestamp>-full or
+            -inc """
+        from influxdb.exceptions import InfluxDBClientError
+
+        influxdb_client = self._influxdb_client()
+        if influxdb_client is None:
+            return False
+        now = datetime.utcnow()
+        since = self._last_backup_time(client)
+        kind = 'full' if (since is None or now.weekday()
+                          == self.FULL_BACKUP_WEEKDAY) else 'inc'
+        name = '{}-{}'.format(now.strftime(self.TIMESTAMP_FORMAT), kind)
+        end = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        path = os.path.join(self.backup_dir, name)
+        cmd = ['influxd', 'backup', '-portable', '-end', end]
+        if kind == 'inc':
+            cmd += ['-start', since.strftime('%Y-%m-%dT%H:%M:%SZ')]
+        logging.info('Taking %s backup %s', kind, name)
+        if not execute_cmd(cmd + [path]):
+            return False
+        try:
+            # The stats of the whole databases, which the incremental
+            # backups are merged into on restore
+            databases = {
+                _db['name']: [
+                    measurement['name']
+                    for measurement in influxdb_client.query(
+                        'SHOW MEASUREMENTS', database=_db['name']).get_points()
+                ]
+                for _db in influxdb_client.get_list_database()
+                if _db['name'] != '_internal'
+            }
+            stats = self._measurement_stats(influxdb_client, databases, end)
+            if stats is None:
+                return False
+            manifest = {}
+            for (dbname, measurement), values in stats.items():
+                manifest.setdefault(dbname, {})[measurement] = {
+                    bound: values.get(bound)
+                    for bound in ['count', 'min_time', 'max_time']
+                }
+            with open(os.path.join(path, self.STATS_MANIFEST), 'w') as mfh:
+                json.dump(manifest, mfh)
+            return self.upload_tarball(
+                client, '{}-data/{}.tar.{}.gpg'.format(self.datatype, name,
+                                                       self.codec),
+                [(self.backup_dir, [name])])
+        except (InfluxDBClientError, OSError) as error:
+            logging.error('Failed to back up %s: %s', name, error)
+            return False
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @profiled('verify_data')
+    def verify_data(self):
+        """ Verify the point counts and time bounds of the restored
+            measurements against the stats manifest of the backup """
+        logging.info('Verifying data')
+        manifest = self._load_manifest()
+        if manifest is None:
+            return False
+        if not manifest:
+            # Backups from before the stats manifest
+            logging.warning('No %s found in %s, not verifying',
+                            self.STATS_MANIFEST, self.backup_dir)
+            return True
+        client = self._influxdb_client()
+        if client is None:
+            return False
+        databases = {
+            dbname: measurements
+            for dbname, measurements in manifest.items()
+            if not self.databases or dbname in self.databases
+        }
+        actual = self._measurement_stats(client, databases)
+        if actual is None:
             return False
 
-        return self._restore_influxdb_data(influxdb_client)
+        ret = True
+        for (dbname, measurement), stats in sorted(actual.items()):
+            expected = databases[dbname][measurement]
+            table = '{}.{}'.format(dbname, measurement)
+            if not self.record_row_count(table, expected['count'],
+                                         stats['count'], stats['seconds']):
+                ret = False
+            for bound in ['min_time', 'max_time']:
+                if stats.get(bound) != expected.get(bound):
+                    logging.error('%s of %s differs (expected=%s, actual=%s)',
+                                  bound, table, expected.get(bound),
+                                  stats.get(bound))
+                    ret = False
+        return ret
 
 
 class CassandraData(DataSource):
@@ -246,15 +2025,67 @@ class CassandraData(DataSource):
     DATA_DIR = '/var/lib/cassandra'
     BACKUP_DIR = os.path.join(DATA_DIR, 'cassandra-data')
     KEYSPACE_REGEX = r'^schema-\w+.cql$'
+    # Extracted by restore_keyspaces, copied by restore_data
+    RESTORE_EXTRACTS = False
     RESTRICTED_KEYSPACES = ['schema-system_schema.cql']
+    # The keyspaces backed up, one tarball each
+    BACKUP_KEYSPACES = [
+        'brazosdb', 'doloresdb', 'gangesdb', 'indusdb', 'purusdb', 'seinedb',
+        'system_schema', 'tigrisdb', 'upgrade', 'vault', 'volgadb'
+    ]
+    TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
+    # Deduplicated backups: SSTable files stored once, by the SHA-256 of
+    # their content, and a manifest per backup
+    CAS_PREFIX = 'cassandra-cas/'
+    MANIFEST = 'manifest.json.gpg'
+    # Uploaded next to the manifest before a deduplicated backup reuses the
+    # SSTable files stored, deleted once the manifest is uploaded
+    PENDING = 'manifest.pending'
 
     HOST = '127.0.0.1'
     PORT = 9042
 
     def __init__(self, *args, **kwargs):
         self.datatype = CASSANDRA
-        self.keyspaces_path = os.path.join(self.BACKUP_DIR, 'KEYSPACES')
+        self.cluster = None
+        self.session = None
+        # Schemas are applied once per cluster, other nodes only extract
+        self.apply_schema = kwargs.get('apply_schema', True)
+        self.jobs = kwargs.get('jobs') or RESTORE_JOBS
+        self.dedup = kwargs.get('dedup', False)
+        # Stream the tables to the cluster of these hosts with sstableloader,
+        # each loader throttled to loader_throttle Mbit/s
+        self.loader_hosts = kwargs.get('loader_hosts')
+        self.loader_throttle = kwargs.get('loader_throttle')
+        self.loader_lock = threading.Lock()
         super().__init__(*args, **kwargs)
+        self.keyspaces_path = os.path.join(self.backup_dir, 'KEYSPACES')
+        # Tables already streamed by sstableloader, one keyspace.table a line
+        self.loaded_path = os.path.join(self.backup_dir, 'LOADED')
+        # Decrypted SSTable files of deduplicated backups, kept between
+        # restores so that unchanged files are not downloaded again
+        self.cas_cache = os.path.join(self.data_dir, 'cassandra-cas')
+
+    def selected(self, keyspace, table=None):
+        """ Whether the keyspace, or its table, is selected by the keyspace
+            and table filters """
+        if not self.keyspaces and not self.tables:
+            return True
+        if keyspace in self.keyspaces:
+            return True
+        if table is None:
+            return any(
+                tbl.split('.')[0] == keyspace for tbl in self.tables)
+        return '{}.{}'.format(keyspace, table) in self.tables
+
+    def selected_tables(self, keyspace):
+        """ Return the tables selected in keyspace, [] if all of them are """
+        if not self.tables or keyspace in self.keyspaces:
+            return []
+        return [
+            tbl.split('.', 1)[1] for tbl in self.tables
+            if tbl.split('.')[0] == keyspace
+        ]
 
     # pylint: disable=no-self-use
     def get_last_backup_keys(self, objs):
@@ -263,42 +2094,197 @@ class CassandraData(DataSource):
         # ordered. We iterate over the last 20 objects in reverse order to find the last
         # full backup, while adding them to the list of blobs that we need to
         # download.
-        keys = [os.path.dirname(bkp) for bkp in objs]
+        # The SSTable files of deduplicated backups are not backup sets
+        keys = [
+            os.path.dirname(bkp) for bkp in objs
+            if not bkp.startswith(self.CAS_PREFIX)
+            and not bkp.endswith(self.PENDING)
+        ]
         data = {}
         for key in keys:
             data.update({
                 key:
                 datetime.strptime(key.split('/')[1],
-                                  '%Y-%m-%d_%H-%M-%S').timestamp()
+                                  self.TIMESTAMP_FORMAT).timestamp()
             })
         dirname = sorted(data, key=data.get)[-1]
-        dbs = [
-            'brazosdb', 'doloresdb', 'gangesdb', 'indusdb', 'purusdb',
-            'seinedb', 'system_schema', 'tigrisdb', 'upgrade', 'vault',
-            'volgadb'
+        manifest_key = '{}/{}'.format(dirname, self.MANIFEST)
+        if manifest_key in objs:
+            return [manifest_key] + self._missing_objects(manifest_key)
+        dbs = self.BACKUP_KEYSPACES
+        if self.keyspaces or self.tables:
+            dbs = [db for db in dbs if self.selected(db)]
+        keys = []
+        for db in dbs:
+            candidates = [
+                '{}/{}.tar.{}.gpg'.format(dirname, db, codec)
+                for codec in CODECS
+            ]
+            keys.append(
+                next((key for key in candidates if key in objs),
+                     candidates[0]))
+        return keys
+
+    def cas_key(self, digest):
+        """ Key of the SSTable file of SHA-256 digest in the storage """
+        return '{}{}/{}.gpg'.format(self.CAS_PREFIX, digest[:2], digest)
+
+    def cached_path(self, digest):
+        """ Path of the SSTable file of SHA-256 digest in the cache """
+        return os.path.join(self.cas_cache, digest[:2], digest)
+
+    def local_path(self, key):
+        """ SSTable files are downloaded to cassandra-cas/ in the working
+            directory """
+        if key.startswith(self.CAS_PREFIX):
+            return os.path.join(self.backup_dir, key)
+        return super().local_path(key)
+
+    def _read_manifest(self, key):
+        """ Read and decrypt the manifest at key in the storage """
+        gpg = gpg_decrypt_process()
+        if gpg is None:
+            return None
+        stdout, _ = gpg.communicate(b''.join(self.storage.read_chunks(key)))
+        stderr = process_errors(gpg)
+        if gpg.returncode != 0:
+            logging.error('Failed to decrypt %s: %s', key, stderr)
+            return None
+        return json.loads(stdout)
+
+    def _manifest_files(self, manifest):
+        """ Yield the keyspace and the entry of each selected SSTable file of
+            the manifest """
+        for keyspace, backup in sorted(manifest['keyspaces'].items()):
+            for entry in backup['files']:
+                if self.selected(keyspace,
+                                 entry['path'].split('/')[1].split('-')[0]):
+                    yield keyspace, entry
+
+    def _missing_objects(self, manifest_key):
+        """ Keys of the SSTable files of the selected tables of the manifest
+            at manifest_key that are not in the cache yet. They are out of
+            the listing of the datatype prefix: the storage client looks them
+            up (see BackupClient.get_last_backup_keys). """
+        manifest = self._read_manifest(manifest_key)
+        if manifest is None:
+            return []
+        keys = set()
+        cached = set()
+        for _, entry in self._manifest_files(manifest):
+            key = self.cas_key(entry['sha256'])
+            if key in keys or key in cached:
+                continue
+            if os.path.exists(self.cached_path(entry['sha256'])):
+                cached.add(key)
+            else:
+                keys.add(key)
+        logging.info('%d SSTable files to download, %d in the cache',
+                     len(keys), len(cached))
+        return sorted(keys)
+
+    def restore_points(self, objs):
+        """ The backup sets, but for the deduplicated backups in progress
+            (with a pending marker only) """
+        return [(timestamp, keys)
+                for timestamp, keys in super().restore_points(objs)
+                if any(not key.endswith(self.PENDING) for key in keys)]
+
+    def unreferenced_keys(self, kept):
+        """ {key: size} of the SSTable files that none of the manifests in
+            kept refers to and of the pending markers of the deduplicated
+            backups that failed; None if one of the manifests cannot be read
+            or a deduplicated backup is in progress """
+        since = time.time() - PRUNE_GRACE_SECONDS
+        pending = {
+            key: timestamp
+            for key, timestamp in self.storage.backups.items()
+            if key.endswith(self.PENDING)
+        }
+        # A backup in progress may reuse any SSTable file stored, however
+        # old, without its manifest referring to it yet
+        running = [key for key, timestamp in pending.items()
+                   if timestamp >= since]
+        if running:
+            logging.error('Not pruning SSTable files while deduplicated '
+                          'backups are in progress: %s', ', '.join(running))
+            return None
+        manifests = [
+            key for key in kept if os.path.basename(key) == self.MANIFEST
         ]
-        return ['{}/{}.tar.gz.gpg'.format(dirname, db) for db in dbs]
+        with ThreadPoolExecutor(
+                max_workers=self.storage.concurrency) as pool:
+            contents = list(pool.map(self._read_manifest, manifests))
+        if any(manifest is None for manifest in contents):
+            logging.error('Not pruning SSTable files without all the '
+                          'manifests of the backups kept')
+            return None
+        referenced = {
+            self.cas_key(entry['sha256'])
+            for manifest in contents
+            for backup in manifest['keyspaces'].values()
+            for entry in backup['files']
+        }
+        keys = {}
+        for key, timestamp, size in self.storage.list_objects(
+                self.CAS_PREFIX):
+            if key not in referenced and timestamp < since:
+                keys[key] = size
+        logging.info('%d SSTable files referenced by %d manifests, %d '
+                     'unreferenced', len(referenced), len(manifests),
+                     len(keys))
+        for key in pending:
+            logging.warning('Deduplicated backup %s failed',
+                            os.path.dirname(key))
+            keys[key] = self.storage.sizes.get(key, 0)
+        return keys
 
+    @profiled('restore_keyspaces')
     def restore_keyspaces(self):
         """ Restore keyspaces """
         logging.info('Restoring keyspaces')
-        try:
-            os.chdir(self.BACKUP_DIR)
-        except OSError as error:
-            logging.error('Unable to change directory to %s: %s',
-                          self.BACKUP_DIR, error)
-            return False
-
         # Remove the KEYSPACES file if it exists
         if os.path.exists(self.keyspaces_path):
             os.unlink(self.keyspaces_path)
+        manifests = sorted(
+            pathlib.Path(self.backup_dir).glob(
+                '*/' + self.MANIFEST[:-len('.gpg')]))
+        if manifests and not self._materialize(manifests[-1]):
+            return False
 
-        # Find all the tarballs in the backup download directory
-        for tarball_path in pathlib.Path('.').glob('*/*.tar.gz'):
-            cmd = ['tar', 'xf', os.fspath(tarball_path)]
+        # Find all the tarballs in the backup download directory, and extract
+        # them --jobs at a time
+        cmds = []
+        size = 0
+        for tarball_path in pathlib.Path(self.backup_dir).glob('*/*.tar.*'):
+            # The decrypted tarballs
+            if tarball_path.suffix == '.gpg' or not tarball_codec(
+                    tarball_path.name):
+                continue
+            keyspace = tarball_name(tarball_path.name)
+            if not self.selected(keyspace):
+                continue
+            cmd = [
+                'tar', 'xf',
+                os.fspath(tarball_path), '-C', self.backup_dir
+            ] + tar_codec_args(tarball_path.name)
+            tables = self.selected_tables(keyspace)
+            if tables:
+                cmd += [
+                    '--wildcards', 'schema-{}.cql'.format(keyspace),
+                    '{}.stats'.format(keyspace)
+                ] + ['{}/{}-*'.format(keyspace, tbl) for tbl in tables]
             logging.info(cmd)
-            if not execute_cmd(cmd):
-                return False
+            cmds.append(cmd)
+            size += tarball_path.stat().st_size
+        start = time.monotonic()
+        if any(SUPERVISOR.run_all(cmds)):
+            return False
+        if cmds:
+            self.record_throughput('extract',
+                                   size,
+                                   time.monotonic() - start,
+                                   tarballs=len(cmds))
         logging.info('Untarring completed')
 
         # Restore the keyspace schemas
@@ -308,17 +2294,23 @@ class CassandraData(DataSource):
             os.getenv('CASSANDRA_PASSWORD'), '-f'
         ]
         restored_keyspaces = []
-        for schema_path in pathlib.Path('.').glob('schema-*.cql'):
+        for schema_path in pathlib.Path(
+                self.backup_dir).glob('schema-*.cql'):
             logging.info('Restoring schema from %s', schema_path)
-            keyspace_schema = os.fspath(schema_path)
+            keyspace_schema = schema_path.name
             if keyspace_schema in self.RESTRICTED_KEYSPACES or not re.match(
                     self.KEYSPACE_REGEX, keyspace_schema):
                 logging.info('Skipping restoring %s', keyspace_schema)
                 continue
             keyspace = keyspace_schema[len('schema-'):-len('.cql')]
+            if not self.selected(keyspace):
+                logging.info('Skipping restoring %s', keyspace_schema)
+                continue
             with open(self.keyspaces_path, 'a') as ksfh:
                 ksfh.write('{}\n'.format(keyspace))
-            cmd = keyspace_restore_cmd_prefix + [keyspace_schema]
+            if not self.apply_schema:
+                continue
+            cmd = keyspace_restore_cmd_prefix + [os.fspath(schema_path)]
             logging.info(cmd)
             if not execute_cmd(cmd):
                 return False
@@ -326,46 +2318,214 @@ class CassandraData(DataSource):
         logging.info('Keyspaces restored: %s', ','.join(restored_keyspaces))
         return True
 
-    def restore_data(self):
-        """ Restore from cassandra data tarballs """
+    def _cache(self, digest):
+        """ Move the downloaded SSTable file of SHA-256 digest to the cache,
+            after checking its content; returns its path in the cache """
+        cached = self.cached_path(digest)
+        if os.path.exists(cached):
+            return cached
+        downloaded = self.local_path(self.cas_key(digest))[:-len('.gpg')]
+        if file_sha256(downloaded) != digest:
+            raise ChecksumError('{} does not match its SHA-256 {}'.format(
+                downloaded, digest))
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        shutil.move(downloaded, cached)
+        return cached
+
+    @profiled('materialize')
+    def _materialize(self, path):
+        """ Lay the deduplicated backup of the manifest at path out in the
+            working directory like extracted tarballs: the schema, stats and
+            snapshots of the selected keyspaces, the SSTable files linked
+            from the cache """
         try:
-            os.chdir(self.BACKUP_DIR)
-        except OSError as error:
-            logging.error('Unable to change directory to %s: %s',
-                          self.DATA_DIR, error)
+            with open(path) as mfh:
+                manifest = json.load(mfh)
+            for keyspace, backup in manifest['keyspaces'].items():
+                if not self.selected(keyspace):
+                    continue
+                for name, content in [('schema-{}.cql', backup['schema']),
+                                      ('{}.stats', backup['stats'])]:
+                    with open(os.path.join(self.backup_dir,
+                                           name.format(keyspace)),
+                              'w') as sfh:
+                        sfh.write(content)
+            linked = 0
+            for _, entry in self._manifest_files(manifest):
+                dest = os.path.join(self.backup_dir, entry['path'])
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                copy_file(self._cache(entry['sha256']), dest)
+                linked += entry['size']
+            # Keep the cache to the files of the last backup restored
+            digests = {
+                entry['sha256']
+                for backup in manifest['keyspaces'].values()
+                for entry in backup['files']
+            }
+            for cached in pathlib.Path(self.cas_cache).glob('*/*'):
+                if cached.name not in digests:
+                    cached.unlink()
+        except (OSError, ValueError, KeyError, ChecksumError) as error:
+            logging.error('Failed to lay out %s: %s', path, error)
             return False
+        logging.info('Laid out %s of SSTables from %s', human_size(linked),
+                     path)
+        return True
 
+    @profiled('restore_data')
+    def restore_data(self):
+        """ Restore from cassandra data tarballs """
         # Load the keyspaces from KEYSPACES file
         with open(self.keyspaces_path) as kpath:
             keyspaces = [key.strip('\n') for key in kpath.readlines()]
             kpath.close()
-        keyspaces.append('system_schema')
+        if not self.keyspaces and not self.tables:
+            keyspaces.append('system_schema')
+        keyspaces = [keyspace for keyspace in keyspaces
+                     if self.selected(keyspace)]
 
         logging.info('Restoring data for %s', ','.join(keyspaces))
+        if self.loader_hosts:
+            return self._load_tables(keyspaces)
         for keyspace in keyspaces:
-            for sdir in pathlib.Path(keyspace).glob('*/snapshots/backup-*'):
-                spath = os.path.join(self.BACKUP_DIR, sdir)
-                tbl_name = os.fspath(sdir).split('-')[0].split('/')[1]
-                tdir_path = os.path.join(self.DATA_DIR, 'data', keyspace)
+            for sdir in pathlib.Path(self.backup_dir,
+                                     keyspace).glob('*/snapshots/backup-*'):
+                spath = os.fspath(sdir)
+                tbl_name = sdir.relative_to(
+                    self.backup_dir).parts[1].split('-')[0]
+                if not self.selected(keyspace, tbl_name):
+                    continue
+                tdir_path = os.path.join(self.data_dir, 'data', keyspace)
                 tpath = list(pathlib.Path(tdir_path).glob(tbl_name + '-*'))[0]
                 logging.info('Restoring %s/%s data', keyspace, tbl_name)
+                copied = 0
+                start = time.monotonic()
                 for entry in os.listdir(spath):
                     try:
                         src = os.path.join(spath, entry)
                         dest = os.path.join(tpath, entry)
                         if os.path.isfile(src):
                             shutil.copy2(src, dest)
+                            copied += os.path.getsize(dest)
                     except OSError as error:
                         logging.error('Failed to copy %s -> %s: %s', src, dest,
                                       error)
                         return False
+                self.record_throughput('copy',
+                                       copied,
+                                       time.monotonic() - start,
+                                       table='{}.{}'.format(
+                                           keyspace, tbl_name))
+        logging.info('Restoring data DONE')
+        return True
+
+    def _loaded_tables(self):
+        """ Return the tables in the resume file of sstableloader """
+        try:
+            with open(self.loaded_path) as lfh:
+                return {line.strip() for line in lfh if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _load_table(self, keyspace, table, sdirs):
+        """ Stream the snapshot directories sdirs of keyspace.table to the
+            cluster with sstableloader, retrying with backoff; returns
+            whether it was loaded """
+        name = '{}.{}'.format(keyspace, table)
+        # sstableloader takes the keyspace and table from the last two
+        # directories of the path; the files are hard linked there
+        stage = os.path.join(self.backup_dir, 'sstableloader', keyspace,
+                             table)
+        size = 0
+        try:
+            shutil.rmtree(stage, ignore_errors=True)
+            os.makedirs(stage)
+            for sdir in sdirs:
+                for entry in os.scandir(sdir):
+                    if entry.is_file():
+                        copy_file(entry.path,
+                                  os.path.join(stage, entry.name))
+                        size += entry.stat().st_size
+        except OSError as error:
+            logging.error('Failed to stage %s: %s', name, error)
+            return False
+        cmd = ['sstableloader', '--no-progress', '-d', self.loader_hosts]
+        if os.getenv('CASSANDRA_USERNAME'):
+            cmd += [
+                '-u',
+                os.getenv('CASSANDRA_USERNAME'), '-pw',
+                os.getenv('CASSANDRA_PASSWORD')
+            ]
+        if self.loader_throttle:
+            cmd += ['-t', str(self.loader_throttle)]
+        cmd.append(stage)
+        for attempt in range(LOADER_RETRIES + 1):
+            if attempt:
+                delay = LOADER_BACKOFF_SECONDS * 2**(attempt - 1)
+                logging.warning('Retrying %s in %ds', name, delay)
+                time.sleep(delay)
+            logging.info('Streaming %s (%s)', name, human_size(size))
+            start = time.monotonic()
+            if execute_cmd(cmd):
+                break
+        else:
+            logging.error('Failed to stream %s after %d attempts', name,
+                          LOADER_RETRIES + 1)
+            return False
+        with self.loader_lock:
+            self.record_throughput('copy',
+                                   size,
+                                   time.monotonic() - start,
+                                   table=name)
+            with open(self.loaded_path, 'a') as lfh:
+                lfh.write(name + '\n')
+        shutil.rmtree(stage, ignore_errors=True)
+        return True
+
+    def _load_tables(self, keyspaces):
+        """ Stream the selected tables of keyspaces to the cluster with
+            sstableloader, --jobs tables at a time; tables in the resume
+            file are skipped, so a failed restore resumes where it stopped """
+        tables = {}
+        for keyspace in keyspaces:
+            # The schema is applied by restore_keyspaces, and the system
+            # tables belong to each node
+            if keyspace.startswith('system'):
+                continue
+            for sdir in sorted(
+                    pathlib.Path(self.backup_dir,
+                                 keyspace).glob('*/snapshots/backup-*')):
+                table = sdir.relative_to(
+                    self.backup_dir).parts[1].split('-')[0]
+                if self.selected(keyspace, table):
+                    tables.setdefault((keyspace, table), []).append(sdir)
+        loaded = self._loaded_tables()
+        pending = [(keyspace, table) for keyspace, table in sorted(tables)
+                   if '{}.{}'.format(keyspace, table) not in loaded]
+        logging.info('Streaming %d tables to %s, %d already loaded',
+                     len(pending), self.loader_hosts,
+                     len(tables) - len(pending))
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            results = list(
+                pool.map(
+                    lambda table: self._load_table(*table, tables[table]),
+                    pending))
+        if not all(results):
+            logging.error('%d of %d tables failed to stream; run the restore '
+                          'again to resume', results.count(False),
+                          len(pending))
+            return False
         logging.info('Restoring data DONE')
         return True
 
+    @profiled('refresh_data')
     def refresh_data(self):
         """ Refresh data """
+        if self.loader_hosts:
+            logging.info('Tables streamed with sstableloader need no refresh')
+            return True
         logging.info('Refreshing data')
-        system_dir = os.path.join(self.DATA_DIR, 'data/system')
+        system_dir = os.path.join(self.data_dir, 'data/system')
         shutil.rmtree(system_dir)
         os.makedirs(system_dir)
         repair_cmd = ['nodetool', 'repair']
@@ -373,51 +2533,229 @@ class CassandraData(DataSource):
             return False
         return True
 
+    def _session(self):
+        """ Return the session of the cassandra cluster, None if the
+            credentials are missing """
+        # pylint: disable=no-name-in-module
+        from cassandra.cluster import Cluster
+        from cassandra.auth import PlainTextAuthProvider
+        from cassandra.policies import DCAwareRoundRobinPolicy
+
+        if self.session is not None:
+            return self.session
+        if os.getenv('CASSANDRA_USERNAME') is None or os.getenv(
+                'CASSANDRA_PASSWORD') is None:
+            logging.error('Cassandra credentials are None')
+            return None
+
+        self.cluster = Cluster(contact_points=[self.HOST],
+                               load_balancing_policy=DCAwareRoundRobinPolicy(
+                                   local_dc='datacenter1'),
+                               port=self.PORT,
+                               auth_provider=PlainTextAuthProvider(
+                                   username=os.getenv('CASSANDRA_USERNAME'),
+                                   password=os.getenv('CASSANDRA_PASSWORD')),
+                               protocol_version=3,
+                               ssl_options={'check_hostname': False})
+        self.session = self.cluster.connect()
+        return self.session
+
+    def close(self):
+        """ Shut the cassandra cluster connection down """
+        if self.cluster is not None:
+            self.cluster.shutdown()
+            self.cluster = None
+            self.session = None
+
+    def _count_rows(self, session, tables):
+        """ Count the rows of tables (keyspace.table), jobs tables at a time;
+            returns {table: rows} """
+        def count(table):
+            query = 'SELECT COUNT(*) FROM {};'.format(table)
+            return int(session.execute(query, timeout=None).one().count)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return dict(zip(tables, pool.map(count, tables)))
+
+    def _snapshot_paths(self, keyspace, tag):
+        """ Paths of the snapshot tag of the selected tables of keyspace,
+            relative to the data directory """
+        data = pathlib.Path(self.data_dir, 'data')
+        return sorted(
+            os.fspath(path.relative_to(data))
+            for path in data.glob('{}/*/snapshots/{}'.format(keyspace, tag))
+            if self.selected(keyspace, path.parts[-3].split('-')[0]))
+
+    def _backup_dedup(self, client, timestamp, tag, keyspaces, stage):
+        """ Upload the SSTable files of the snapshot tag that are not stored
+            yet, then the manifest of the backup: the schema, stats and files
+            of each keyspace """
+        data = os.path.join(self.data_dir, 'data')
+        files = {
+            keyspace: [
+                os.path.join(snapshot, entry.name)
+                for snapshot in self._snapshot_paths(keyspace, tag)
+                for entry in os.scandir(os.path.join(data, snapshot))
+                if entry.is_file()
+            ]
+            for keyspace in keyspaces
+        }
+        paths = [path for keyspace in keyspaces for path in files[keyspace]]
+        prefix = '{}-data/{}/'.format(self.datatype, timestamp)
+        # Keeps prune from deleting the stored files reused until the
+        # manifest refers to them
+        pending = os.path.join(stage, self.PENDING)
+        with open(pending, 'w'):
+            pass
+        if not self.upload_file(client, prefix + self.PENDING, pending):
+            return False
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            digests = dict(
+                zip(paths,
+                    pool.map(lambda path: file_sha256(os.path.join(data, path)),
+                             paths)))
+        stored = client.list_keys(self.CAS_PREFIX)
+        missing = {}
+        for path in paths:
+            key = self.cas_key(digests[path])
+            if key not in stored:
+                missing.setdefault(key, os.path.join(data, path))
+        logging.info('Uploading %d of %d SSTable files', len(missing),
+                     len(paths))
+        with ThreadPoolExecutor(max_workers=client.concurrency) as pool:
+            if not all(
+                    pool.map(lambda item: self.upload_file(client, *item),
+                             missing.items())):
+                return False
+
+        manifest = {'timestamp': timestamp, 'keyspaces': {}}
+        for keyspace in keyspaces:
+            backup = manifest['keyspaces'][keyspace] = {'files': []}
+            for name, field in [('schema-{}.cql', 'schema'),
+                                ('{}.stats', 'stats')]:
+                with open(os.path.join(stage, name.format(keyspace))) as sfh:
+                    backup[field] = sfh.read()
+            for path in files[keyspace]:
+                backup['files'].append({
+                    'path': path,
+                    'sha256': digests[path],
+                    'size': os.path.getsize(os.path.join(data, path))
+                })
+        path = os.path.join(stage, self.MANIFEST[:-len('.gpg')])
+        with open(path, 'w') as mfh:
+            json.dump(manifest, mfh)
+        # Uploaded last, so a manifest only lists stored files
+        if not self.upload_file(client, prefix + self.MANIFEST, path):
+            return False
+        if client.delete_keys([prefix + self.PENDING]):
+            logging.warning('Unable to delete %s, prune deletes it',
+                            prefix + self.PENDING)
+        return True
+
     # pylint: disable=too-many-locals
+    @profiled('backup')
+    def backup_data(self, client):
+        """ Snapshot the selected keyspaces and upload a tarball of each of
+            them, with its schema and the row counts of its tables, to
+            cassandra-data/<timestamp>/, or with dedup their SSTable files
+            that are not stored yet and a manifest """
+        # pylint: disable=no-name-in-module
+        from cassandra import OperationTimedOut, ReadFailure
+
+        session = self._session()
+        if session is None:
+            logging.error('Unable to connect to cassandra')
+            return False
+        timestamp = datetime.now().strftime(self.TIMESTAMP_FORMAT)
+        tag = 'backup-' + timestamp
+        keyspaces = [ks for ks in self.BACKUP_KEYSPACES if self.selected(ks)]
+        # The schemas and row counts, the SSTables are read from the snapshot
+        stage = os.path.join(self.backup_dir, tag)
+        os.makedirs(stage, exist_ok=True)
+        logging.info('Backing up %s', ','.join(keyspaces))
+        if not execute_cmd(['nodetool', 'snapshot', '-t', tag] + keyspaces):
+            return False
+        try:
+            metadata = session.cluster.metadata.keyspaces
+            tables = [
+                '{}.{}'.format(keyspace, table) for keyspace in keyspaces
+                for table in sorted(metadata[keyspace].tables)
+                if self.selected(keyspace, table)
+            ]
+            try:
+                rows = self._count_rows(session, tables)
+            except (OperationTimedOut, ReadFailure) as error:
+                logging.error('Failed to count rows: %s', error)
+                return False
+            for keyspace in keyspaces:
+                with open(os.path.join(stage, 'schema-{}.cql'.format(keyspace)),
+                          'w') as sfh:
+                    sfh.write(metadata[keyspace].export_as_string())
+                with open(os.path.join(stage, '{}.stats'.format(keyspace)),
+                          'w') as sfh:
+                    for table in tables:
+                        if table.split('.')[0] == keyspace:
+                            sfh.write('{} {}\n'.format(table, rows[table]))
+                if self.dedup:
+                    continue
+                members = [(stage, [
+                    'schema-{}.cql'.format(keyspace),
+                    '{}.stats'.format(keyspace)
+                ]), (os.path.join(self.data_dir, 'data'),
+                     self._snapshot_paths(keyspace, tag))]
+                key = '{}-data/{}/{}.tar.{}.gpg'.format(
+                    self.datatype, timestamp, keyspace, self.codec)
+                if not self.upload_tarball(client, key, members):
+                    return False
+            if self.dedup:
+                return self._backup_dedup(client, timestamp, tag, keyspaces,
+                                          stage)
+        except OSError as error:
+            logging.error(error)
+            return False
+        finally:
+            execute_cmd(['nodetool', 'clearsnapshot', '-t', tag])
+            shutil.rmtree(stage, ignore_errors=True)
+        return True
+
+    # pylint: disable=too-many-locals
+    @profiled('verify_data')
     def verify_data(self):
         """ Verify restored data """
+        # pylint: disable=no-name-in-module
+        from cassandra import OperationTimedOut, ReadFailure
+
         logging.info('Verifying data')
         with open(self.keyspaces_path) as kpath:
             keyspaces = [key.strip('\n') for key in kpath.readlines()]
             kpath.close()
 
-        if os.getenv('CASSANDRA_USERNAME') is None or os.getenv(
-                'CASSANDRA_PASSWORD') is None:
-            logging.error('Cassandra credentials are None')
-            return False
-
-        cluster = Cluster(contact_points=[self.HOST],
-                          load_balancing_policy=DCAwareRoundRobinPolicy(
-                              local_dc='datacenter1'),
-                          port=self.PORT,
-                          auth_provider=PlainTextAuthProvider(
-                              username=os.getenv('CASSANDRA_USERNAME'),
-                              password=os.getenv('CASSANDRA_PASSWORD')),
-                          protocol_version=3,
-                          ssl_options={'check_hostname': False})
-        if not cluster:
+        session = self._session()
+        if session is None:
             logging.error('Unable to connect to cassandra')
             return False
 
+        keyspaces = [
+            keyspace for keyspace in keyspaces if self.selected(keyspace)
+        ]
         logging.info('Verifying data for %s', ','.join(keyspaces))
-        session = cluster.connect()
         try:
             for keyspace in keyspaces:
-                path = os.path.join(self.BACKUP_DIR, keyspace + '.stats')
+                path = os.path.join(self.backup_dir, keyspace + '.stats')
                 with open(path) as stats:
                     for line in stats.readlines():
                         tbl, rows = line.split()
+                        if not self.selected(*tbl.split('.', 1)):
+                            continue
                         expected_rows = int(rows)
                         query = 'SELECT COUNT(*) FROM {};'.format(tbl)
                         try:
+                            start = time.monotonic()
                             results = session.execute(query)
                             actual_rows = int(results.one().count)
-                            if not row_count_ok(tbl, expected_rows,
-                                                actual_rows):
-                                logging.error(
-                                    'Row count for %s differ too much (expected=%d, actual=%d)',
-                                    tbl, expected_rows, actual_rows)
-                            logging.info('%s OK', tbl)
+                            self.record_row_count(tbl, expected_rows,
+                                                  actual_rows,
+                                                  time.monotonic() - start)
                         except (OperationTimedOut, ReadFailure) as error:
                             logging.error('Failed to execute query: %s: %s',
                                           query, error)
@@ -426,28 +2764,699 @@ class CassandraData(DataSource):
         except OSError as error:
             logging.error(error)
             return False
-        session.shutdown()
 
         return True
 
-    def cleanup(self):
-        """ Cleanup """
-        logging.info('Cleanup')
+
+class PostgresData(DataSource):
+    """ PostgreSQL Data Source """
+    DATA_DIR = '/var/lib/postgresql'
+    BACKUP_DIR = os.path.join(DATA_DIR, 'postgres-data')
+    # The tarballs are decrypted while they are extracted, and pg_restore
+    # loading the dump is the copy phase
+    PHASES = ['download', 'extract', 'copy']
+    STREAM_DECRYPT = True
+
+    def __init__(self, *args, **kwargs):
+        self.datatype = POSTGRES
+        self.jobs = kwargs.get('jobs') or RESTORE_JOBS
+        super().__init__(*args, **kwargs)
+
+    def selected(self, dbname):
+        """ Whether the database is selected by the database filter """
+        return not self.databases or dbname in self.databases
+
+    def dbname(self, key):
+        """ Name of the database backed up in the tarball at key """
+        return tarball_name(os.path.basename(key))
+
+    def get_last_backup_keys(self, objs):
+        """ Return the tarballs of the databases in the last backup directory """
+        dirs = {}
+        for key in objs:
+            if key.endswith('.gpg') and tarball_codec(key):
+                dirs.setdefault(os.path.dirname(key), []).append(key)
+        if not dirs:
+            return []
+        dirname = max(dirs,
+                      key=lambda key: datetime.strptime(
+                          key.split('/')[1], '%Y-%m-%d_%H-%M-%S'))
+        return sorted(key for key in dirs[dirname]
+                      if self.selected(self.dbname(key)))
+
+    @profiled('restore_data')
+    def restore_data(self):
+        """ Restore the databases from their directory-format dumps """
+        tarballs = sorted(
+            path for path in pathlib.Path(self.backup_dir).glob('*/*.gpg')
+            if tarball_codec(path.name))
+        if not tarballs:
+            logging.error('No backup found in %s', self.backup_dir)
+            return False
+        for etarball in tarballs:
+            dbname = self.dbname(etarball.name)
+            if not self.selected(dbname):
+                continue
+            start = time.monotonic()
+            if not extract_encrypted(etarball, self.backup_dir):
+                return False
+            self.record_throughput('extract',
+                                   etarball.stat().st_size,
+                                   time.monotonic() - start,
+                                   object=os.fspath(etarball))
+
+            dump = os.path.join(self.backup_dir, dbname)
+            logging.info('Restoring database %s', dbname)
+            start = time.monotonic()
+            for cmd in [['dropdb', '--if-exists', dbname],
+                        ['createdb', dbname],
+                        [
+                            'pg_restore', '--jobs',
+                            str(self.jobs), '--dbname', dbname, dump
+                        ]]:
+                logging.info(cmd)
+                if not execute_cmd(cmd):
+                    return False
+            self.record_throughput('copy',
+                                   sum(path.stat().st_size
+                                       for path in pathlib.Path(dump).iterdir()),
+                                   time.monotonic() - start,
+                                   database=dbname)
+            shutil.rmtree(dump)
+        logging.info('Restoring data DONE')
+        return True
+
+    @profiled('verify_data')
+    def verify_data(self):
+        """ Verify restored data, counting the rows of jobs tables at a time """
+        import psycopg2
+        from psycopg2 import sql
+
+        logging.info('Verifying data')
+        tables = []
         try:
-            shutil.rmtree(self.BACKUP_DIR)
+            for stats_path in sorted(
+                    pathlib.Path(self.backup_dir).glob('*.stats')):
+                dbname = stats_path.name[:-len('.stats')]
+                if not self.selected(dbname):
+                    continue
+                with open(stats_path) as stats:
+                    for line in stats.readlines():
+                        tbl, rows = line.split()
+                        tables.append((dbname, tbl, int(rows)))
         except OSError as error:
-            logging.error('Cannot delete %s: %s', self.BACKUP_DIR, error)
+            logging.error(error)
+            return False
+
+        # A connection per database and thread; a connection runs one query
+        # at a time
+        local = threading.local()
+        connections = []
+        lock = threading.Lock()
+
+        def count(table):
+            dbname, tbl, _ = table
+            conns = getattr(local, 'connections', None)
+            if conns is None:
+                conns = local.connections = {}
+            if dbname not in conns:
+                conns[dbname] = psycopg2.connect(dbname=dbname)
+                with lock:
+                    connections.append(conns[dbname])
+            query = sql.SQL('SELECT COUNT(*) FROM {}').format(
+                sql.Identifier(*tbl.split('.', 1)))
+            start = time.monotonic()
+            with conns[dbname].cursor() as cursor:
+                cursor.execute(query)
+                actual_rows = cursor.fetchone()[0]
+            return actual_rows, time.monotonic() - start
+
+        logging.info('Verifying %d tables', len(tables))
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                counts = list(pool.map(count, tables))
+        except psycopg2.Error as error:
+            logging.error('Failed to count rows: %s', error)
+            return False
+        finally:
+            for conn in connections:
+                conn.close()
+
+        ret = True
+        for (dbname, tbl, expected_rows), (actual_rows, seconds) in zip(
+                tables, counts):
+            if not self.record_row_count('{}.{}'.format(dbname, tbl),
+                                         expected_rows, actual_rows, seconds):
+                ret = False
+        return ret
+
+
+class ElasticsearchData(DataSource):
+    """ Elasticsearch Data Source """
+    DATA_DIR = '/var/lib/elasticsearch'
+    BACKUP_DIR = os.path.join(DATA_DIR, 'elasticsearch-data')
+    SNAPSHOT = 'snapshot'
+    SNAPSHOT_REPOSITORY = 'restore-backup'
+    # The tarballs are decrypted and loaded in one pass
+    PHASES = ['download', 'extract']
+    STREAM_DECRYPT = True
+
+    def __init__(self, *args, **kwargs):
+        self.datatype = ELASTICSEARCH
+        self.jobs = kwargs.get('jobs') or RESTORE_JOBS
+        self.bulk_size = kwargs.get('bulk_size') or ES_BULK_BYTES
+        self.indices = kwargs.get('indices') or []
+        self.url = urllib.parse.urlsplit(
+            os.environ.get('ELASTICSEARCH_URL', 'http://127.0.0.1:9200'))
+        # One keep-alive connection per thread
+        self.local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def selected(self, index):
+        """ Whether the index is selected by the index filter """
+        return not self.indices or index in self.indices
+
+    def get_last_backup_keys(self, objs):
+        """ Return the tarballs of the indices in the last backup directory """
+        dirs = {}
+        for key in objs:
+            if key.endswith('.gpg') and tarball_codec(key):
+                dirs.setdefault(os.path.dirname(key), []).append(key)
+        if not dirs:
+            return []
+        dirname = max(dirs,
+                      key=lambda key: datetime.strptime(
+                          key.split('/')[1], '%Y-%m-%d_%H-%M-%S'))
+        return sorted(key for key in dirs[dirname]
+                      if self._index(key) == self.SNAPSHOT
+                      or self.selected(self._index(key)))
+
+    def _index(self, key):
+        """ Name of the index backed up in the tarball at key """
+        return tarball_name(os.path.basename(key))
+
+    def _connection(self):
+        """ Return the connection of this thread to the cluster """
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = self.local.connection = http_connection(self.url)
+        return conn
+
+    def _request(self, method, path, body=None, ndjson=False):
+        """ Send a request to the cluster; returns the HTTP status and the
+            decoded JSON response """
+        headers = {
+            'Content-Type':
+            'application/x-ndjson' if ndjson else 'application/json'
+        }
+        username = os.environ.get('ELASTICSEARCH_USERNAME')
+        if username:
+            credentials = '{}:{}'.format(
+                username, os.environ.get('ELASTICSEARCH_PASSWORD', ''))
+            headers['Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode()).decode()
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed the keep-alive connection; reconnect once
+                conn.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+        return response.status, json.loads(data) if data else {}
+
+    def _create_index(self, index, definition):
+        """ Recreate the index with its settings and mappings, with refresh
+            and replicas disabled for the load; returns the settings to put
+            back after it (None for the default) """
+        settings = definition.setdefault('settings', {})
+        # Settings exported by the index settings API are nested in 'index'
+        index_settings = settings.setdefault('index', {})
+        restored = {
+            name: index_settings.pop(name, settings.pop(name, None))
+            for name in ['refresh_interval', 'number_of_replicas']
+        }
+        index_settings.update(refresh_interval='-1', number_of_replicas=0)
+        status, response = self._request('DELETE', '/' + index)
+        if status >= 300 and status != 404:
+            raise RuntimeError('Unable to delete index {}: {}'.format(
+                index, response))
+        status, response = self._request('PUT', '/' + index, definition)
+        if status >= 300:
+            raise RuntimeError('Unable to create index {}: {}'.format(
+                index, response))
+        return restored
+
+    def _restore_settings(self, settings):
+        """ Put the settings of each index loaded back and refresh it;
+            returns True if all of them were """
+        ok = True
+        for index, values in settings.items():
+            try:
+                status, response = self._request(
+                    'PUT', '/{}/_settings'.format(index), {'index': values})
+                if status < 300:
+                    status, response = self._request(
+                        'POST', '/{}/_refresh'.format(index))
+            except (http.client.HTTPException, OSError) as error:
+                status, response = None, error
+            if status is None or status >= 300:
+                logging.error('Unable to restore the settings of %s: %s',
+                              index, response)
+                ok = False
+        return ok
+
+    def _bulk(self, index, docs):
+        """ Index docs, the action and document lines of each document,
+            retrying the documents rejected with 429 with exponential backoff;
+            returns the number of documents that failed """
+        path = '/{}/_bulk'.format(index)
+        backoff = ES_BACKOFF_SECONDS
+        failed = 0
+        for _ in range(ES_BULK_RETRIES + 1):
+            status, response = self._request('POST',
+                                             path,
+                                             b''.join(docs),
+                                             ndjson=True)
+            retry = []
+            if status == 429:
+                retry = docs
+            elif status >= 300:
+                logging.error('Bulk request to %s failed: %s', index, response)
+                return failed + len(docs)
+            elif response.get('errors'):
+                for doc, item in zip(docs, response['items']):
+                    result = next(iter(item.values()))
+                    if result.get('status') == 429:
+                        retry.append(doc)
+                    elif result.get('status', 500) >= 300:
+                        if not failed:
+                            logging.error('Failed to index into %s: %s', index,
+                                          result.get('error'))
+                        failed += 1
+            if not retry:
+                return failed
+            logging.debug('%d documents rejected by %s, retrying in %ds',
+                          len(retry), index, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, ES_BACKOFF_MAX_SECONDS)
+            docs = retry
+        logging.error('%d documents still rejected by %s after %d retries',
+                      len(docs), index, ES_BULK_RETRIES)
+        return failed + len(docs)
+
+    def _load(self, etarball):
+        """ Stream the encrypted tarball of an index through gpg and its
+            decompressor into bulk requests sent by jobs workers; returns True
+            if every document was indexed """
+        with open(etarball, 'rb') as efh:
+            gpg = gpg_decrypt_process(stdin=efh)
+        if gpg is None:
+            return False
+        unzip = decompress_process(tarball_codec(etarball.name), gpg.stdout)
+        # The decompressor holds the read end of the pipe now
+        gpg.stdout.close()
+        # The settings to put back on each index created
+        settings = {}
+        futures = []
+        # Bound the bulk requests in flight, and so the memory used
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+
+        def submit(pool, index, docs):
+            slots.acquire()
+            future = pool.submit(self._bulk, index, docs)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        ok = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool, \
+                    tarfile.open(fileobj=unzip.stdout, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    name = member.name
+                    index = name.split('/')[0]
+                    if name.endswith('.stats') and '/' not in name:
+                        with open(os.path.join(self.backup_dir, name),
+                                  'wb') as sfh:
+                            shutil.copyfileobj(tar.extractfile(member), sfh)
+                    elif name.endswith('/index.json'):
+                        settings[index] = self._create_index(
+                            index, json.load(tar.extractfile(member)))
+                    elif name.endswith('.ndjson'):
+                        if index not in settings:
+                            settings[index] = self._create_index(index, {})
+                        docs = []
+                        size = 0
+                        lines = tar.extractfile(member)
+                        for action in lines:
+                            doc = action + lines.readline()
+                            docs.append(doc)
+                            size += len(doc)
+                            if size >= self.bulk_size:
+                                submit(pool, index, docs)
+                                docs = []
+                                size = 0
+                        if docs:
+                            submit(pool, index, docs)
+            failed = sum(future.result() for future in futures)
+            if failed:
+                logging.error('%d documents of %s not indexed', failed,
+                              etarball)
+                ok = False
+        except (tarfile.TarError, EOFError, ValueError) as error:
+            logging.error('Unable to read %s: %s', etarball, error)
+            ok = False
+        except (http.client.HTTPException, OSError, RuntimeError) as error:
+            logging.error('Failed to restore %s: %s', etarball, error)
+            ok = False
+        finally:
+            # Even after a failure, so that no index is left without refresh
+            # and replicas
+            ok = self._restore_settings(settings) and ok
+            unzip.stdout.close()
+            unzip_stderr = process_errors(unzip)
+            stderr = process_errors(gpg)
+        if gpg.returncode != 0:
+            logging.error('Failed to decrypt %s: %s', etarball, stderr)
+            return False
+        if unzip.returncode != 0:
+            logging.error('Failed to decompress %s: %s', etarball,
+                          unzip_stderr)
+            return False
+        return ok
+
+    def _restore_snapshot(self, etarball):
+        """ Restore the selected indices from the last snapshot of the
+            snapshot repository in the encrypted tarball """
+        if not extract_encrypted(etarball, self.backup_dir):
+            return False
+        repository = '/_snapshot/' + self.SNAPSHOT_REPOSITORY
+        try:
+            status, response = self._request(
+                'PUT', repository, {
+                    'type': 'fs',
+                    'settings': {
+                        'location': os.path.join(self.backup_dir,
+                                                 self.SNAPSHOT),
+                        'readonly': True
+                    }
+                })
+            if status >= 300:
+                logging.error('Unable to register snapshot repository: %s',
+                              response)
+                return False
+            status, response = self._request('GET', repository + '/_all')
+            snapshots = response.get('snapshots') if status < 300 else None
+            if not snapshots:
+                logging.error('No snapshot found in %s: %s', etarball,
+                              response)
+                return False
+            snapshot = snapshots[-1]
+            indices = [
+                index for index in snapshot['indices']
+                if not index.startswith('.') and self.selected(index)
+            ]
+            logging.info('Restoring %s from snapshot %s', ','.join(indices),
+                         snapshot['snapshot'])
+            for index in indices:
+                self._request('DELETE', '/' + index)
+            status, response = self._request(
+                'POST', '{}/{}/_restore?wait_for_completion=true'.format(
+                    repository, snapshot['snapshot']), {
+                        'indices': ','.join(indices),
+                        'include_global_state': False
+                    })
+            if status >= 300:
+                logging.error('Failed to restore snapshot %s: %s',
+                              snapshot['snapshot'], response)
+                return False
+            self._request('DELETE', repository)
+        except (http.client.HTTPException, OSError) as error:
+            logging.error('Failed to restore %s: %s', etarball, error)
+            return False
+        return True
+
+    @profiled('restore_data')
+    def restore_data(self):
+        """ Restore the indices from their tarballs """
+        tarballs = sorted(
+            path for path in pathlib.Path(self.backup_dir).glob('*/*.gpg')
+            if tarball_codec(path.name))
+        if not tarballs:
+            logging.error('No backup found in %s', self.backup_dir)
+            return False
+        for etarball in tarballs:
+            index = self._index(etarball.name)
+            start = time.monotonic()
+            if index == self.SNAPSHOT:
+                if not self._restore_snapshot(etarball):
+                    return False
+            elif self.selected(index):
+                logging.info('Restoring index %s', index)
+                if not self._load(etarball):
+                    return False
+            else:
+                continue
+            self.record_throughput('extract',
+                                   etarball.stat().st_size,
+                                   time.monotonic() - start,
+                                   object=os.fspath(etarball))
+        logging.info('Restoring data DONE')
+        return True
+
+    @profiled('verify_data')
+    def verify_data(self):
+        """ Verify the document count of the restored indices """
+        logging.info('Verifying data')
+        ret = True
+        try:
+            for stats_path in sorted(
+                    pathlib.Path(self.backup_dir).glob('*.stats')):
+                with open(stats_path) as stats:
+                    for line in stats.readlines():
+                        index, count = line.split()
+                        if not self.selected(index):
+                            continue
+                        start = time.monotonic()
+                        status, response = self._request(
+                            'GET', '/{}/_count'.format(index))
+                        if status >= 300:
+                            logging.error('Failed to count %s: %s', index,
+                                          response)
+                            return False
+                        if not self.record_row_count(
+                                index, int(count), response['count'],
+                                time.monotonic() - start):
+                            ret = False
+        except (http.client.HTTPException, OSError) as error:
+            logging.error(error)
+            return False
+        return ret
+
+
+class VaultData(DataSource):
+    """ Vault raft snapshot Data Source """
+    DATA_DIR = '/var/lib/vault'
+    BACKUP_DIR = os.path.join(DATA_DIR, 'vault-data')
+    SNAPSHOT = 'raft.snap.gpg'
+    METADATA = 'kv-metadata.json.gpg'
+    # The snapshot is decrypted and sent to vault in one pass
+    PHASES = ['download', 'extract']
+    STREAM_DECRYPT = True
+
+    def __init__(self, *args, **kwargs):
+        self.datatype = VAULT
+        self.url = urllib.parse.urlsplit(
+            os.environ.get('VAULT_ADDR', 'https://127.0.0.1:8200'))
+        super().__init__(*args, **kwargs)
+
+    def get_last_backup_keys(self, objs):
+        """ Return the snapshot and KV metadata of the last backup """
+        dirs = [
+            os.path.dirname(key) for key in objs
+            if os.path.basename(key) == self.SNAPSHOT
+        ]
+        if not dirs:
+            return []
+        dirname = max(dirs,
+                      key=lambda key: datetime.strptime(
+                          key.split('/')[1], '%Y-%m-%d_%H-%M-%S'))
+        keys = [os.path.join(dirname, self.SNAPSHOT)]
+        if os.path.join(dirname, self.METADATA) in objs:
+            keys.append(os.path.join(dirname, self.METADATA))
+        return keys
+
+    def _last(self, name):
+        """ Path of the last downloaded file called name, None if there is
+            none """
+        paths = sorted(pathlib.Path(self.backup_dir).glob('*/' + name))
+        return paths[-1] if paths else None
+
+    def _request(self, method, path, body=None, chunked=False):
+        """ Send a request to vault; returns the HTTP status and the decoded
+            JSON response """
+        token = os.environ.get('VAULT_TOKEN')
+        if token is None:
+            raise RuntimeError('VAULT_TOKEN is not set')
+        conn = http_connection(self.url, os.environ.get('VAULT_CACERT'))
+        try:
+            conn.request(method,
+                         '/v1/' + path,
+                         body=body,
+                         headers={'X-Vault-Token': token},
+                         encode_chunked=chunked)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        return response.status, json.loads(data) if data else {}
+
+    @profiled('restore_data')
+    def restore_data(self):
+        """ Stream the decrypted raft snapshot into vault """
+        snapshot = self._last(self.SNAPSHOT)
+        if snapshot is None:
+            logging.error('No snapshot found in %s', self.backup_dir)
+            return False
+        with open(snapshot, 'rb') as sfh:
+            gpg = gpg_decrypt_process(stdin=sfh)
+        if gpg is None:
             return False
+
+        def chunks():
+            while True:
+                chunk = gpg.stdout.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        logging.info('Restoring %s', snapshot)
+        start = time.monotonic()
+        try:
+            status, response = self._request('POST',
+                                             'sys/storage/raft/snapshot-force',
+                                             chunks(),
+                                             chunked=True)
+        except (http.client.HTTPException, OSError, RuntimeError) as error:
+            logging.error('Failed to restore %s: %s', snapshot, error)
+            return False
+        finally:
+            gpg.stdout.close()
+            stderr = process_errors(gpg)
+        if gpg.returncode != 0:
+            logging.error('Failed to decrypt %s: %s', snapshot, stderr)
+            return False
+        if status >= 300:
+            logging.error('Failed to restore %s: %s', snapshot, response)
+            return False
+        self.record_throughput('extract',
+                               snapshot.stat().st_size,
+                               time.monotonic() - start,
+                               object=os.fspath(snapshot))
+        logging.info('Restoring data DONE')
         return True
 
+    def _wait_ready(self):
+        """ Wait for vault to be unsealed and active after the restore """
+        deadline = time.monotonic() + VAULT_READY_TIMEOUT
+        while True:
+            try:
+                status, _ = self._request('GET', 'sys/health')
+                if status == 200:
+                    return True
+            except (http.client.HTTPException, OSError):
+                status = None
+            if time.monotonic() > deadline:
+                logging.error('Vault not ready after %ds (status %s)',
+                              VAULT_READY_TIMEOUT, status)
+                return False
+            time.sleep(1)
+
+    @profiled('verify_data')
+    def verify_data(self):
+        """ Compare the KV versions of a sample of secrets with the metadata
+            of the backup """
+        logging.info('Verifying data')
+        path = self._last(self.METADATA)
+        if path is None:
+            logging.error('No KV metadata found in %s', self.backup_dir)
+            return False
+        with open(path, 'rb') as mfh:
+            gpg = gpg_decrypt_process(stdin=mfh)
+        if gpg is None:
+            return False
+        data, _ = gpg.communicate()
+        stderr = process_errors(gpg)
+        if gpg.returncode != 0:
+            logging.error('Failed to decrypt %s: %s', path, stderr)
+            return False
+        try:
+            metadata = json.loads(data)
+        except ValueError as error:
+            logging.error('Invalid KV metadata %s: %s', path, error)
+            return False
+
+        try:
+            if not self._wait_ready():
+                return False
+            versions = metadata['versions']
+            sample = random.sample(sorted(versions),
+                                   min(VAULT_VERIFY_SAMPLE, len(versions)))
+            logging.info('Verifying %d of %d secrets', len(sample),
+                         len(versions))
+            mismatches = 0
+            seconds = 0.0
+            for secret in sample:
+                start = time.monotonic()
+                status, response = self._request(
+                    'GET', '{}/metadata/{}'.format(metadata['mount'],
+                                                   urllib.parse.quote(secret)))
+                seconds += time.monotonic() - start
+                version = response.get('data', {}).get(
+                    'current_version') if status == 200 else None
+                if version != versions[secret]:
+                    logging.error(
+                        'Version of %s differs (expected=%s, actual=%s)',
+                        secret, versions[secret], version)
+                    mismatches += 1
+                else:
+                    logging.info('%s OK', secret)
+            # The paths of the secrets are a new random sample each run, and
+            # are not to be published: one mean latency for the mount
+            if sample:
+                METRICS.add('restore_verify_query_seconds',
+                            seconds / len(sample),
+                            table=metadata['mount'])
+        except (http.client.HTTPException, OSError, RuntimeError,
+                KeyError) as error:
+            logging.error('Failed to verify secrets: %s', error)
+            return False
+        return mismatches == 0
+
 
 class BackupClient(ABC):
     """ Generic backup client abstraction """
+    # Keys deleted per request
+    DELETE_BATCH = 1000
+
     def __init__(self, *args, **kwargs):  #pylint: disable=unused-argument
         self.datasource = None
         self.storage_client = None
         self.backups = {}
+        self.sizes = {}
         self.idx = 0
+        self.use_async = kwargs.get('async_io', False)
+        self.concurrency = kwargs.get('concurrency', DOWNLOAD_CONCURRENCY)
+        self.upload_slots = threading.Semaphore(self.concurrency)
         if 'datatype' not in kwargs:
             logging.error('Need datatype to initialize backup client.')
             sys.exit(1)
@@ -456,29 +3465,205 @@ class BackupClient(ABC):
             self.datasource = InfluxData(*args, **kwargs)
         elif datatype == CASSANDRA:
             self.datasource = CassandraData(*args, **kwargs)
+        elif datatype == POSTGRES:
+            self.datasource = PostgresData(*args, **kwargs)
+        elif datatype == ELASTICSEARCH:
+            self.datasource = ElasticsearchData(*args, **kwargs)
+        elif datatype == VAULT:
+            self.datasource = VaultData(*args, **kwargs)
         else:
             logging.error('Unsupported datatype: %s', self.datasource.datatype)
             sys.exit(1)
+        self.datasource.storage = self
 
     def __iter__(self):
         self.idx = 0
         return self
 
-    def __next__(self):
-        if self.idx < len(self.backups):
-            item = self.backups[self.idx]
-            self.idx += 1
-            return item
-        raise StopIteration
+    def __next__(self):
+        if self.idx < len(self.backups):
+            item = self.backups[self.idx]
+            self.idx += 1
+            return item
+        raise StopIteration
+
+    def __len__(self):
+        return len(self.backups)
+
+    def __getitem__(self, idx):
+        return self.backups[idx]
+
+    def _download(self, path):
+        """ Download the given path from storage backend """
+
+    def _list(self, prefix):
+        """ Yield (key, last modified timestamp, size) of the objects under
+            prefix in the storage backend """
+
+    def read_chunks(self, key):
+        """ Yield the content of the object at key in chunks """
+        raise NotImplementedError
+
+    def checksum(self, key):
+        """ Return the ObjectChecksum of the object at key """
+        return ObjectChecksum()
+
+    def upload(self, key, stream):
+        """ Upload stream (an EncryptedStream) to key in the storage backend;
+            returns the number of bytes uploaded, None if the upload failed """
+        raise NotImplementedError
+
+    def _upload_parts(self, stream, upload_part):
+        """ Read stream in parts of UPLOAD_PART_SIZE and upload each of them
+            with upload_part(number, data), --concurrency parts at a time,
+            while the next parts are read; returns the results of
+            upload_part in order, the size and the MD5 of the stream. Raises
+            OSError if the stream did not complete. """
+        # Shared by concurrent uploads, so that at most --concurrency parts
+        # are held in memory in all
+        slots = self.upload_slots
+        md5 = hashlib.md5()
+        size = 0
+        futures = []
+
+        def run(number, data):
+            try:
+                return upload_part(number, data)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            number = 0
+            while True:
+                data = stream.read(UPLOAD_PART_SIZE)
+                if not data and number:
+                    break
+                number += 1
+                md5.update(data)
+                size += len(data)
+                slots.acquire()
+                if any(future.done() and future.exception()
+                       for future in futures):
+                    slots.release()
+                    break
+                futures.append(pool.submit(run, number, data))
+                if len(data) < UPLOAD_PART_SIZE:
+                    break
+            results = [future.result() for future in futures]
+        if not stream.wait():
+            raise OSError('the backup stream failed')
+        return results, size, md5
+
+    def _list_prefixes(self, prefix):
+        """ Delimiter listing of prefix: returns the sub-prefixes directly
+            under prefix, and [(key, last modified timestamp, size)] of the
+            objects directly under it """
+        raise NotImplementedError
+
+    def _list_sharded(self, prefix):
+        """ List the sub-prefixes of prefix concurrently and merge them """
+        prefixes, listing = self._list_prefixes(prefix)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for shard in pool.map(lambda sub: list(self._list(sub)),
+                                  prefixes):
+                listing.extend(shard)
+        logging.debug('Listed %d objects in %d prefixes', len(listing),
+                      len(prefixes))
+        return listing
+
+    def async_storage(self):
+        """ Return the AsyncStorage for the storage backend """
+        raise NotImplementedError
+
+    def list_objects(self, prefix):
+        """ Return [(key, last modified timestamp, size)] of the objects
+            under prefix """
+        return self._list_sharded(prefix)
+
+    def list_keys(self, prefix):
+        """ Return the set of keys under prefix """
+        return {key for key, _, _ in self.list_objects(prefix)}
+
+    def _delete_batch(self, keys):
+        """ Delete keys, at most DELETE_BATCH of them, in one request;
+            returns the keys that could not be deleted """
+        raise NotImplementedError
+
+    @profiled('delete')
+    def delete_keys(self, keys):
+        """ Delete keys in batches of DELETE_BATCH, --concurrency batches at
+            a time; returns the keys that could not be deleted """
+        keys = sorted(keys)
+        batches = [
+            keys[idx:idx + self.DELETE_BATCH]
+            for idx in range(0, len(keys), self.DELETE_BATCH)
+        ]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            failed = [
+                key for batch in pool.map(self._delete_batch, batches)
+                for key in batch
+            ]
+        for key in set(keys) - set(failed):
+            self.backups.pop(key, None)
+            self.sizes.pop(key, None)
+        return failed
+
+    @profiled('list')
+    def _get_backups(self):
+        """ Retrieve list of backups from the datasource """
+        pfx = self.datasource.datatype + '-data/'
+        if self.use_async:
+            listing = asyncio.run(self._list_async(pfx))
+        else:
+            listing = self._list_sharded(pfx)
+        self.backups = {}
+        self.sizes = {}
+        for key, timestamp, size in listing:
+            self.backups.update({key: timestamp})
+            self.sizes.update({key: size})
+
+    async def _list_async(self, prefix):
+        """ List the sub-prefixes of prefix concurrently with the asyncio
+            backend """
+        async with self.async_storage() as storage:
+            prefixes, listing = await storage.list_prefixes(prefix)
+            return listing + await storage.list_many(prefixes)
 
-    def __len__(self):
-        return len(self.backups)
+    async def _download_async(self, keys):
+        """ Download the keys concurrently with the asyncio backend """
+        async with self.async_storage() as storage:
+            return await storage.download_many(keys, self.datasource)
 
-    def __getitem__(self, idx):
-        return self.backups[idx]
+    @profiled('download')
+    def download_last_backup(self):
+        """ Download the last backups to the working directory, --concurrency
+            objects at a time, and return list of filenames """
+        keys = self.get_last_backup_keys()
+        if self.use_async:
+            for key in keys:
+                if key not in self.backups:
+                    logging.error('Backup %s not found.', key)
+                    return []
+            return asyncio.run(self._download_async(keys))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(self._download, keys))
 
-    def _download(self, path):
-        """ Download the given path from storage backend """
+    def _lookup(self, keys):
+        """ Add the keys out of the listing of the datatype prefix (the
+            SSTable files of deduplicated backups) to the backups, with one
+            listing of their common prefix """
+        missing = {key for key in keys if key not in self.backups}
+        if not missing:
+            return
+        prefix = os.path.commonprefix(sorted(missing))
+        if self.use_async:
+            listing = asyncio.run(self._list_async(prefix))
+        else:
+            listing = self.list_objects(prefix)
+        for key, timestamp, size in listing:
+            if key in missing:
+                self.backups[key] = timestamp
+                self.sizes[key] = size
 
     def get_last_backup_keys(self):
         """ Get last backups for the type of backup:
@@ -489,16 +3674,85 @@ class BackupClient(ABC):
             In both cases, the last backups will return a list of tarballs to be
             downloaded
         """
-        return self.datasource.get_last_backup_keys(self.backups)
+        keys = self.datasource.get_last_backup_keys(self.backups)
+        self._lookup(keys)
+        return keys
 
     def restore(self):
         """ Restore data from the tarballs """
         return self.datasource.restore()
 
+    def plan(self, action=None):
+        """ Estimate the space and time needed to restore the last backups,
+            or with action ('restore_keyspaces' or 'restore'), the space
+            needed by that step of a restore downloaded already. Returns the
+            list of tarballs with their compressed, decrypted and extracted
+            sizes, the space needed per filesystem and the ETA (None if there
+            is no throughput history yet).
+        """
+        tarballs = []
+        for key in self.get_last_backup_keys():
+            size = self.sizes.get(key)
+            if size is None:
+                logging.warning('Size of %s unknown', key)
+                size = 0
+            tarballs.append({
+                'key': key,
+                'compressed': size,
+                # GPG adds a few bytes of overhead to the gzipped tarball
+                'decrypted': size,
+                'extracted': int(size * EXTRACT_RATIO)
+            })
+        total = {
+            phase: sum(tarball[phase] for tarball in tarballs)
+            for phase in ['compressed', 'decrypted', 'extracted']
+        }
+
+        # The backup directory holds the encrypted and decrypted tarballs and
+        # the extracted files, the data directory receives the restored data
+        datasource = self.datasource
+        backup_size = total['compressed'] + total['decrypted'] + total[
+            'extracted']
+        data_size = total['extracted']
+        if action == 'restore_keyspaces':
+            backup_size, data_size = total['extracted'], 0
+        elif action == 'restore':
+            backup_size = total[
+                'extracted'] if datasource.RESTORE_EXTRACTS else 0
+        filesystems = {}
+        for path, needed in [(datasource.backup_dir, backup_size),
+                             (datasource.data_dir, data_size)]:
+            device, free = free_space(path)
+            fsys = filesystems.setdefault(device, {
+                'paths': [],
+                'free': free,
+                'needed': 0
+            })
+            fsys['paths'].append(path)
+            fsys['needed'] += needed
+
+        eta = 0
+        phase_bytes = {
+            'download': total['compressed'],
+            'decrypt': total['compressed'],
+            'extract': total['decrypted'],
+            'copy': total['extracted']
+        }
+        for phase in datasource.PHASES:
+            rate = datasource.throughput(phase)
+            if rate is None:
+                eta = None
+                break
+            eta += phase_bytes[phase] / rate
+        return tarballs, total, list(filesystems.values()), eta
+
 
 class S3Client(BackupClient):
     """ S3 Client implementation """
     def __init__(self, *args, **kwargs):
+        import boto3
+        from botocore.exceptions import ClientError
+
         super().__init__(*args, **kwargs)
         try:
             s3_resource = boto3.resource('s3')
@@ -509,52 +3763,225 @@ class S3Client(BackupClient):
             logging.error(error)
         self._get_backups()
 
-    def _get_backups(self):
-        """ Retrieve list of backups from the datasource """
-        pfx = self.datasource.datatype + '-data'
-        self.backups = {}
-        for obj in self.backup_bucket.objects.filter(Prefix=pfx):
-            self.backups.update({obj.key: obj.last_modified.timestamp()})
+    def _list(self, prefix):
+        """ List the objects under prefix in the S3 bucket """
+        # Unlike the bucket resource, the client is thread safe
+        paginator = self.backup_bucket.meta.client.get_paginator(
+            'list_objects_v2')
+        for page in paginator.paginate(Bucket=self.backup_bucket.name,
+                                       Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj['LastModified'].timestamp(), obj['Size']
+
+    def _list_prefixes(self, prefix):
+        """ Delimiter listing of prefix in the S3 bucket """
+        prefixes = []
+        listing = []
+        paginator = self.backup_bucket.meta.client.get_paginator(
+            'list_objects_v2')
+        for page in paginator.paginate(Bucket=self.backup_bucket.name,
+                                       Prefix=prefix,
+                                       Delimiter='/'):
+            prefixes.extend(pfx['Prefix']
+                            for pfx in page.get('CommonPrefixes', []))
+            listing.extend(
+                (obj['Key'], obj['LastModified'].timestamp(), obj['Size'])
+                for obj in page.get('Contents', []))
+        return prefixes, listing
+
+    def read_chunks(self, key):
+        """ Stream the object at key from the S3 bucket """
+        response = self.backup_bucket.meta.client.get_object(
+            Bucket=self.backup_bucket.name, Key=key)
+        for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+
+    def checksum(self, key):
+        """ The ETag of the object; the size of its first part is the part
+            size of multipart uploads """
+        return s3_checksum(
+            self.backup_bucket.meta.client.head_object(
+                Bucket=self.backup_bucket.name, Key=key, PartNumber=1))
 
+    def _download_parts(self, key, size, dest):
+        """ Download the object at key to dest part by part in parallel,
+            hashing each part as it is written; returns the status of its
+            checksum """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        client = self.backup_bucket.meta.client
+        checksum = self.checksum(key)
+        part_size = checksum.part_size or size or 1
+        parts = max(1, -(-size // part_size))
+
+        def fetch(number, dfd):
+            first = (number - 1) * part_size
+            length = min(size, first + part_size) - first
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                md5 = hashlib.md5()
+                offset = first
+                try:
+                    # With ChecksumMode, botocore checks the part against
+                    # the checksum S3 keeps for it, if it was uploaded with
+                    # one
+                    kwargs = {'PartNumber': number} if checksum.part_size \
+                        else {}
+                    response = client.get_object(
+                        Bucket=self.backup_bucket.name,
+                        Key=key,
+                        ChecksumMode='ENABLED',
+                        **kwargs)
+                    for chunk in response['Body'].iter_chunks(
+                            DOWNLOAD_CHUNK_SIZE):
+                        os.pwrite(dfd, chunk, offset)
+                        md5.update(chunk)
+                        offset += len(chunk)
+                    if offset - first == length:
+                        return md5.digest()
+                    error = 'got {} of {} bytes'.format(offset - first, length)
+                except (BotoCoreError, ClientError, OSError) as exc:
+                    error = exc
+                logging.warning('Part %d of %s failed (attempt %d): %s',
+                                number, key, attempt, error)
+            raise ChecksumError('part {} of {} failed {} times'.format(
+                number, key, DOWNLOAD_RETRIES))
+
+        with open(dest, 'wb') as dfh:
+            dfh.truncate(size)
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                with ThreadPoolExecutor(
+                        max_workers=min(parts, self.concurrency)) as pool:
+                    digests = list(
+                        pool.map(lambda number: fetch(number, dfh.fileno()),
+                                 range(1, parts + 1)))
+                if checksum.expected is None:
+                    return 'unavailable'
+                if checksum.expected == (multipart_etag(digests)
+                                         if checksum.part_size else
+                                         digests[0].hex()):
+                    return 'ok'
+                # Without a checksum per part, the bad part is unknown
+                logging.warning('%s does not match its ETag (attempt %d)', key,
+                                attempt)
+        raise ChecksumError('{} does not match its ETag {}'.format(
+            key, checksum.expected))
+
+    @profiled('put_object')
+    def upload(self, key, stream):
+        """ Multipart upload of stream to key in the S3 bucket """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        client = self.backup_bucket.meta.client
+        bucket = self.backup_bucket.name
+        try:
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=key)['UploadId']
+        except (BotoCoreError, ClientError) as error:
+            logging.error('Failed to upload %s: %s', key, error)
+            return None
+
+        def upload_part(number, data):
+            response = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=data,
+                ContentMD5=base64.b64encode(
+                    hashlib.md5(data).digest()).decode())
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        try:
+            parts, size, _ = self._upload_parts(stream, upload_part)
+            client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except (BotoCoreError, ClientError, OSError) as error:
+            logging.error('Failed to upload %s: %s', key, error)
+            with contextlib.suppress(BotoCoreError, ClientError):
+                client.abort_multipart_upload(Bucket=bucket,
+                                              Key=key,
+                                              UploadId=upload_id)
+            return None
+        return size
+
+    def _delete_batch(self, keys):
+        """ Delete keys with one DeleteObjects request """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            response = self.backup_bucket.meta.client.delete_objects(
+                Bucket=self.backup_bucket.name,
+                Delete={
+                    'Objects': [{
+                        'Key': key
+                    } for key in keys],
+                    'Quiet': True
+                })
+        except (BotoCoreError, ClientError) as error:
+            logging.error('Failed to delete %d objects: %s', len(keys), error)
+            return keys
+        # Quiet mode only reports the keys that were not deleted
+        errors = response.get('Errors', [])
+        for error in errors:
+            logging.error('Failed to delete %s: %s', error['Key'],
+                          error.get('Message'))
+        return [error['Key'] for error in errors]
+
+    def async_storage(self):
+        """ Return the asyncio S3 backend for the bucket """
+        return AsyncS3Storage(os.environ['S3_BACKUP_BUCKET'], self.concurrency)
+
+    @profiled('get_object')
     def _download(self, path):
         """ Download encrypted blob at the path in S3 storage backend """
-        backups = list(self.backup_bucket.objects.filter(Prefix=path))
-        if not backups:
-            logging.error('Backup %s not found.', path)
-            return None
+        from botocore.exceptions import ClientError
+
+        # The keys listed already need no request, and the bucket resource
+        # is not thread safe
+        if path in self.sizes:
+            blob, size = path, self.sizes[path]
+        else:
+            backups = list(self.backup_bucket.objects.filter(Prefix=path))
+            if not backups:
+                logging.error('Backup %s not found.', path)
+                return None
 
-        assert len(backups) == 1
-        blob = backups[0].key
+            assert len(backups) == 1
+            blob, size = backups[0].key, backups[0].size
+        dest = self.datasource.local_path(blob)
         try:
-            os.makedirs(os.path.dirname(blob))
+            os.makedirs(os.path.dirname(dest))
         except OSError as error:
             if error.errno != errno.EEXIST:
                 raise
 
         try:
-            self.backup_bucket.download_file(blob, blob)
-            logging.info('Downloaded %s (%d bytes)', blob,
-                         os.path.getsize(blob))
-        except ClientError as error:
+            start = time.monotonic()
+            status = self._download_parts(blob, size, dest)
+            logging.info('Downloaded %s (%d bytes, checksum %s)', blob,
+                         os.path.getsize(dest), status)
+            self.datasource.record_throughput('download',
+                                              os.path.getsize(dest),
+                                              time.monotonic() - start,
+                                              object=blob)
+        except (ClientError, ChecksumError, OSError) as error:
             logging.error('Failed to download %s: %s', blob, error)
             return None
-        return blob
-
-    def download_last_backup(self):
-        """ Download the last backups and return list of filenames """
-        try:
-            os.chdir(self.datasource.DATA_DIR)
-        except OSError as error:
-            logging.error('Unable to change directory to %s: %s',
-                          self.datasource.DATA_DIR, error)
-            return []
-        keys = self.datasource.get_last_backup_keys(self.backups)
-        return [self._download(key) for key in keys]
+        return dest
 
 
 class AzureClient(BackupClient):
     """ Azure Client implementation """
+    # Sub-requests per blob batch request
+    DELETE_BATCH = 256
+
     def __init__(self, *args, **kwargs):
+        from azure.storage.blob import BlobServiceClient
+        from azure.core.exceptions import AzureError
+
         super().__init__(*args, **kwargs)
         logging.getLogger('azure').setLevel(logging.WARN)
         try:
@@ -564,76 +3991,510 @@ class AzureClient(BackupClient):
                 az_connection)
             self.storage_client = blob_service_client.get_container_client(
                 az_backup_container)
-        except ClientError as error:
+        except AzureError as error:
             logging.error(error)
         self._get_backups()
 
-    def _get_backups(self):
-        """ Retrieve list of backups from the datasource """
-        pfx = self.datasource.datatype + '-data'
-        self.backups = {}
-        for obj in self.storage_client.list_blobs(name_starts_with=pfx):
-            self.backups.update({obj.name: obj.last_modified.timestamp()})
+    def _list(self, prefix):
+        """ List the blobs under prefix in the Azure container """
+        for obj in self.storage_client.list_blobs(name_starts_with=prefix):
+            yield obj.name, obj.last_modified.timestamp(), obj.size
+
+    def _list_prefixes(self, prefix):
+        """ Delimiter listing of prefix in the Azure container """
+        from azure.storage.blob import BlobPrefix
+
+        prefixes = []
+        listing = []
+        for obj in self.storage_client.walk_blobs(name_starts_with=prefix,
+                                                  delimiter='/'):
+            if isinstance(obj, BlobPrefix):
+                prefixes.append(obj.name)
+            else:
+                listing.append(
+                    (obj.name, obj.last_modified.timestamp(), obj.size))
+        return prefixes, listing
+
+    def read_chunks(self, key):
+        """ Stream the blob at key from the Azure container """
+        stream = self.storage_client.get_blob_client(key).download_blob()
+        for chunk in stream.chunks():
+            yield chunk
+
+    def checksum(self, key):
+        """ The Content-MD5 of the blob, when set at upload """
+        return azure_checksum(
+            self.storage_client.get_blob_client(key).get_blob_properties())
+
+    @profiled('put_object')
+    def upload(self, key, stream):
+        """ Upload stream to key in the Azure container as blocks, committed
+            with the Content-MD5 of the whole blob """
+        from azure.core.exceptions import AzureError
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        blob_client = self.storage_client.get_blob_client(key)
+
+        def upload_part(number, data):
+            block_id = base64.b64encode(
+                '{:08d}'.format(number).encode()).decode()
+            blob_client.stage_block(block_id, data, validate_content=True)
+            return BlobBlock(block_id=block_id)
 
+        try:
+            blocks, size, md5 = self._upload_parts(stream, upload_part)
+            blob_client.commit_block_list(
+                blocks,
+                content_settings=ContentSettings(content_md5=md5.digest()))
+        except (AzureError, OSError) as error:
+            # Uncommitted blocks are discarded by Azure after a week
+            logging.error('Failed to upload %s: %s', key, error)
+            return None
+        return size
+
+    def _delete_batch(self, keys):
+        """ Delete keys with one blob batch request """
+        from azure.core.exceptions import AzureError
+
+        try:
+            responses = list(
+                self.storage_client.delete_blobs(*keys,
+                                                 delete_snapshots='include',
+                                                 raise_on_any_failure=False))
+        except AzureError as error:
+            logging.error('Failed to delete %d blobs: %s', len(keys), error)
+            return keys
+        failed = []
+        for key, response in zip(keys, responses):
+            # A blob already gone is as good as deleted
+            if response.status_code not in (202, 404):
+                logging.error('Failed to delete %s: HTTP %d', key,
+                              response.status_code)
+                failed.append(key)
+        return failed
+
+    def async_storage(self):
+        """ Return the asyncio Azure backend for the container """
+        return AsyncAzureStorage(
+            os.environ.get('AZURE_STORAGE_CONNECTION_STRING'),
+            os.environ.get('AZURE_BLOB_BACKUP_CONTAINER'), self.concurrency)
+
+    @profiled('get_object')
     def _download(self, path):
         """ Download encrypted blob from given path from Azure backend """
-        backups = list(self.storage_client.list_blobs(name_starts_with=path))
+        from azure.core.exceptions import AzureError
 
-        if not backups:
-            logging.error('Backup %s not found.', path)
-            return None
+        # The keys listed already need no request
+        if path in self.backups:
+            blob = path
+        else:
+            backups = list(
+                self.storage_client.list_blobs(name_starts_with=path))
 
-        assert len(backups) == 1
-        blob = backups[0].name
+            if not backups:
+                logging.error('Backup %s not found.', path)
+                return None
+
+            assert len(backups) == 1
+            blob = backups[0].name
+        dest = self.datasource.local_path(blob)
         try:
-            os.makedirs(os.path.dirname(blob))
+            os.makedirs(os.path.dirname(dest))
         except OSError as error:
             if error.errno != errno.EEXIST:
                 raise
 
         try:
+            start = time.monotonic()
             blob_client = self.storage_client.get_blob_client(blob)
-            with open(blob, 'wb') as data:
-                stream = blob_client.download_blob()
-                data.write(stream.readall())
-                data.close()
-            logging.info('Downloaded %s (%d bytes)', blob,
-                         os.path.getsize(blob))
-        except ClientError as error:
+            expected = self.checksum(blob).expected
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                checksum = ObjectChecksum(expected)
+                with open(dest, 'wb') as data:
+                    # Each range is checked against its transactional MD5,
+                    # and downloaded again by the SDK if it does not match
+                    stream = blob_client.download_blob(validate_content=True)
+                    for chunk in stream.chunks():
+                        data.write(chunk)
+                        checksum.update(chunk)
+                if checksum.status != 'mismatch':
+                    break
+                logging.warning('%s does not match its Content-MD5 '
+                                '(attempt %d)', blob, attempt)
+            else:
+                raise ChecksumError('{} does not match its Content-MD5 '
+                                    '{}'.format(blob, expected))
+            logging.info('Downloaded %s (%d bytes, checksum %s)', blob,
+                         os.path.getsize(dest), checksum.status)
+            self.datasource.record_throughput('download',
+                                              os.path.getsize(dest),
+                                              time.monotonic() - start,
+                                              object=blob)
+        except (AzureError, ChecksumError, OSError) as error:
             logging.error('Failed to download %s: %s', blob, error)
             return None
-        return blob
+        return dest
 
-    def download_last_backup(self):
-        """ Download the last backups and return list of filenames """
+
+class FilesystemClient(BackupClient):
+    """ Local filesystem (or NFS mount) client implementation """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.root = os.environ['BACKUP_DIR_PATH']
+        if self.use_async:
+            logging.info('Filesystem backend does not need --async-io')
+            self.use_async = False
+        self._get_backups()
+
+    def _scan(self, prefix):
+        """ Return the sub-prefixes and [(key, last modified timestamp,
+            size)] of the files in the directory at prefix """
+        prefixes = []
+        listing = []
+        try:
+            with os.scandir(os.path.join(self.root, prefix)) as entries:
+                for entry in entries:
+                    key = prefix + entry.name
+                    if entry.is_dir():
+                        prefixes.append(key + '/')
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        listing.append((key, stat.st_mtime, stat.st_size))
+        except FileNotFoundError:
+            pass
+        return prefixes, listing
+
+    def _list(self, prefix):
+        """ List the files under the directory at prefix """
+        prefixes, listing = self._scan(prefix)
+        for entry in listing:
+            yield entry
+        for sub in prefixes:
+            for entry in self._list(sub):
+                yield entry
+
+    def _list_prefixes(self, prefix):
+        """ List the directory at prefix """
+        return self._scan(prefix)
+
+    def read_chunks(self, key):
+        """ Read the file at key in the backup directory """
+        with open(os.path.join(self.root, key), 'rb') as sfh:
+            while True:
+                chunk = sfh.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _delete_batch(self, keys):
+        """ Remove the files at keys, and the directories they leave empty """
+        failed = []
+        for key in keys:
+            path = os.path.join(self.root, key)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logging.error('Failed to delete %s: %s', key, error)
+                failed.append(key)
+                continue
+            # Up to the datatype prefix, which is never removed
+            for _ in range(key.count('/') - 1):
+                path = os.path.dirname(path)
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    break
+        return failed
+
+    @profiled('put_object')
+    def upload(self, key, stream):
+        """ Write stream to key in the backup directory; the file appears
+            under its name only once complete """
+        dest = os.path.join(self.root, key)
+        # Out of the datatype prefixes, so that listings do not see it
+        partial = os.path.join(self.root, '.uploads', key.replace('/', '_'))
         try:
-            os.chdir(self.datasource.DATA_DIR)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.makedirs(os.path.dirname(partial), exist_ok=True)
+            with open(partial, 'wb') as dfh:
+                _, size, _ = self._upload_parts(
+                    stream, lambda number, data: os.pwrite(
+                        dfh.fileno(), data, (number - 1) * UPLOAD_PART_SIZE))
+            os.replace(partial, dest)
         except OSError as error:
-            logging.error('Unable to change directory to %s: %s',
-                          self.datasource.DATA_DIR, error)
-            return []
-        keys = self.datasource.get_last_backup_keys(self.backups)
-        return [self._download(key) for key in keys]
+            logging.error('Failed to upload %s: %s', key, error)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(partial)
+            return None
+        return size
+
+    @profiled('get_object')
+    def _download(self, path):
+        """ Copy the blob at path from the backup directory """
+        src = os.path.join(self.root, path)
+        if not os.path.isfile(src):
+            logging.error('Backup %s not found.', path)
+            return None
+        dest = self.datasource.local_path(path)
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            start = time.monotonic()
+            method = copy_file(src, dest)
+            logging.info('Downloaded %s (%d bytes, %s)', path,
+                         os.path.getsize(dest), method)
+            self.datasource.record_throughput('download',
+                                              os.path.getsize(dest),
+                                              time.monotonic() - start,
+                                              object=path)
+        except OSError as error:
+            logging.error('Failed to download %s: %s', path, error)
+            return None
+        return dest
+
+
+class AsyncStorage(ABC):
+    """ Generic asyncio storage backend. Used as an async context manager,
+        which opens the connection pool shared by all requests. """
+    # Exceptions of the backend library that fail a single request
+    errors = ()
+
+    def __init__(self, concurrency=DOWNLOAD_CONCURRENCY):
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """ Open the connection pool """
+
+    async def close(self):
+        """ Close the connection pool """
+
+    async def list(self, prefix):
+        """ Return [(key, last modified timestamp, size)] of the objects
+            under prefix """
+        raise NotImplementedError
+
+    async def read_chunks(self, key):
+        """ Yield the content of the object at key in chunks """
+        raise NotImplementedError
+        yield  # pylint: disable=unreachable
+
+    async def list_prefixes(self, prefix):
+        """ Delimiter listing of prefix: returns the sub-prefixes directly
+            under prefix, and [(key, last modified timestamp, size)] of the
+            objects directly under it """
+        raise NotImplementedError
+
+    async def list_many(self, prefixes):
+        """ List the prefixes concurrently and merge the listings """
+        async def bounded_list(prefix):
+            async with self.semaphore:
+                return await self.list(prefix)
+
+        listings = await asyncio.gather(
+            *[bounded_list(prefix) for prefix in prefixes])
+        return [entry for listing in listings for entry in listing]
+
+    async def checksum(self, key):
+        """ Return the ObjectChecksum of the object at key """
+        raise NotImplementedError
+
+    async def download(self, key, datasource=None):
+        """ Stream the object at key to its path in the working directory of
+            the datasource (the file of the same name without one), checking
+            it against its checksum on the way; returns the path, None if the
+            download failed """
+        dest = datasource.local_path(key) if datasource else key
+        async with self.semaphore:
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                start = time.monotonic()
+                expected = await self.checksum(key)
+                for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                    checksum = ObjectChecksum(expected.expected,
+                                              expected.part_size)
+                    with open(dest, 'wb') as data:
+                        async for chunk in self.read_chunks(key):
+                            data.write(chunk)
+                            checksum.update(chunk)
+                    if checksum.status != 'mismatch':
+                        break
+                    logging.warning('%s does not match its checksum '
+                                    '(attempt %d)', key, attempt)
+                else:
+                    raise ChecksumError('{} does not match its checksum '
+                                        '{}'.format(key, expected.expected))
+                size = os.path.getsize(dest)
+            except self.errors + (OSError, ChecksumError) as error:
+                logging.error('Failed to download %s: %s', key, error)
+                return None
+        logging.info('Downloaded %s (%d bytes)', key, size)
+        if datasource:
+            datasource.record_throughput('download',
+                                         size,
+                                         time.monotonic() - start,
+                                         object=key)
+        return dest
+
+    async def download_many(self, keys, datasource=None):
+        """ Download the keys concurrently; returns the list of filenames,
+            None for the ones that failed """
+        return await asyncio.gather(
+            *[self.download(key, datasource) for key in keys])
+
+
+class AsyncS3Storage(AsyncStorage):
+    """ asyncio S3 backend (aiobotocore) """
+    def __init__(self, bucket, concurrency=DOWNLOAD_CONCURRENCY):
+        from botocore.exceptions import ClientError
+
+        super().__init__(concurrency)
+        self.errors = (ClientError, )
+        self.bucket = bucket
+        self.context = None
+        self.client = None
+
+    async def open(self):
+        from aiobotocore.session import get_session
+        from botocore.config import Config
 
+        self.context = get_session().create_client(
+            's3', config=Config(max_pool_connections=self.concurrency))
+        self.client = await self.context.__aenter__()
 
-def get_backup_client(dbtype=None):
-    """Determine if we are using AWS or Azure for backups and return a client
-       for that """
-    if all([env in os.environ for env in AWS_VARS]):
-        return S3Client(datatype=dbtype)
+    async def close(self):
+        await self.context.__aexit__(None, None, None)
 
-    if all([env in os.environ for env in AZURE_VARS]):
-        return AzureClient(datatype=dbtype)
+    async def list(self, prefix):
+        listing = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self.bucket,
+                                             Prefix=prefix):
+            for obj in page.get('Contents', []):
+                listing.append((obj['Key'], obj['LastModified'].timestamp(),
+                                obj['Size']))
+        return listing
+
+    async def list_prefixes(self, prefix):
+        prefixes = []
+        listing = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self.bucket,
+                                             Prefix=prefix,
+                                             Delimiter='/'):
+            prefixes.extend(pfx['Prefix']
+                            for pfx in page.get('CommonPrefixes', []))
+            listing.extend(
+                (obj['Key'], obj['LastModified'].timestamp(), obj['Size'])
+                for obj in page.get('Contents', []))
+        return prefixes, listing
+
+    async def checksum(self, key):
+        return s3_checksum(await self.client.head_object(
+            Bucket=self.bucket, Key=key, PartNumber=1))
+
+    async def read_chunks(self, key):
+        response = await self.client.get_object(Bucket=self.bucket, Key=key)
+        async with response['Body'] as stream:
+            while True:
+                chunk = await stream.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class AsyncAzureStorage(AsyncStorage):
+    """ asyncio Azure backend (azure.storage.blob.aio) """
+    def __init__(self,
+                 connection_string,
+                 container,
+                 concurrency=DOWNLOAD_CONCURRENCY):
+        from azure.core.exceptions import AzureError
+
+        super().__init__(concurrency)
+        self.errors = (AzureError, )
+        self.connection_string = connection_string
+        self.container = container
+        self.client = None
+
+    async def open(self):
+        from azure.storage.blob.aio import ContainerClient
+
+        self.client = ContainerClient.from_connection_string(
+            self.connection_string, self.container)
+        await self.client.__aenter__()
+
+    async def close(self):
+        await self.client.__aexit__(None, None, None)
+
+    async def list(self, prefix):
+        listing = []
+        async for blob in self.client.list_blobs(name_starts_with=prefix):
+            listing.append(
+                (blob.name, blob.last_modified.timestamp(), blob.size))
+        return listing
+
+    async def list_prefixes(self, prefix):
+        from azure.storage.blob.aio import BlobPrefix
+
+        prefixes = []
+        listing = []
+        async for obj in self.client.walk_blobs(name_starts_with=prefix,
+                                                delimiter='/'):
+            if isinstance(obj, BlobPrefix):
+                prefixes.append(obj.name)
+            else:
+                listing.append(
+                    (obj.name, obj.last_modified.timestamp(), obj.size))
+        return prefixes, listing
+
+    async def checksum(self, key):
+        return azure_checksum(
+            await self.client.get_blob_client(key).get_blob_properties())
+
+    async def read_chunks(self, key):
+        stream = await self.client.get_blob_client(key).download_blob(
+            validate_content=True)
+        async for chunk in stream.chunks():
+            yield chunk
+
+
+def get_backup_client(dbtype=None, backend=None, **kwargs):
+    """Determine if we are using AWS, Azure or a local filesystem for backups
+       (or use backend, one of BACKENDS) and return a client for that """
+    if backend is None:
+        for name, env_vars in [('aws', AWS_VARS), ('azure', AZURE_VARS),
+                               ('fs', FS_VARS)]:
+            if all([env in os.environ for env in env_vars]):
+                backend = name
+                break
+    if backend == 'aws':
+        return S3Client(datatype=dbtype, **kwargs)
+    if backend == 'azure':
+        return AzureClient(datatype=dbtype, **kwargs)
+    if backend == 'fs':
+        return FilesystemClient(datatype=dbtype, **kwargs)
 
     logging.error('Unknown backup strategy.')
     return None
 
 
+@profiled('decrypt')
 def decrypt(blob):
     """ Decrypt the given blob with the passphrase in environment variable """
+    import gnupg
+
     logging.debug('Decrypting %s', blob)
-    homedir = os.path.join(os.getenv('HOME'), '.gnupg')
-    gpg = gnupg.GPG(gnupghome=homedir, keyring='pubring.kbx')
+    gpg = gnupg.GPG(gnupghome=gnupg_home(), keyring='pubring.kbx')
     public_keys = gpg.list_keys()
     if not public_keys:
         logging.error('No keys found!')
@@ -659,43 +4520,584 @@ def decrypt(blob):
     return None
 
 
+def _feed(client, key, stdin, limiter, checksum, result):
+    """ Stream the object at key into stdin, hashing it on the way """
+    try:
+        for chunk in client.read_chunks(key):
+            limiter.consume(len(chunk))
+            checksum.update(chunk)
+            result['bytes'] += len(chunk)
+            stdin.write(chunk)
+    except BrokenPipeError:
+        # gpg gave up on the stream; its exit status tells why
+        pass
+    except Exception as error:  # pylint: disable=broad-except
+        result['errors'].append('read: {}'.format(error))
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def scrub_object(client, key, limiter):
+    """ Stream the object at key through gpg and a tar reader without
+        writing it to disk; returns its health report """
+    result = {'key': key, 'bytes': 0, 'members': 0, 'errors': []}
+    start = time.monotonic()
+    try:
+        checksum = client.checksum(key)
+    except Exception as error:  # pylint: disable=broad-except
+        checksum = ObjectChecksum()
+        result['errors'].append('checksum: {}'.format(error))
+
+    proc = gpg_decrypt_process()
+    if proc is None:
+        result['errors'].append('decrypt: no passphrase')
+        result['status'] = 'bad'
+        return result
+    feeder = threading.Thread(target=_feed,
+                              args=(client, key, proc.stdin, limiter, checksum,
+                                    result))
+    feeder.start()
+    codec = tarball_codec(key)
+    unzip = None
+    stream = proc.stdout
+    if codec:
+        # The decompressor checks the checksums of the compressed stream
+        unzip = decompress_process(codec, proc.stdout)
+        proc.stdout.close()
+        stream = unzip.stdout
+    try:
+        if codec:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    result['members'] += 1
+                    if member.isfile():
+                        tar.extractfile(member).read()
+        # Other objects (snapshots, manifests, SSTable files) are only
+        # decrypted
+        while stream.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+    except (tarfile.TarError, OSError, EOFError) as error:
+        result['errors'].append('archive: {}'.format(error))
+    stream.close()
+    if unzip is not None:
+        stderr = process_errors(unzip)
+        if unzip.returncode != 0:
+            result['errors'].append('decompress: {}'.format(
+                stderr or unzip.returncode))
+    feeder.join()
+    stderr = process_errors(proc)
+    if proc.returncode != 0:
+        result['errors'].append('decrypt: {}'.format(stderr or
+                                                     proc.returncode))
+    result['expected_checksum'] = checksum.expected
+    result['actual_checksum'] = checksum.hexdigest()
+    result['checksum'] = checksum.status
+    if checksum.status == 'mismatch':
+        result['errors'].append('checksum: {} != {}'.format(
+            result['actual_checksum'], checksum.expected))
+    result['seconds'] = time.monotonic() - start
+    result['status'] = 'bad' if result['errors'] else 'ok'
+    METRICS.transfer('scrub', result['bytes'], result['seconds'], object=key)
+    METRICS.add('restore_scrub_ok', int(result['status'] == 'ok'), object=key)
+    return result
+
+
+def scrub(dbtype, params):
+    """ Scrub recent backups; returns 1 if any of them is bad """
+    with PROFILER.phase('setup'):
+        client = get_backup_client(dbtype,
+                                   async_io=params.async_io,
+                                   concurrency=params.concurrency)
+    if client is None:
+        return 1
+    since = time.time() - params.since_days * 86400
+    keys = sorted(key for key, timestamp in client.backups.items()
+                  if timestamp >= since and key.endswith('.gpg'))
+    logging.info('Scrubbing %d objects', len(keys))
+    limiter = RateLimiter(params.bandwidth * 1024 * 1024 if params.
+                          bandwidth else None)
+    with PROFILER.phase('scrub'):
+        with ThreadPoolExecutor(max_workers=params.concurrency) as pool:
+            results = list(
+                pool.map(lambda key: scrub_object(client, key, limiter),
+                         keys))
+
+    bad = [result for result in results if result['status'] != 'ok']
+    for result in bad:
+        logging.error('%s is bad: %s', result['key'],
+                      '; '.join(result['errors']))
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'datatype': dbtype,
+        'objects': len(results),
+        'bad': len(bad),
+        'results': results
+    }
+    try:
+        with open(params.scrub_report, 'w') as rfh:
+            json.dump(report, rfh, indent=2)
+    except OSError as error:
+        logging.error('Unable to write scrub report: %s', error)
+        return 1
+    print('Scrubbed {} objects ({}), {} bad'.format(
+        len(results), human_size(sum(result['bytes'] for result in results)),
+        len(bad)))
+    return 1 if bad else 0
+
+
+def backup(dbtype, params):
+    """ Back dbtype up to the storage backend; returns 1 if it failed """
+    with PROFILER.phase('setup'):
+        client = get_backup_client(dbtype,
+                                   concurrency=params.concurrency,
+                                   keyspaces=params.keyspace,
+                                   tables=params.table,
+                                   jobs=params.jobs,
+                                   dedup=params.dedup,
+                                   codec=params.codec)
+    if client is None:
+        return 1
+    try:
+        with PROFILER.phase('backup'):
+            ret = client.datasource.backup_data(client)
+    finally:
+        client.datasource.close()
+    return 0 if ret else 1
+
+
+def retained(times, keep_daily, keep_weekly):
+    """ Return the indexes of the backup times (oldest first) that the
+        retention policy keeps: the last one, and the last one of each of the
+        keep_daily last days and of the keep_weekly last weeks with backups """
+    keep = {len(times) - 1} if times else set()
+    for count, period in [(keep_daily, lambda time: time.date()),
+                          (keep_weekly, lambda time: time.isocalendar()[:2])]:
+        periods = set()
+        for idx in range(len(times) - 1, -1, -1):
+            if period(times[idx]) in periods:
+                continue
+            if len(periods) == count:
+                break
+            periods.add(period(times[idx]))
+            keep.add(idx)
+    return keep
+
+
+def prune(dbtype, params):
+    """ Delete the backup sets the retention policy does not keep; returns 1
+        if any of them could not be deleted """
+    with PROFILER.phase('setup'):
+        client = get_backup_client(dbtype, concurrency=params.concurrency)
+    if client is None:
+        return 1
+    datasource = client.datasource
+    points = datasource.restore_points(client.backups)
+    if not points:
+        logging.error('No backups of %s found', dbtype)
+        return 1
+    kept = retained([timestamp for timestamp, _ in points],
+                    params.keep_daily, params.keep_weekly)
+    # An incremental influxdb backup kept keeps its whole chain
+    keep = set()
+    for idx in kept:
+        keep.update(points[idx][1])
+    # A backup is only pruned if some of its objects are deleted
+    pruned = 0
+    for idx, (timestamp, keys) in enumerate(points):
+        if idx in kept:
+            action = 'Keeping'
+        elif keep.issuperset(keys):
+            action = 'Keeping (chain)'
+        else:
+            action = 'Pruning'
+            pruned += 1
+        logging.info('%s backup of %s (%d objects)', action, timestamp,
+                     len(keys))
+    keys = {key for _, backup in points for key in backup} - keep
+    ret = 0
+    with PROFILER.phase('list'):
+        unreferenced = datasource.unreferenced_keys(keep)
+    if unreferenced is None:
+        ret = 1
+        unreferenced = {}
+    keys.update(unreferenced)
+    sizes = {**client.sizes, **unreferenced}
+    size = sum(sizes.get(key, 0) for key in keys)
+    if params.dry_run:
+        print('Would prune {} of {} backups, {} objects ({})'.format(
+            pruned, len(points), len(keys),
+            human_size(size)))
+        return ret
+    with PROFILER.phase('prune'):
+        failed = client.delete_keys(keys)
+    size -= sum(sizes.get(key, 0) for key in failed)
+    METRICS.add('prune_deleted_objects', len(keys) - len(failed))
+    METRICS.add('prune_deleted_bytes', size)
+    print('Pruned {} of {} backups, {} objects ({}), {} failed'.format(
+        pruned, len(points),
+        len(keys) - len(failed), human_size(size), len(failed)))
+    return 1 if failed else ret
+
+
+def node_command(template, node, args):
+    """ Return the command running restore.py with args on node """
+    cmd = []
+    for token in shlex.split(template):
+        if token == '{args}':
+            cmd.extend(args)
+        else:
+            cmd.append(token.format(host=node['host'], rack=node['rack']))
+    return cmd
+
+
+def run_phase(phase, nodes, params, extra=None):
+    """ Run phase on the nodes in parallel, at most rack_concurrency nodes
+        per rack at a time; returns the result of each node """
+    racks = {
+        node['rack']: threading.Semaphore(params.rack_concurrency)
+        for node in nodes
+    }
+    done = []
+    lock = threading.Lock()
+    args = ['--' + phase] + (extra or [])
+    for flag in ['debug', 'verbose']:
+        if getattr(params, flag):
+            args.append('--' + flag)
+    for flag in ['keyspace', 'table']:
+        for value in getattr(params, flag) or []:
+            args += ['--' + flag, value]
+    if params.command_timeout:
+        args += ['--command-timeout', str(params.command_timeout)]
+    args.append(CASSANDRA)
+    # The output of each node is logged as it comes, prefixed with its host;
+    # a node is not timed out, the commands it runs are
+    supervisor = CommandSupervisor(concurrency=len(nodes))
+
+    def run(node):
+        cmd = node_command(params.node_command, node, args)
+        with racks[node['rack']]:
+            logging.debug('%s: %s', node['host'], cmd)
+            start = time.monotonic()
+            returncode = supervisor.submit(cmd, name=node['host']).result()
+            seconds = time.monotonic() - start
+        result = {
+            'host': node['host'],
+            'rack': node['rack'],
+            'phase': phase,
+            'returncode': returncode,
+            'seconds': seconds
+        }
+        METRICS.add('restore_node_phase_seconds',
+                    seconds,
+                    node=node['host'],
+                    phase=phase)
+        METRICS.add('restore_node_phase_success',
+                    int(returncode == 0),
+                    node=node['host'],
+                    phase=phase)
+        with lock:
+            done.append(result)
+            progress = '[{}/{}]'.format(len(done), len(nodes))
+        if returncode:
+            logging.error('%s %s %s (%s) failed in %s', progress, phase,
+                          node['host'], node['rack'], human_duration(seconds))
+        else:
+            logging.info('%s %s %s (%s) OK in %s', progress, phase,
+                         node['host'], node['rack'], human_duration(seconds))
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+            return list(pool.map(run, nodes))
+    finally:
+        supervisor.close()
+
+
+def coordinate(dbtype, params):
+    """ Restore every node of the inventory; returns 1 if a node failed """
+    try:
+        with open(params.inventory) as ifh:
+            nodes = [
+                dict({'rack': 'default'}, **node) for node in json.load(ifh)
+            ]
+    except (OSError, ValueError, TypeError) as error:
+        logging.error('Unable to read inventory %s: %s', params.inventory,
+                      error)
+        return 1
+    if not nodes:
+        logging.error('No node in inventory %s', params.inventory)
+        return 1
+    seed, others = nodes[:1], nodes[1:]
+    logging.info('Restoring %s on %d nodes in %d racks', dbtype, len(nodes),
+                 len(set(node['rack'] for node in nodes)))
+
+    stages = [
+        ('download', nodes, None),
+        ('restore-keyspaces', seed, None),
+        ('restore-keyspaces', others, ['--no-schema']),
+        ('restore', nodes, None),
+        ('refresh', nodes, None),
+        ('verify', seed, None),
+        ('cleanup', others, None),
+    ]
+    results = []
+    ret = 0
+    for phase, stage_nodes, extra in stages:
+        if not stage_nodes:
+            continue
+        print('{}: {} nodes'.format(phase, len(stage_nodes)))
+        with PROFILER.phase(phase):
+            phase_results = run_phase(phase, stage_nodes, params, extra)
+        results.extend(phase_results)
+        failed = [
+            result['host'] for result in phase_results
+            if result['returncode']
+        ]
+        if failed:
+            logging.error('%s failed on %s', phase, ', '.join(failed))
+            ret = 1
+            break
+
+    try:
+        with open(params.coordinate_report, 'w') as rfh:
+            json.dump(
+                {
+                    'timestamp': datetime.now().isoformat(),
+                    'datatype': dbtype,
+                    'nodes': nodes,
+                    'success': ret == 0,
+                    'results': results
+                },
+                rfh,
+                indent=2)
+    except OSError as error:
+        logging.error('Unable to write coordinate report: %s', error)
+        return 1
+    print('Restored {} nodes{}'.format(len(nodes),
+                                       '' if ret == 0 else ' (FAILED)'))
+    return ret
+
+
+def show_plan(client):
+    """ Print the restore plan; returns 1 if there is not enough disk space """
+    tarballs, total, filesystems, eta = client.plan()
+    row = '{:<60} {:>12} {:>12} {:>12}'
+    print(row.format('TARBALL', 'COMPRESSED', 'DECRYPTED', 'EXTRACTED'))
+    for tarball in tarballs + [dict(total, key='TOTAL')]:
+        print(
+            row.format(tarball['key'], human_size(tarball['compressed']),
+                       human_size(tarball['decrypted']),
+                       human_size(tarball['extracted'])))
+    print()
+    ret = 0
+    for fsys in filesystems:
+        enough = fsys['free'] >= fsys['needed']
+        print('{}: {} free, {} needed{}'.format(
+            ', '.join(fsys['paths']), human_size(fsys['free']),
+            human_size(fsys['needed']), '' if enough else ' (INSUFFICIENT)'))
+        if not enough:
+            logging.error('Not enough space in %s to restore',
+                          ', '.join(fsys['paths']))
+            ret = 1
+    if eta is None:
+        print('ETA: unknown (no throughput history yet)')
+    else:
+        print('ETA: {}'.format(human_duration(eta)))
+    return ret
+
+
+class RestoreSession:
+    """ Restore of one datatype from one storage backend (one of BACKENDS,
+        chosen from the environment if None), working in workdir (the backup
+        directory of the datatype if None) rather than in the current
+        directory. The storage client, its listing and the database client
+        are created on first use and kept for the session, so that several
+        sessions can restore different databases concurrently in one
+        process. Other keyword arguments are passed to the datasource
+        (filters, jobs...) and the storage client (async_io, concurrency).
+    """
+    def __init__(self, datatype, backend=None, workdir=None, **kwargs):
+        self.datatype = datatype
+        self.backend = backend
+        self.workdir = workdir
+        self.kwargs = kwargs
+        self._client = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def client(self):
+        """ The storage client, listing the backups on first use """
+        with self.lock:
+            if self._client is None:
+                self._client = get_backup_client(self.datatype,
+                                                 backend=self.backend,
+                                                 workdir=self.workdir,
+                                                 **self.kwargs)
+                if self._client is None:
+                    raise RuntimeError('No storage backend for {}'.format(
+                        self.datatype))
+            return self._client
+
+    def open(self):
+        """ Create the storage client and list the backups """
+        return self.client
+
+    @property
+    def datasource(self):
+        """ The datasource restoring the datatype """
+        return self.client.datasource
+
+    def last_backup_keys(self):
+        """ Return the keys of the last set of backups """
+        return self.client.get_last_backup_keys()
+
+    def plan(self, action=None):
+        """ Return the restore plan, see BackupClient.plan """
+        return self.client.plan(action)
+
+    def check_space(self, action=None):
+        """ Whether each filesystem has the space the restore plan (of the
+            step action, see BackupClient.plan) needs """
+        _, _, filesystems, _ = self.plan(action)
+        ok = True
+        for fsys in filesystems:
+            if fsys['free'] < fsys['needed']:
+                logging.error('Not enough space in %s to restore: %s free, '
+                              '%s needed', ', '.join(fsys['paths']),
+                              human_size(fsys['free']),
+                              human_size(fsys['needed']))
+                ok = False
+        return ok
+
+    def download(self):
+        """ Download the last set of backups to the working directory and
+            decrypt them, --concurrency at a time (unless the datasource
+            decrypts as it restores) """
+        etarballs = self.client.download_last_backup()
+        for etarball in etarballs:
+            if etarball is None or not os.path.exists(etarball):
+                logging.error('%s does not exist', etarball)
+                return False
+        if self.datasource.STREAM_DECRYPT:
+            # Decrypted as it is extracted, by restore_data
+            return True
+        with ThreadPoolExecutor(
+                max_workers=self.client.concurrency) as pool:
+            return all(pool.map(self._decrypt, etarballs))
+
+    def _decrypt(self, etarball):
+        """ Decrypt the downloaded etarball; returns whether it was """
+        start = time.monotonic()
+        if not decrypt(etarball):
+            logging.error('Failed to decrypt %s', etarball)
+            return False
+        self.datasource.record_throughput('decrypt',
+                                          os.path.getsize(etarball),
+                                          time.monotonic() - start,
+                                          object=etarball)
+        return True
+
+    def restore_keyspaces(self):
+        """ Restore the keyspace schemas (cassandra only) """
+        return self.datasource.restore_keyspaces()
+
+    def restore(self):
+        """ Restore the data from the downloaded backups """
+        return self.datasource.restore_data()
+
+    def refresh(self):
+        """ Refresh the restored data (cassandra only) """
+        return self.datasource.refresh_data()
+
+    def verify(self):
+        """ Verify the restored data """
+        return self.datasource.verify_data()
+
+    def cleanup(self):
+        """ Remove the working directory """
+        return self.datasource.cleanup()
+
+    def close(self):
+        """ Close the database client """
+        if self._client is not None:
+            self._client.datasource.close()
+
+
 # pylint: disable=too-many-return-statements,too-many-branches
 def restore(dbtype, params):
     """ Restore data """
-    client = get_backup_client(dbtype)
+    session = RestoreSession(dbtype,
+                             async_io=params.async_io,
+                             concurrency=params.concurrency,
+                             keyspaces=params.keyspace,
+                             tables=params.table,
+                             databases=params.database,
+                             jobs=params.jobs,
+                             indices=params.index,
+                             bulk_size=params.bulk_size,
+                             apply_schema=not params.no_schema,
+                             loader_hosts=params.sstableloader,
+                             loader_throttle=params.loader_throttle)
+    with PROFILER.phase('setup'):
+        try:
+            session.open()
+        except RuntimeError as error:
+            logging.error(error)
+            return 1
+    with session:
+        return _restore(session, params)
+
+
+def _restore(session, params):
+    """ Run the action of params in session """
     if params.show_last:
-        print('\n'.join(client.get_last_backup_keys()))
+        print('\n'.join(session.last_backup_keys()))
         return 0
 
+    if params.plan:
+        return show_plan(session.client)
+
+    # The same check as --plan, for the step run, before anything is
+    # written
+    if params.download or params.restore_keyspaces or params.restore:
+        action = None if params.download else (
+            'restore_keyspaces' if params.restore_keyspaces else 'restore')
+        if not session.check_space(action):
+            return 1
+
     if params.download:
-        encrypted_tarballs = client.download_last_backup()
-        for etarball in encrypted_tarballs:
-            if not os.path.exists(etarball):
-                logging.error('%s does not exist', etarball)
-                return 1
-            if not decrypt(etarball):
-                logging.error('Failed to decrypt %s', etarball)
-                return 1
-        return 0
+        return 0 if session.download() else 1
 
     if params.restore_keyspaces:
-        if not client.datasource.restore_keyspaces():
+        if not session.restore_keyspaces():
             logging.error('Failed to restore keyspaces.')
             return 1
     elif params.restore:
-        if not client.datasource.restore_data():
-            logging.error('Failed to restore %s data.',
-                          client.datasource.datatype)
+        if not session.restore():
+            logging.error('Failed to restore %s data.', session.datatype)
             return 1
     elif params.refresh:
-        if not client.datasource.refresh_data():
+        if not session.refresh():
             logging.error('Failed to refresh keyspaces.')
             return 1
     elif params.verify:
-        if not client.datasource.verify_data():
+        if not session.verify():
             logging.error('Failed to verify restored data.')
             return 1
-        if not client.datasource.cleanup():
+        if not session.cleanup():
+            logging.error('Failed to cleanup temporary files.')
+            return 1
+    elif params.cleanup:
+        if not session.cleanup():
             logging.error('Failed to cleanup temporary files.')
             return 1
     else:
@@ -716,6 +5118,10 @@ def main():
     parser.add_argument('--show-last',
                         action='store_true',
                         help='Show the last available backup')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='Estimate disk space and time needed to restore '
+                        'the last backup')
     parser.add_argument('--download',
                         action='store_true',
                         help='Download last backup specified or as specified')
@@ -728,7 +5134,125 @@ def main():
                         help='Refresh keyspaces (cassandra only).')
     parser.add_argument('--verify',
                         action='store_true',
-                        help='Verify restored data (cassandra only).')
+                        help='Verify restored data.')
+    parser.add_argument('--metrics-file',
+                        default=os.environ.get('RESTORE_METRICS_FILE'),
+                        help='Write metrics to this Prometheus textfile.')
+    parser.add_argument('--metrics-json',
+                        help='Write metrics to this JSON file.')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Time each phase of the restore.')
+    parser.add_argument('--profile-cprofile',
+                        action='store_true',
+                        help='Profile the functions called in each phase.')
+    parser.add_argument('--profile-memory',
+                        action='store_true',
+                        help='Trace memory allocations in each phase.')
+    parser.add_argument('--profile-report',
+                        default='restore-profile.txt',
+                        help='Write the profile report to this file.')
+    parser.add_argument('--async-io',
+                        action='store_true',
+                        help='List and download with the asyncio storage '
+                        'backends.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=DOWNLOAD_CONCURRENCY,
+                        help='Maximum concurrent storage requests.')
+    parser.add_argument('--keyspace',
+                        action='append',
+                        help='Only restore this keyspace (cassandra only).')
+    parser.add_argument('--table',
+                        action='append',
+                        help='Only restore this keyspace.table (cassandra '
+                        'only).')
+    parser.add_argument('--database',
+                        action='append',
+                        help='Only restore this database (influxdb and '
+                        'postgres only).')
+    parser.add_argument('--since-days',
+                        type=float,
+                        default=SCRUB_SINCE_DAYS,
+                        help='Scrub backups from the last SINCE_DAYS days.')
+    parser.add_argument('--bandwidth',
+                        type=float,
+                        help='Limit scrub reads to BANDWIDTH MB/s.')
+    parser.add_argument('--scrub-report',
+                        default='scrub-report.json',
+                        help='Write the scrub health report to this file.')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=RESTORE_JOBS,
+                        help='Parallel jobs of the postgres and '
+                        'elasticsearch restores, and of the influxdb and '
+                        'cassandra count queries.')
+    parser.add_argument('--cleanup',
+                        action='store_true',
+                        help='Remove the downloaded and extracted backups.')
+    parser.add_argument('--no-schema',
+                        action='store_true',
+                        help='Extract the tarballs without applying the '
+                        'keyspace schemas (cassandra only).')
+    parser.add_argument('--inventory',
+                        help='JSON list of the nodes to restore (coordinate '
+                        'only).')
+    parser.add_argument('--node-command',
+                        default=NODE_COMMAND,
+                        help='Command running restore.py on a node '
+                        '(coordinate only).')
+    parser.add_argument('--rack-concurrency',
+                        type=int,
+                        default=1,
+                        help='Nodes of a rack running a phase at a time '
+                        '(coordinate only).')
+    parser.add_argument('--coordinate-report',
+                        default='coordinate-report.json',
+                        help='Write the per-node results to this file.')
+    parser.add_argument('--index',
+                        action='append',
+                        help='Only restore this index (elasticsearch only).')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='Store each SSTable file once, by content '
+                        '(cassandra backup only).')
+    parser.add_argument('--codec',
+                        choices=sorted(CODECS),
+                        default=BACKUP_CODEC,
+                        help='Compress the backup tarballs with this codec '
+                        '(backup only).')
+    parser.add_argument('--keep-daily',
+                        type=int,
+                        default=PRUNE_KEEP_DAILY,
+                        help='Keep the last backup of as many days (prune '
+                        'only).')
+    parser.add_argument('--keep-weekly',
+                        type=int,
+                        default=PRUNE_KEEP_WEEKLY,
+                        help='Keep the last backup of as many weeks (prune '
+                        'only).')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='Only report what would be deleted (prune '
+                        'only).')
+    parser.add_argument('--sstableloader',
+                        metavar='HOSTS',
+                        help='Stream the tables to the cluster of these comma '
+                        'separated hosts with sstableloader (cassandra '
+                        'only).')
+    parser.add_argument('--loader-throttle',
+                        type=float,
+                        help='Throttle each sstableloader to LOADER_THROTTLE '
+                        'Mbit/s (cassandra only).')
+    parser.add_argument('--command-timeout',
+                        type=float,
+                        help='Kill the external commands that run longer '
+                        'than COMMAND_TIMEOUT seconds.')
+    parser.add_argument('--bulk-size',
+                        type=int,
+                        default=ES_BULK_BYTES,
+                        help='Size in bytes of the bulk requests '
+                        '(elasticsearch only).')
     params, dbargs = parser.parse_known_args()
 
     # Logging
@@ -738,7 +5262,10 @@ def main():
     elif params.verbose:
         log_level = logging.INFO
     logging.basicConfig(level=log_level, format='%(levelname)s %(message)s')
-    urllib3.disable_warnings()
+
+    command = 'restore'
+    if dbargs and dbargs[0] in COMMANDS:
+        command = dbargs.pop(0)
 
     # DB validation
     if not dbargs:
@@ -749,12 +5276,110 @@ def main():
                       dbargs[0])
         sys.exit(1)
     if dbargs[0] != CASSANDRA:
-        if params.restore_keyspaces or params.refresh or params.verify:
-            logging.error('--restore-keyspaces, --refresh and --verify only '
+        if params.restore_keyspaces or params.refresh or params.no_schema:
+            logging.error('--restore-keyspaces, --refresh and --no-schema '
+                          'only available for Cassandra.')
+            sys.exit(1)
+        if command == 'coordinate':
+            logging.error('coordinate only available for Cassandra.')
+            sys.exit(1)
+        if params.keyspace or params.table:
+            logging.error('--keyspace and --table only available for '
+                          'Cassandra.')
+            sys.exit(1)
+        if params.sstableloader or params.loader_throttle:
+            logging.error('--sstableloader and --loader-throttle only '
                           'available for Cassandra.')
             sys.exit(1)
+    if params.database and dbargs[0] not in [ZINFLUXDB, POSTGRES]:
+        logging.error('--database only available for InfluxDB and '
+                      'PostgreSQL.')
+        sys.exit(1)
+    if params.index and dbargs[0] != ELASTICSEARCH:
+        logging.error('--index only available for Elasticsearch.')
+        sys.exit(1)
+    for table in params.table or []:
+        if '.' not in table:
+            logging.error('--table must be keyspace.table: %s', table)
+            sys.exit(1)
+    if command == 'coordinate' and not params.inventory:
+        logging.error('coordinate needs --inventory.')
+        sys.exit(1)
+    if command == 'backup' and dbargs[0] not in BACKUP_DATATYPES:
+        logging.error('backup only available for %s.',
+                      ' and '.join(BACKUP_DATATYPES))
+        sys.exit(1)
+    if params.dedup and (command != 'backup' or dbargs[0] != CASSANDRA):
+        logging.error('--dedup only available for Cassandra backups.')
+        sys.exit(1)
+    if command == 'prune' and (params.database or params.keyspace
+                               or params.table or params.index):
+        logging.error('prune applies to whole backups, not to a selection.')
+        sys.exit(1)
+    if params.loader_throttle and not params.sstableloader:
+        logging.error('--loader-throttle needs --sstableloader.')
+        sys.exit(1)
+    if params.keep_daily < 0 or params.keep_weekly < 0:
+        logging.error('--keep-daily and --keep-weekly must not be negative.')
+        sys.exit(1)
+    if command == 'backup' and params.database:
+        logging.error('--database not available for backup, influxdb '
+                      'backups hold all databases.')
+        sys.exit(1)
 
-    return restore(dbargs[0], params)
+    # Output paths are relative to where the script was started
+    metrics_files = [
+        os.path.abspath(path) if path else None
+        for path in [params.metrics_file, params.metrics_json]
+    ]
+    profile_report = os.path.abspath(params.profile_report)
+    params.scrub_report = os.path.abspath(params.scrub_report)
+    params.coordinate_report = os.path.abspath(params.coordinate_report)
+    SUPERVISOR.concurrency = params.jobs
+    SUPERVISOR.timeout = params.command_timeout
+    if params.profile or params.profile_cprofile or params.profile_memory:
+        PROFILER.enable(use_cprofile=params.profile_cprofile,
+                        use_tracemalloc=params.profile_memory)
+    actions = [
+        action for action in [
+            'show_last', 'plan', 'download', 'restore_keyspaces', 'restore',
+            'refresh', 'verify', 'cleanup'
+        ] if getattr(params, action)
+    ]
+    if command != 'restore':
+        actions = [command]
+    METRICS.labels = {
+        'datatype': dbargs[0],
+        'action': actions[0] if actions else 'none'
+    }
+    start = time.monotonic()
+    if command == 'scrub':
+        ret = scrub(dbargs[0], params)
+    elif command == 'coordinate':
+        ret = coordinate(dbargs[0], params)
+    elif command == 'backup':
+        ret = backup(dbargs[0], params)
+    elif command == 'prune':
+        ret = prune(dbargs[0], params)
+    else:
+        ret = restore(dbargs[0], params)
+    METRICS.add('restore_duration_seconds', time.monotonic() - start)
+    METRICS.add('restore_success', int(ret == 0))
+    METRICS.add('restore_last_run_timestamp_seconds', time.time())
+    try:
+        if metrics_files[0]:
+            METRICS.write_textfile(metrics_files[0])
+        if metrics_files[1]:
+            METRICS.write_json(metrics_files[1])
+    except OSError as error:
+        logging.error('Unable to write metrics: %s', error)
+    if PROFILER.enabled:
+        try:
+            PROFILER.write_report(profile_report)
+            logging.info('Profile report written to %s', profile_report)
+        except OSError as error:
+            logging.error('Unable to write profile report: %s', error)
+    return ret
 
 
 if __name__ == '__main__':
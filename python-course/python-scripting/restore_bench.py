@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+
+"""Benchmark for the restore pipeline that runs without a storage bucket or a
+database cluster.
+
+
+Usage: restore_bench [-h] [--verbose] [--suites SUITES]
+                     [--max-startup MAX_STARTUP] [--datatypes DATATYPES]
+                     [--file-size FILE_SIZE] [--files FILES] [--tables TABLES]
+                     [--incrementals INCREMENTALS] [--zero-ratio ZERO_RATIO]
+                     [--repeat REPEAT] [--codec CODEC] [--codecs CODECS]
+                     [--output OUTPUT] [--compare COMPARE]
+                     [--tolerance TOLERANCE] [--keep]
+
+The benchmark generates a synthetic backup set, GPG encrypted tarballs laid out
+like the real ones (cassandra-data/<ts>/<db>.tar.gz.gpg for cassandra and
+zinfluxdb-data/<date>/<ts>-full|-inc.tar.gz.gpg for influxdb, compressed with
+--codec), in a local
+directory served by the filesystem storage backend. It then times
+download_last_backup, decrypt, restore_keyspaces and restore_data of restore.py
+against temporary data directories. External tools that need a live database
+(cqlsh, influxd) are replaced by stand-ins that succeed immediately, and the
+influxdb client by one answering like an empty server, so the timings cover the
+storage, GPG, tar and copy work done by the restore.
+
+The shape of the backup is configurable: the number of tables per keyspace, the
+number and size of the SSTable files per table, the number of incremental
+influxdb backups and the fraction of each file that is zeroes (which controls
+how well the tarballs compress).
+
+The codecs suite compares the compression codecs of restore.py (--codecs, all
+of the installed ones by default) on a keyspace of the same shape: for each of
+them, the time to compress it into a tarball and to extract it, with the
+programs restore.py would use, and the compression ratio. Decryption costs the
+same whatever the codec, so the tarballs are not encrypted.
+
+The startup suite times restore.py --help, and fails if importing restore.py
+loads any storage backend or database client module (they must be imported
+lazily) or if startup takes longer than --max-startup seconds.
+
+Results are written as JSON with --output. With --compare, the results are
+compared against a previous JSON file and the benchmark exits with an error if
+any phase got slower by more than --tolerance (20% by default).
+
+"""
+
+import os
+import sys
+import argparse
+import json
+import logging
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import restore
+
+GPG_KEY_NAME = 'restore-bench'
+GPG_PASSPHRASE = 'restore-bench'
+
+# The database of the synthetic influxdb backups
+INFLUXDB_DATABASE = 'telegraf'
+
+# The cassandra datasource restores this fixed set of keyspaces
+CASSANDRA_DBS = [
+    'brazosdb', 'doloresdb', 'gangesdb', 'indusdb', 'purusdb', 'seinedb',
+    'system_schema', 'tigrisdb', 'upgrade', 'vault', 'volgadb'
+]
+
+STANDIN_TOOLS = ['cqlsh', 'influxd', 'nodetool']
+
+SUITES = ['restore', 'startup', 'codecs']
+
+# Datatypes with synthetic backups
+DATATYPES = [restore.CASSANDRA, restore.ZINFLUXDB]
+
+# Modules restore.py must not import until a backend or datasource needs them
+LAZY_MODULES = [
+    'boto3', 'botocore', 'azure', 'gnupg', 'influxdb', 'cassandra', 'urllib3',
+    'psycopg2'
+]
+
+RESTORE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'restore.py')
+
+
+def run(cmd, **kwargs):
+    """ Run a command, raising on failure """
+    logging.debug(cmd)
+    subprocess.run(cmd, check=True, **kwargs)
+
+
+def write_file(path, size, zero_ratio):
+    """ Write a file of size bytes, the first zero_ratio of it zeroes """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    zeroes = int(size * zero_ratio)
+    with open(path, 'wb') as sfh:
+        sfh.write(bytes(zeroes))
+        sfh.write(os.urandom(size - zeroes))
+
+
+def setup_gpg(home):
+    """ Create a GPG home with a passphrase protected key, like the one the
+        restore script decrypts with """
+    gnupghome = os.path.join(home, '.gnupg')
+    os.makedirs(gnupghome, mode=0o700)
+    run([
+        'gpg', '--batch', '--homedir', gnupghome, '--pinentry-mode',
+        'loopback', '--passphrase', GPG_PASSPHRASE, '--quick-gen-key',
+        GPG_KEY_NAME, 'default', 'default', 'never'
+    ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return gnupghome
+
+
+def make_tarball(gnupghome, src_dir, members, dest):
+    """ Tar and compress members of src_dir with the codec of dest, and
+        encrypt the tarball to dest """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tarball = dest[:-len('.gpg')]
+    run(['tar', 'cf', tarball] +
+        restore.tar_codec_args(tarball, decompress=False) + ['-C', src_dir] +
+        members)
+    run([
+        'gpg', '--batch', '--yes', '--homedir', gnupghome, '--trust-model',
+        'always', '--recipient', GPG_KEY_NAME, '--output', dest, '--encrypt',
+        tarball
+    ])
+    os.unlink(tarball)
+
+
+def make_cassandra_backup(gnupghome, bucket, stage, params):
+    """ Generate a cassandra backup set in bucket. Returns the table
+        directories the restore expects in the cassandra data directory. """
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    table_dirs = []
+    for keyspace in CASSANDRA_DBS:
+        ks_stage = os.path.join(stage, keyspace)
+        os.makedirs(ks_stage)
+        with open(os.path.join(ks_stage, 'schema-{}.cql'.format(keyspace)),
+                  'w') as schema:
+            schema.write('CREATE KEYSPACE {};\n'.format(keyspace))
+        with open(os.path.join(ks_stage, '{}.stats'.format(keyspace)),
+                  'w') as stats:
+            for tbl in range(params.tables):
+                stats.write('{}.tbl{} {}\n'.format(keyspace, tbl, params.files))
+        for tbl in range(params.tables):
+            tbl_name = 'tbl{}'.format(tbl)
+            snapshot = os.path.join(ks_stage, keyspace,
+                                    '{}-{}'.format(tbl_name, uuid.uuid4().hex),
+                                    'snapshots', 'backup-bench')
+            for idx in range(params.files):
+                write_file(
+                    os.path.join(snapshot, 'md-{}-big-Data.db'.format(idx)),
+                    params.file_size, params.zero_ratio)
+            table_dirs.append(
+                os.path.join(keyspace,
+                             '{}-{}'.format(tbl_name, uuid.uuid4().hex)))
+        make_tarball(
+            gnupghome, ks_stage,
+            ['schema-{}.cql'.format(keyspace), '{}.stats'.format(keyspace),
+             keyspace],
+            os.path.join(bucket, 'cassandra-data', timestamp,
+                         '{}.tar.{}.gpg'.format(keyspace, params.codec)))
+        shutil.rmtree(ks_stage)
+    return table_dirs
+
+
+def make_influxdb_backup(gnupghome, bucket, stage, params):
+    """ Generate a full influxdb backup and incremental backups in bucket, one
+        day apart """
+    start = datetime.now() - timedelta(days=params.incrementals)
+    for idx in range(params.incrementals + 1):
+        when = start + timedelta(days=idx)
+        stamp = when.strftime('%Y%m%dT%H%M%SZ')
+        name = '{}-{}'.format(stamp, 'full' if idx == 0 else 'inc')
+        # The layout of influxd backup -portable: the meta store, one
+        # <ts>.s<shard id>.tar.gz file per shard and the manifest mapping
+        # the shards to their database
+        write_file(os.path.join(stage, name, '{}.meta'.format(stamp)), 1024,
+                   0)
+        files = []
+        for shard in range(params.files):
+            files.append({
+                'database': INFLUXDB_DATABASE,
+                'policy': 'autogen',
+                'shardID': shard + 1,
+                'fileName': '{}.s{}.tar.gz'.format(stamp, shard + 1),
+                'size': params.file_size,
+                'lastModified': 0
+            })
+            write_file(os.path.join(stage, name, files[-1]['fileName']),
+                       params.file_size, params.zero_ratio)
+        with open(os.path.join(stage, name, '{}.manifest'.format(stamp)),
+                  'w') as mfh:
+            json.dump(
+                {
+                    'meta': {
+                        'fileName': '{}.meta'.format(stamp),
+                        'size': 1024
+                    },
+                    'limited': False,
+                    'files': files
+                }, mfh)
+        dest = os.path.join(bucket, 'zinfluxdb-data', when.strftime('%Y-%m-%d'),
+                            '{}.tar.{}.gpg'.format(name, params.codec))
+        make_tarball(gnupghome, stage, [name], dest)
+        # The listing orders influxdb backups by modification time
+        os.utime(dest, (when.timestamp(), when.timestamp()))
+        shutil.rmtree(os.path.join(stage, name))
+
+
+def make_standin_tools(bindir):
+    """ Write the stand-ins of STANDIN_TOOLS, which succeed immediately, to
+        bindir """
+    os.makedirs(bindir)
+    for tool in STANDIN_TOOLS:
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as tfh:
+            tfh.write('#!/bin/sh\nexit 0\n')
+        os.chmod(path, 0o755)
+
+
+class StandinInfluxDBClient:
+    """ Stand-in for the influxdb client of the datasource, answering like
+        the server the influxd stand-in restored databases to """
+    def __init__(self, databases):
+        self.databases = databases
+
+    def get_list_database(self):
+        """ The databases restored """
+        return [{'name': name} for name in self.databases]
+
+    def switch_database(self, database):
+        """ Nothing to switch """
+
+    def query(self, query, **kwargs):
+        """ The merge of the incremental backups has nothing to copy """
+
+    def drop_database(self, database):
+        """ Nothing to drop """
+
+    def close(self):
+        """ Nothing to close """
+
+
+def make_client(datatype, bucket, data_dir):
+    """ Return a backup client restoring datatype from bucket into data_dir """
+    os.environ['BACKUP_DIR_PATH'] = bucket
+    return restore.FilesystemClient(datatype=datatype,
+                                    data_dir=data_dir,
+                                    workdir=os.path.join(
+                                        data_dir, datatype + '-data'))
+
+
+def timed(run_results, name, nbytes, func, *args, **kwargs):
+    """ Run func, adding its duration and the bytes it processed to the
+        results of phase name in this run """
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    result = run_results.setdefault(name, {'seconds': 0.0, 'bytes': 0})
+    result['seconds'] += time.perf_counter() - start
+    result['bytes'] += nbytes
+    return ret
+
+
+def bench_restore(datatype, bucket, data_dir, table_dirs, results):
+    """ Time each phase of restoring datatype from bucket into data_dir """
+    os.makedirs(data_dir)
+    for table_dir in table_dirs:
+        os.makedirs(os.path.join(data_dir, 'data', table_dir))
+    client = make_client(datatype, bucket, data_dir)
+    compressed = sum(client.sizes[key] for key in client.get_last_backup_keys())
+
+    run_results = {}
+    etarballs = timed(run_results, '{}.download_last_backup'.format(datatype),
+                      compressed, client.download_last_backup)
+    for etarball in etarballs:
+        if not timed(run_results, '{}.decrypt'.format(datatype),
+                     os.path.getsize(etarball), restore.decrypt, etarball):
+            raise RuntimeError('Failed to decrypt {}'.format(etarball))
+
+    if datatype == restore.CASSANDRA:
+        datasource = client.datasource
+        if not timed(run_results, 'cassandra.restore_keyspaces', compressed,
+                     datasource.restore_keyspaces):
+            raise RuntimeError('Failed to restore keyspaces')
+        if not timed(run_results, 'cassandra.restore_data', compressed,
+                     datasource.restore_data):
+            raise RuntimeError('Failed to restore data')
+    elif datatype == restore.ZINFLUXDB:
+        datasource = client.datasource
+        datasource.client = StandinInfluxDBClient([INFLUXDB_DATABASE])
+        if not timed(run_results, 'zinfluxdb.restore_data', compressed,
+                     datasource.restore_data):
+            raise RuntimeError('Failed to restore data')
+
+    for name, result in run_results.items():
+        results.setdefault(name, []).append(result)
+
+
+def bench_startup(params, results):
+    """ Time the startup of restore.py; returns False if it loads a backend
+        module on import or starts slower than params.max_startup """
+    check = ('import json, sys; sys.path.insert(0, {!r}); import restore; '
+             'print(json.dumps(sorted(set(name.split(".")[0] '
+             'for name in sys.modules))))').format(
+                 os.path.dirname(RESTORE_SCRIPT))
+    proc = subprocess.run([sys.executable, '-c', check],
+                          check=True,
+                          stdout=subprocess.PIPE)
+    loaded = [
+        name for name in json.loads(proc.stdout) if name in LAZY_MODULES
+    ]
+    if loaded:
+        logging.error('Importing restore.py loads %s', ', '.join(loaded))
+        return False
+
+    for _ in range(params.repeat):
+        run_results = {}
+        timed(run_results, 'startup.help', 0, subprocess.run,
+              [sys.executable, RESTORE_SCRIPT, '--help'],
+              stdout=subprocess.DEVNULL)
+        results.setdefault('startup.help', []).append(
+            run_results['startup.help'])
+    seconds = statistics.median(
+        sample['seconds'] for sample in results['startup.help'])
+    if seconds > params.max_startup:
+        logging.error('restore.py --help took %.3fs (max %.3fs)', seconds,
+                      params.max_startup)
+        return False
+    return True
+
+
+def bench_codecs(params, workdir, results):
+    """ Time compressing a keyspace of the shape of params into a tarball and
+        extracting it with each codec, and record the compression ratio """
+    src = os.path.join(workdir, 'src')
+    for tbl in range(params.tables):
+        for idx in range(params.files):
+            write_file(
+                os.path.join(src, 'ks', 'tbl{}'.format(tbl), 'snapshots',
+                             'backup-bench', 'md-{}-big-Data.db'.format(idx)),
+                params.file_size, params.zero_ratio)
+    size = params.tables * params.files * params.file_size
+    for codec in params.codecs:
+        program = restore.codec_program(codec)
+        if not shutil.which(program.split()[0]):
+            logging.warning('Skipping %s, %s is not installed', codec,
+                            program.split()[0])
+            continue
+        tarball = os.path.join(workdir, 'ks.tar.' + codec)
+        dest = os.path.join(workdir, 'out')
+        for _ in range(params.repeat):
+            run_results = {}
+            timed(run_results, 'codecs.{}.compress'.format(codec), size, run,
+                  ['tar', 'cf', tarball] +
+                  restore.tar_codec_args(tarball, decompress=False) +
+                  ['-C', src, 'ks'])
+            os.makedirs(dest)
+            timed(run_results, 'codecs.{}.extract'.format(codec), size, run,
+                  ['tar', 'xf', tarball, '-C', dest] +
+                  restore.tar_codec_args(tarball))
+            shutil.rmtree(dest)
+            ratio = size / os.path.getsize(tarball)
+            for name, result in run_results.items():
+                result['ratio'] = ratio
+                results.setdefault(name, []).append(result)
+        logging.info('%s (%s): ratio %.2f', codec, program, ratio)
+        os.unlink(tarball)
+
+
+def summarize(results):
+    """ Reduce the samples of each phase to their median """
+    summary = {}
+    for name, samples in results.items():
+        seconds = statistics.median(sample['seconds'] for sample in samples)
+        nbytes = samples[0]['bytes']
+        summary[name] = {
+            'seconds': seconds,
+            'bytes': nbytes,
+            'bytes_per_second': nbytes / seconds
+            if nbytes and seconds else None,
+            'samples': len(samples)
+        }
+        if 'ratio' in samples[0]:
+            summary[name]['ratio'] = samples[0]['ratio']
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """ Log phases slower than baseline by more than tolerance; returns the
+        number of regressions """
+    regressions = 0
+    for name, result in sorted(summary.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        after = result['seconds']
+        change = (after - before) / before if before else 0.0
+        if change > tolerance:
+            logging.error('%s regressed: %.3fs -> %.3fs (%+.0f%%)', name,
+                          before, after, change * 100)
+            regressions += 1
+        else:
+            logging.info('%s: %.3fs -> %.3fs (%+.0f%%)', name, before, after,
+                         change * 100)
+    return regressions
+
+
+def benchmark(params, workdir):
+    """ Generate the backups in workdir and run the benchmark """
+    home = os.path.join(workdir, 'home')
+    bucket = os.path.join(workdir, 'bucket')
+    bindir = os.path.join(workdir, 'bin')
+    make_standin_tools(bindir)
+    os.environ.update({
+        'HOME': home,
+        'GPG_PASSPHRASE': GPG_PASSPHRASE,
+        'CASSANDRA_USERNAME': 'bench',
+        'CASSANDRA_PASSWORD': 'bench',
+        'PATH': bindir + os.pathsep + os.environ.get('PATH', '')
+    })
+    gnupghome = setup_gpg(home)
+
+    table_dirs = {}
+    if restore.CASSANDRA in params.datatypes:
+        table_dirs[restore.CASSANDRA] = make_cassandra_backup(
+            gnupghome, bucket, os.path.join(workdir, 'stage'), params)
+    if restore.ZINFLUXDB in params.datatypes:
+        table_dirs[restore.ZINFLUXDB] = []
+        make_influxdb_backup(gnupghome, bucket,
+                             os.path.join(workdir, 'stage'), params)
+
+    results = {}
+    for run_idx in range(params.repeat):
+        for datatype in params.datatypes:
+            data_dir = os.path.join(workdir, 'run{}'.format(run_idx), datatype)
+            bench_restore(datatype, bucket, data_dir, table_dirs[datatype],
+                          results)
+            shutil.rmtree(data_dir)
+    return summarize(results)
+
+
+def main():
+    """ Main """
+    parser = argparse.ArgumentParser('restore_bench')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='Set log level to verbose')
+    parser.add_argument('--suites',
+                        default=','.join(SUITES),
+                        help='Comma separated suites to run.')
+    parser.add_argument('--max-startup',
+                        type=float,
+                        default=0.5,
+                        help='Slowest acceptable restore.py startup (seconds).')
+    parser.add_argument('--datatypes',
+                        default=','.join(DATATYPES),
+                        help='Comma separated datatypes to benchmark.')
+    parser.add_argument('--file-size',
+                        type=int,
+                        default=4 * 1024 * 1024,
+                        help='Size of each generated data file in bytes.')
+    parser.add_argument('--files',
+                        type=int,
+                        default=4,
+                        help='Data files per table or influxdb backup.')
+    parser.add_argument('--tables',
+                        type=int,
+                        default=2,
+                        help='Tables per cassandra keyspace.')
+    parser.add_argument('--incrementals',
+                        type=int,
+                        default=3,
+                        help='Incremental influxdb backups after the full one.')
+    parser.add_argument('--zero-ratio',
+                        type=float,
+                        default=0.5,
+                        help='Fraction of each data file that is zeroes.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of runs; the median is reported.')
+    parser.add_argument('--codec',
+                        choices=sorted(restore.CODECS),
+                        default=restore.BACKUP_CODEC,
+                        help='Codec of the generated backups.')
+    parser.add_argument('--codecs',
+                        default=','.join(restore.CODECS),
+                        help='Comma separated codecs to compare.')
+    parser.add_argument('--output', help='Write results to this JSON file.')
+    parser.add_argument('--compare',
+                        help='Compare results against this JSON file.')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.20,
+                        help='Slowdown flagged as a regression by --compare.')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='Keep the generated backups and data directories.')
+    params = parser.parse_args()
+    params.datatypes = params.datatypes.split(',')
+    params.suites = params.suites.split(',')
+    params.codecs = params.codecs.split(',')
+    logging.basicConfig(level=logging.INFO if params.verbose else logging.ERROR,
+                        format='%(levelname)s %(message)s')
+    for datatype in params.datatypes:
+        if datatype not in DATATYPES:
+            logging.error('Unsupported datatype: %s', datatype)
+            return 1
+    for suite in params.suites:
+        if suite not in SUITES:
+            logging.error('Unknown suite: %s', suite)
+            return 1
+    for codec in params.codecs:
+        if codec not in restore.CODECS:
+            logging.error('Unknown codec: %s', codec)
+            return 1
+
+    output = os.path.abspath(params.output) if params.output else None
+    baseline = None
+    if params.compare:
+        with open(params.compare) as bfh:
+            baseline = json.load(bfh)['results']
+
+    ret = 0
+    summary = {}
+    if 'startup' in params.suites:
+        results = {}
+        if not bench_startup(params, results):
+            ret = 1
+        summary.update(summarize(results))
+    if 'restore' in params.suites:
+        workdir = tempfile.mkdtemp(prefix='restore-bench-')
+        try:
+            summary.update(benchmark(params, workdir))
+        finally:
+            if params.keep:
+                print('Benchmark files kept in {}'.format(workdir))
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    if 'codecs' in params.suites:
+        workdir = tempfile.mkdtemp(prefix='restore-bench-')
+        try:
+            results = {}
+            bench_codecs(params, workdir, results)
+            summary.update(summarize(results))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'params': {
+            key: value
+            for key, value in vars(params).items()
+            if key not in ['output', 'compare', 'verbose', 'keep']
+        },
+        'results': summary
+    }
+    row = '{:<40} {:>10} {:>12} {:>14}'
+    print(row.format('PHASE', 'SECONDS', 'SIZE', 'THROUGHPUT'))
+    for name, result in sorted(summary.items()):
+        rate = result['bytes_per_second']
+        print(
+            row.format(
+                name, '{:.3f}'.format(result['seconds']),
+                restore.human_size(result['bytes']),
+                '{}/s'.format(restore.human_size(rate)) if rate else '-'))
+    ratios = {
+        name.split('.')[1]: result['ratio']
+        for name, result in summary.items() if 'ratio' in result
+    }
+    for codec, ratio in sorted(ratios.items()):
+        print('{} compression ratio: {:.2f}'.format(codec, ratio))
+    if output:
+        with open(output, 'w') as ofh:
+            json.dump(report, ofh, indent=2)
+
+    if baseline is not None and compare(summary, baseline,
+                                        params.tolerance):
+        return 1
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())